@@ -0,0 +1,394 @@
+# ztreamy: a framework for publishing semantic events on the Web
+# Copyright (C) 2011-2015 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+import unittest
+import socket
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.iostream
+import tornado.simple_httpclient
+import tornado.tcpclient
+
+import ztreamy
+from ztreamy import events
+from ztreamy.client import (AsyncStreamingClient, BatchingEventPublisher,
+                            StreamingEventPublisher)
+from ztreamy.server import StreamServer, Stream
+
+
+class TestAsyncStreamingClient(unittest.TestCase):
+
+    def test_lost_events(self):
+        received = []
+        client = AsyncStreamingClient('http://127.0.0.1/test/stream',
+                                      event_callback=received.append,
+                                      reconnect=False)
+        evs = [events.Event('source-id-value', 'text/plain',
+                            'Event {}'.format(i),
+                            extra_headers={ztreamy.sequence_header: str(i)})
+               for i in range(20)]
+        client._deliver_events(evs[:5])
+        client._deliver_events(evs[5:6] + evs[8:12] + evs[15:17])
+        self.assertEqual(client.lost_events, 5)
+        client._deliver_events(evs[18:])
+        self.assertEqual(client.lost_events, 6)
+        self.assertEqual(client.last_sequence, 19)
+        self.assertEqual(len(received), 14)
+
+    def test_renumbering_callback(self):
+        # A relay stream renumbers the events it receives
+        def renumber(evs):
+            for i, event in enumerate(evs):
+                event.set_extra_header(ztreamy.sequence_header, str(i))
+        client = AsyncStreamingClient('http://127.0.0.1/test/stream',
+                                      event_callback=renumber,
+                                      separate_events=False,
+                                      reconnect=False)
+        evs = [events.Event('source-id-value', 'text/plain',
+                            'Event {}'.format(i),
+                            extra_headers={ztreamy.sequence_header: str(i)})
+               for i in range(100, 105)]
+        client._deliver_events(evs[:2])
+        client._deliver_events(evs[2:])
+        self.assertEqual(client.last_sequence, 104)
+        self.assertEqual(client.lost_events, 0)
+
+
+class TestBatchingEventPublisher(unittest.TestCase):
+
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.server = StreamServer(self.port, ioloop=self.ioloop)
+        self.stream = Stream('/test', allow_publish=True, ioloop=self.ioloop)
+        self.server.add_stream(self.stream)
+        self.received = []
+        self.stream.create_local_client(self.received.append)
+        self.events = [events.Event('source-id-value', 'text/plain',
+                                    'Event {:03d}'.format(i))
+                       for i in range(200)]
+        self.batches = []
+        self.drained = []
+
+    def tearDown(self):
+        self.server.stop()
+        self.ioloop.close(all_fds=True)
+
+    def test_buffering(self):
+        publisher = self._publisher(buffering_time=20)
+        responses = []
+
+        @tornado.gen.coroutine
+        def run():
+            publisher.publish(self.events[0], callback=responses.append)
+            publisher.publish_events(self.events[1:3])
+            self.assertEqual(publisher.num_requests, 0)
+            yield self._wait(3)
+            self.assertEqual(len(self.batches), 1)
+            self.assertEqual(len(responses), 1)
+            # A full batch is sent without waiting
+            publisher.publish_events(self.events[3:53])
+            self.assertEqual(publisher.num_requests, 1)
+            publisher.close()
+            yield self._wait(53)
+
+        self.ioloop.run_sync(run, timeout=30)
+        self.assertEqual([len(evs) for evs in self.batches], [3, 50])
+        self.assertEqual(len(self.received), 53)
+
+    def test_coalescing(self):
+        publisher = self._publisher(buffering_time=0)
+
+        @tornado.gen.coroutine
+        def run():
+            # The server is busy with the first event while
+            # the rest of them are coalesced into batches
+            for event in self.events:
+                publisher.publish(event)
+            self.assertTrue(publisher.saturated)
+            yield self._wait(len(self.events))
+
+        self.ioloop.run_sync(run, timeout=30)
+        self.assertEqual([e.event_id for e in self.received],
+                         [e.event_id for e in self.events])
+        self.assertEqual([len(evs) for evs in self.batches],
+                         [1, 50, 50, 50, 49])
+        self.assertFalse(publisher.saturated)
+        self.assertEqual(publisher.pending_bytes, 0)
+        self.assertEqual(self.drained, [True])
+        publisher.close()
+
+    def test_failed_batches(self):
+        errors = []
+
+        @tornado.gen.coroutine
+        def run():
+            # The server is not running yet
+            publisher = BatchingEventPublisher( \
+                            'http://127.0.0.1:{}/test'.format(self.port),
+                            io_loop=self.ioloop, buffering_time=0,
+                            batch_callback=self._batch)
+            for event in self.events[:10]:
+                publisher.publish(event)
+            yield tornado.gen.sleep(0.3)
+            self.assertTrue(publisher.failed_attempts > 0)
+            self.assertEqual(self.batches, [])
+            self.server.start(loop=False)
+            publisher.close()
+            yield self._wait(10)
+            self.assertEqual(publisher.failed_attempts, 0)
+            self.assertEqual(publisher.pending_bytes, 0)
+            # Rejected batches are not sent again
+            publisher = BatchingEventPublisher( \
+                            'http://127.0.0.1:{}/other'.format(self.port),
+                            io_loop=self.ioloop, buffering_time=0,
+                            error_callback=lambda *args, **kwargs:
+                                                    errors.append(args))
+            publisher.publish(self.events[10])
+            deadline = time.time() + 5
+            while not errors and time.time() < deadline:
+                yield tornado.gen.sleep(0.005)
+            self.assertEqual(publisher.failed_attempts, 0)
+            self.assertEqual(publisher.pending_bytes, 0)
+            publisher.close()
+
+        self.ioloop.run_sync(run, timeout=30)
+        self.assertEqual([e.event_id for e in self.received],
+                         [e.event_id for e in self.events[:10]])
+        self.assertEqual(len(errors), 1)
+
+    def _publisher(self, **kwargs):
+        url = 'http://127.0.0.1:{}/test'.format(self.port)
+        event_size = len(str(self.events[0]))
+        self.server.start(loop=False)
+        return BatchingEventPublisher(url, io_loop=self.ioloop,
+                                      max_batch_bytes=50 * event_size,
+                                      max_requests=1,
+                                      max_pending_bytes=80 * event_size,
+                                      batch_callback=self._batch,
+                                      drain_callback=self._drain,
+                                      **kwargs)
+
+    @tornado.gen.coroutine
+    def _wait(self, num_events):
+        # Waits until the server acknowledges the events
+        deadline = time.time() + 5
+        while (sum(len(evs) for evs in self.batches) < num_events
+               and time.time() < deadline):
+            yield tornado.gen.sleep(0.005)
+
+    def _batch(self, evs, response):
+        self.assertEqual(response.code, 200)
+        self.batches.append(evs)
+
+    def _drain(self):
+        self.drained.append(True)
+
+
+class TestStreamingEventPublisher(unittest.TestCase):
+
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:{}/test'.format(sock.getsockname()[1])
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.server = StreamServer(sock.getsockname()[1], ioloop=self.ioloop)
+        sock.close()
+        self.stream = Stream('/test', allow_publish=True, ioloop=self.ioloop)
+        self.server.add_stream(self.stream)
+        self.received = []
+        self.stream.create_local_client(self.received.append)
+        self.events = [events.Event('source-id-value', 'text/plain',
+                                    'Event {}'.format(i))
+                       for i in range(30)]
+        self.server.start(loop=False)
+
+    def tearDown(self):
+        self.server.stop()
+        self.ioloop.close(all_fds=True)
+
+    def test_publish(self):
+        publisher = StreamingEventPublisher(self.url, io_loop=self.ioloop)
+
+        @tornado.gen.coroutine
+        def run():
+            # Events are dispatched while the request is still open
+            for i in range(0, 30, 10):
+                for event in self.events[i:i + 10]:
+                    publisher.publish(event)
+                yield self._wait(lambda: len(self.received) == i + 10)
+                self.assertTrue(publisher._connected)
+            publisher.close()
+            yield self._wait(lambda: not publisher._connected)
+
+        self.ioloop.run_sync(run, timeout=30)
+        self.assertEqual([e.event_id for e in self.received],
+                         [e.event_id for e in self.events])
+        self.assertEqual(publisher.buffered_bytes, 0)
+        self.assertFalse(publisher._connected)
+
+    def test_failed_write(self):
+        publisher = StreamingEventPublisher(self.url, io_loop=self.ioloop)
+        # Keeps the publisher from opening a request
+        publisher._connected = True
+        publisher.publish_events(self.events[:2])
+        data = ''.join(publisher._buffer)
+
+        def failed_write(data):
+            future = tornado.concurrent.Future()
+            future.set_exception(tornado.iostream.StreamClosedError())
+            return future
+
+        with self.assertRaises(tornado.iostream.StreamClosedError):
+            self.ioloop.run_sync(lambda: publisher._produce_body( \
+                                                            failed_write))
+        # The events are kept for the next request
+        self.assertEqual(publisher._buffer, [data])
+        self.assertEqual(publisher.buffered_bytes, len(data))
+        written = []
+
+        def write(data):
+            written.append(data)
+            future = tornado.concurrent.Future()
+            future.set_result(None)
+            return future
+
+        @tornado.gen.coroutine
+        def run():
+            producer = publisher._produce_body(write)
+            yield tornado.gen.sleep(0.01)
+            self.assertEqual(written, [data])
+            self.assertEqual(publisher.buffered_bytes, 0)
+            # The producer waiting for events ends with the request
+            publisher._request_callback(tornado.httpclient.HTTPResponse( \
+                                    tornado.httpclient.HTTPRequest(self.url),
+                                    200))
+            yield producer
+
+        self.ioloop.run_sync(run, timeout=5)
+        publisher.close()
+
+    def test_reconnection_delay(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:{}/test'.format(sock.getsockname()[1])
+        errors = []
+        publisher = StreamingEventPublisher(url, io_loop=self.ioloop,
+                            error_callback=lambda *args, **kwargs:
+                                                    errors.append(args))
+
+        @tornado.gen.coroutine
+        def run():
+            # Nobody listens at the port: the reconnections are delayed
+            publisher.publish(self.events[0])
+            yield tornado.gen.sleep(0.3)
+
+        self.ioloop.run_sync(run, timeout=5)
+        sock.close()
+        self.assertTrue(1 <= len(errors) < 10)
+        self.assertEqual(publisher.connection_attempts,
+                         len(errors) + int(publisher._connected))
+        publisher.close()
+        # The counter is reset after connecting successfully
+        publisher = StreamingEventPublisher(self.url, io_loop=self.ioloop)
+        publisher.connection_attempts = 5
+
+        @tornado.gen.coroutine
+        def run_connected():
+            publisher.publish(self.events[0])
+            yield self._wait(lambda: len(self.received) == 1)
+
+        self.ioloop.run_sync(run_connected, timeout=5)
+        self.assertEqual(publisher.connection_attempts, 0)
+        publisher.close()
+
+    def test_errors(self):
+        data = ztreamy.serialize_events(self.events[:2])
+        headers = {'Content-Type': ztreamy.event_media_type}
+
+        @tornado.gen.coroutine
+        def run():
+            client = tornado.simple_httpclient.SimpleAsyncHTTPClient( \
+                                                        force_instance=True)
+            for body in (data[:-10], data + 'Event-Id'):
+                response = yield client.fetch(self.url + '/publish-stream',
+                                              method='POST', body=body,
+                                              headers=headers,
+                                              raise_error=False)
+                self.assertEqual(response.code, 400)
+            client.close()
+
+        self.ioloop.run_sync(run, timeout=30)
+        # Complete events are dispatched anyway
+        self.assertEqual([e.event_id for e in self.received],
+                         [e.event_id for e in self.events[:1]
+                                                + self.events[:2]])
+
+    def test_error_in_open_request(self):
+        data = ztreamy.serialize_events(self.events[:2])
+        port = int(self.url.split(':')[2].split('/')[0])
+
+        @tornado.gen.coroutine
+        def run():
+            stream = yield tornado.tcpclient.TCPClient().connect('127.0.0.1',
+                                                                 port)
+            stream.write('POST /test/publish-stream HTTP/1.1\r\n'
+                         'Host: 127.0.0.1\r\n'
+                         'Content-Type: ' + ztreamy.event_media_type + '\r\n'
+                         'Transfer-Encoding: chunked\r\n\r\n')
+            for chunk in (data, 'Event-Id\r\n\r\n'):
+                stream.write('{:x}\r\n{}\r\n'.format(len(chunk), chunk))
+            # The request is rejected without waiting for its end
+            response = yield stream.read_until_close()
+            self.assertTrue(response.startswith('HTTP/1.1 400'))
+
+        self.ioloop.run_sync(run, timeout=5)
+        self.assertEqual([e.event_id for e in self.received],
+                         [e.event_id for e in self.events[:2]])
+
+    def test_malformed_body(self):
+        bad = events.Event('source-id-value', 'text/n3', '<a> <b> @@@ !!')
+        data = ztreamy.serialize_events(self.events[:1] + [bad])
+        headers = {'Content-Type': ztreamy.event_media_type}
+
+        @tornado.gen.coroutine
+        def run():
+            client = tornado.simple_httpclient.SimpleAsyncHTTPClient( \
+                                                        force_instance=True)
+            for path in ('/publish', '/publish-stream'):
+                response = yield client.fetch(self.url + path,
+                                              method='POST', body=data,
+                                              headers=headers,
+                                              raise_error=False)
+                self.assertEqual(response.code, 400)
+            client.close()
+
+        self.ioloop.run_sync(run, timeout=30)
+        self.assertEqual(self.received, [])
+
+    @tornado.gen.coroutine
+    def _wait(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            yield tornado.gen.sleep(0.005)
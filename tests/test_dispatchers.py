@@ -198,6 +198,89 @@ class TestZlibDispatcher(unittest.TestCase):
         self.assertEqual(clients[6].unzlib_sent_data(), data_c5_7)
         self.assertEqual(clients[7].unzlib_sent_data(), data_c5_7)
 
+    def test_shared_compression(self):
+        rnd = random.Random(45387)
+        uncompressed_data = [_random_string(rnd, 3000) for _ in range(6)]
+        stream = _MockStream('test/stream/path')
+        props = ClientPropertiesFactory.create( \
+                                streaming=True,
+                                encoding=ClientProperties.ENCODING_ZLIB)
+        d = ztreamy.dispatchers.ZlibDispatcher(stream, props,
+                                               shared_compression=True)
+        clients = [_MockClient(properties=props) for _ in range(5)]
+        d.subscribe(clients[0])
+        d.dispatch(_MockEventsPack(uncompressed_data[0]))
+        d.subscribe(clients[1])
+        d.subscribe(clients[2])
+        d.dispatch(_MockEventsPack(uncompressed_data[1]))
+        d.dispatch(_MockEventsPack(uncompressed_data[2]))
+        # A client that has already received some past events
+        initial_data = 'This is a pack of initial data.'
+        clients[3].send(ztreamy.dispatchers.compress_zlib(initial_data))
+        d.subscribe(clients[3])
+        d.subscribe(clients[4])
+        d.unsubscribe(clients[2])
+        d.dispatch(_MockEventsPack(uncompressed_data[3]))
+        d.dispatch(_MockEventsPack(uncompressed_data[4]))
+        d.dispatch(_MockEventsPack(uncompressed_data[5]))
+        self.assertEqual(len(d.groups), 1)
+        self.assertEqual(clients[0].unzlib_sent_data(),
+                         ''.join(uncompressed_data))
+        self.assertEqual(clients[1].unzlib_sent_data(),
+                         ''.join(uncompressed_data[1:]))
+        self.assertEqual(clients[2].unzlib_sent_data(),
+                         ''.join(uncompressed_data[1:3]))
+        self.assertEqual(clients[3].unzlib_sent_data(),
+                         initial_data + ''.join(uncompressed_data[3:]))
+        self.assertEqual(clients[4].unzlib_sent_data(),
+                         ''.join(uncompressed_data[3:]))
+
+    def test_compression_dictionary(self):
+        rnd = random.Random(8734)
+        uncompressed_data = [_random_string(rnd, 3000) for _ in range(5)]
+        dictionary = ztreamy.dispatchers.CompressionDictionary( \
+                                        ''.join(uncompressed_data[:2]))
+        new_dictionary = ztreamy.dispatchers.CompressionDictionary( \
+                                        ''.join(uncompressed_data[1:3]))
+        stream = _MockStream('test/stream/path')
+        props = ClientPropertiesFactory.create( \
+                                streaming=True,
+                                encoding=ClientProperties.ENCODING_ZLIB_DICT)
+        d = ztreamy.dispatchers.ZlibDispatcher(stream, props)
+        clients = [_MockClient(properties=props) for _ in range(3)]
+        clients[0].dictionary = dictionary
+        clients[1].dictionary = dictionary
+        clients[2].dictionary = new_dictionary
+        d.subscribe(clients[0])
+        d.subscribe(clients[1])
+        d.dispatch(_MockEventsPack(uncompressed_data[2]))
+        d.subscribe(clients[2])
+        d.dispatch(_MockEventsPack(uncompressed_data[3]))
+        d.dispatch(_MockEventsPack(uncompressed_data[4]))
+        # Clients with different dictionaries cannot share a group
+        self.assertEqual(len(d.groups), 2)
+        self.assertTrue(d.groups[0].dictionary is dictionary)
+        for client in clients[:2]:
+            decompressor = dictionary.decompressor()
+            self.assertEqual(decompressor.decompress(client.sent_data),
+                             ''.join(uncompressed_data[2:]))
+        decompressor = new_dictionary.decompressor()
+        self.assertEqual(decompressor.decompress(clients[2].sent_data),
+                         ''.join(uncompressed_data[3:]))
+        # The dictionary makes the first data of the stream smaller
+        self.assertTrue(len(dictionary.compress(uncompressed_data[0]))
+                        < len(ztreamy.dispatchers.compress_zlib( \
+                                                uncompressed_data[0])) / 2)
+        self.assertEqual(dictionary.decompress( \
+                                dictionary.compress(uncompressed_data[3])),
+                         uncompressed_data[3])
+
+    def test_train_compression_dictionary(self):
+        train = ztreamy.dispatchers.CompressionDictionary.train
+        evs = ['a' * 10, 'b' * 10, 'c' * 10]
+        self.assertEqual(train(evs, max_size=25).data, 'b' * 10 + 'c' * 10)
+        self.assertEqual(train(evs, max_size=5), None)
+
 
 class _MockStream(object):
     def __init__(self, path):
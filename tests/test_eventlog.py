@@ -0,0 +1,147 @@
+# ztreamy: a framework for publishing semantic events on the Web
+# Copyright (C) 2011-2015 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+import os
+import os.path
+import shutil
+import tempfile
+
+import ztreamy
+import ztreamy.events as events
+from ztreamy.eventlog import EventLog
+from ztreamy.server import Stream
+
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        source_id = ztreamy.random_id()
+        self.events = [events.Event(source_id, 'text/plain',
+                                    'Body of event {0}'.format(i))
+                       for i in range(100)]
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_reopen(self):
+        log = EventLog(self.path)
+        log.append(self.events[:30])
+        log.append(self.events[30:40])
+        log.close()
+        log = EventLog(self.path)
+        self.assertEqual(log.next_sequence, 40)
+        evs, first_sequence = log.read_recent(15)
+        self.assertEqual(first_sequence, 25)
+        self.assertEqual([e.event_id for e in evs],
+                         [e.event_id for e in self.events[25:40]])
+        log.append(self.events[40:45])
+        log.close()
+        evs, first_sequence = EventLog(self.path).read_recent(100)
+        self.assertEqual(first_sequence, 0)
+        self.assertEqual([str(e) for e in evs],
+                         [str(e) for e in self.events[:45]])
+
+    def test_segments_and_index(self):
+        log = EventLog(self.path)
+        log.segment_max_bytes = 1000
+        log.index_interval = 300
+        for i in range(0, 100, 10):
+            log.append(self.events[i:i + 10])
+        log.close()
+        self.assertTrue(len(log.segments) > 1)
+        log = EventLog(self.path)
+        for sequence in (0, 9, 10, 57, 99):
+            segment, offset = log.locate(sequence)
+            with open(segment.filename, 'rb') as f:
+                f.seek(offset)
+                data = f.read(len(str(self.events[sequence])))
+            self.assertEqual(data, str(self.events[sequence]))
+            self.assertEqual(log.find_event(self.events[sequence].event_id),
+                             sequence)
+        self.assertEqual(log.locate(100), None)
+        self.assertEqual(log.find_event(ztreamy.random_id()), None)
+
+    def test_retention(self):
+        log = EventLog(self.path, max_bytes=2500)
+        log.segment_max_bytes = 1000
+        for i in range(0, 100, 10):
+            log.append(self.events[i:i + 10])
+        log.close()
+        self.assertTrue(log.first_sequence > 0)
+        self.assertTrue(sum(s.size for s in log.segments) <= 2500)
+        files = [name for name in os.listdir(self.path)
+                 if name.endswith('.log')]
+        self.assertEqual(len(files), len(log.segments))
+        evs, first_sequence = EventLog(self.path).read_recent(100)
+        self.assertEqual(first_sequence, log.first_sequence)
+        self.assertEqual(evs[-1].event_id, self.events[-1].event_id)
+
+    def test_recover_incomplete_event(self):
+        log = EventLog(self.path)
+        log.append(self.events[:10])
+        log.close()
+        filename = log.segments[-1].filename
+        size = os.path.getsize(filename)
+        with open(filename, 'ab') as f:
+            f.write(str(self.events[10])[:-5])
+        log = EventLog(self.path)
+        self.assertEqual(log.next_sequence, 10)
+        self.assertEqual(os.path.getsize(filename), size)
+        log.append(self.events[10:12])
+        log.close()
+        evs, _ = EventLog(self.path).read_recent(100)
+        self.assertEqual([e.event_id for e in evs],
+                         [e.event_id for e in self.events[:12]])
+
+    def test_lf_headers(self):
+        # Raw events keep the line endings they were received with
+        data = ''.join(str(e).replace('\r\n', '\n')
+                       for e in self.events[:3])
+        evs = events.Deserializer().deserialize(data, parse_body=False,
+                                                complete=True)
+        self.assertTrue(isinstance(evs[0], events.RawEvent))
+        log = EventLog(self.path)
+        log.append(evs)
+        log.append(self.events[3:5])
+        log.close()
+        log = EventLog(self.path)
+        self.assertEqual(log.next_sequence, 5)
+        self.assertEqual(log.find_event(self.events[1].event_id), 1)
+        timestamp = ztreamy.rfc3339_as_time(self.events[0].timestamp)
+        self.assertEqual(log.find_time(timestamp), 0)
+        self.assertEqual(log.find_time(timestamp + 3600), 5)
+        evs, _ = log.read_recent(100)
+        self.assertEqual([e.event_id for e in evs],
+                         [e.event_id for e in self.events[:5]])
+        self.assertEqual(evs[1].body, self.events[1].body)
+
+    def test_stream_restart(self):
+        stream = Stream('/test', event_log_dir=self.path)
+        stream.dispatch_events(self.events[:20])
+        stream.stop()
+        stream = Stream('/test', event_log_dir=self.path,
+                        num_recent_events=8)
+        buf = stream.dispatcher.recent_events
+        self.assertEqual(buf.num_events, 20)
+        data, complete = buf.newer_than(self.events[14].event_id)
+        self.assertTrue(complete)
+        self.assertEqual([e.event_id for e in data],
+                         [e.event_id for e in self.events[15:20]])
+        stream.stop()
@@ -19,6 +19,9 @@
 
 import unittest
 import itertools
+import json
+
+import rdflib
 
 import ztreamy
 import ztreamy.events as events
@@ -129,3 +132,384 @@ class TestEvent(unittest.TestCase):
         self.assertEqual(event.event_type, deserialized[0].event_type)
         self.assertEqual(event.timestamp, deserialized[0].timestamp)
         self.assertEqual(event.extra_headers, deserialized[0].extra_headers)
+
+
+class TestDeserializer(unittest.TestCase):
+
+    def setUp(self):
+        self.events = [events.Event('source-{}'.format(i), 'text/plain',
+                                    'Body of event {}'.format(i) * (i + 1),
+                                    extra_headers={'X-Num': str(i)})
+                       for i in range(20)]
+        self.data = ztreamy.serialize_events(self.events)
+
+    def test_chunks(self):
+        for chunk_size in (1, 7, 100, 1000, len(self.data)):
+            deserializer = ztreamy.Deserializer()
+            deserializer.compaction_threshold = 256
+            evs = []
+            for pos in range(0, len(self.data), chunk_size):
+                evs.extend(deserializer.deserialize( \
+                                            self.data[pos:pos + chunk_size]))
+                self.assertTrue(len(deserializer._data)
+                                <= 256 + 2 * chunk_size + 1000)
+            self.assertEqual(deserializer.pending_data(), 0)
+            self._check_events(evs)
+
+    def test_data_consumed(self):
+        deserializer = ztreamy.Deserializer()
+        first_len = len(str(self.events[0]))
+        deserializer.append_data(self.data[:first_len + 10])
+        self.assertEqual(deserializer.data_consumed(), 0)
+        deserializer.deserialize_next()
+        self.assertEqual(deserializer.data_consumed(), first_len)
+        deserializer.append_data(self.data[first_len + 10:])
+        self.assertEqual(deserializer.data_consumed(), 0)
+        self._check_events(self.events[:1]
+                           + deserializer.deserialize(None, complete=True))
+
+    def test_lf_end_of_lines(self):
+        data = 'Event-Id: 1\nSource-Id: s\nSyntax: text/plain\n' \
+               'Body-Length: 4\n\nbodyEvent-Id: 2\nSource-Id: s\n' \
+               'Syntax: text/plain\nBody-Length: 0\n\n'
+        deserializer = ztreamy.Deserializer()
+        evs = deserializer.deserialize(data, complete=True)
+        self.assertEqual([e.event_id for e in evs], ['1', '2'])
+        self.assertEqual(evs[0].body, 'body')
+        self.assertEqual(evs[1].body, '')
+
+    def test_spurious_data(self):
+        deserializer = ztreamy.Deserializer()
+        with self.assertRaises(ztreamy.ZtreamyException):
+            deserializer.deserialize(self.data + 'Event-Id: 3\r\n',
+                                     complete=True)
+
+    def test_unicode_data(self):
+        deserializer = ztreamy.Deserializer()
+        evs = deserializer.deserialize(unicode(self.data[:100]))
+        evs.extend(deserializer.deserialize(unicode(self.data[100:]),
+                                            complete=True))
+        self._check_events(evs)
+
+        body = u'caf\xe9'
+        data = u'Event-Id: 1\r\nSource-Id: s\r\nSyntax: text/plain\r\n' \
+               u'Body-Length: 5\r\n\r\n' + body
+        evs = ztreamy.Deserializer().deserialize(data, complete=True)
+        self.assertEqual(evs[0].body, body.encode('utf-8'))
+
+    def _check_events(self, evs):
+        self.assertEqual(len(evs), len(self.events))
+        for original, event in zip(self.events, evs):
+            self.assertEqual(original.event_id, event.event_id)
+            self.assertEqual(original.source_id, event.source_id)
+            self.assertEqual(original.body, event.body)
+            self.assertEqual(original.extra_headers, event.extra_headers)
+
+
+class TestRawEvent(unittest.TestCase):
+
+    def setUp(self):
+        self.event = events.Event('source-id-value', 'text/plain', 'a body',
+                                  application_id='app',
+                                  aggregator_id=['agg-1'],
+                                  extra_headers={'X-Header': 'value'})
+        self.data = str(self.event)
+
+    def test_passthrough(self):
+        deserializer = ztreamy.Deserializer()
+        evs = deserializer.deserialize(self.data, parse_body=False,
+                                       complete=True)
+        self.assertEqual(len(evs), 1)
+        self.assertTrue(isinstance(evs[0], ztreamy.RawEvent))
+        self.assertFalse(evs[0]._decoded)
+        self.assertEqual(evs[0].event_id, self.event.event_id)
+        self.assertEqual(str(evs[0]), self.data)
+        self.assertFalse(evs[0]._decoded)
+
+    def test_lazy_headers(self):
+        raw_event = self._deserialize_raw(self.data)
+        self.assertEqual(raw_event.source_id, self.event.source_id)
+        self.assertTrue(raw_event._decoded)
+        self.assertEqual(raw_event.application_id, 'app')
+        self.assertEqual(raw_event.aggregator_id, ['agg-1'])
+        self.assertEqual(raw_event.event_type, None)
+        self.assertEqual(raw_event.timestamp, self.event.timestamp)
+        self.assertEqual(raw_event.extra_headers, {'X-Header': 'value'})
+        self.assertEqual(raw_event.body, 'a body')
+        self.assertEqual(str(raw_event), self.data)
+
+    def test_malformed_headers(self):
+        # Errors are reported when deserializing, not on first access
+        header_end = self.data.index('\r\n\r\n') + 2
+        for line in ('Bad header line\r\n',
+                     'Source-Id: other-source\r\n',
+                     ' Event-Type : \r\n Event-Type: Type\r\n'):
+            data = self.data[:header_end] + line + self.data[header_end:]
+            with self.assertRaises(ztreamy.ZtreamyException):
+                ztreamy.Deserializer().deserialize(data, parse_body=False,
+                                                   complete=True)
+        # Aggregator-Ids can be repeated, like in parsed events
+        data = (self.data[:header_end] + 'Aggregator-Ids: agg-2\r\n'
+                + self.data[header_end:])
+        raw_event = self._deserialize_raw(data)
+        self.assertEqual(raw_event.aggregator_id, ['agg-2'])
+        # The appended ids go after those of the last line
+        raw_event = self._deserialize_raw(data)
+        raw_event.append_aggregator_id('relay')
+        serialized = str(raw_event)
+        self.assertEqual(serialized.count('Aggregator-Ids:'), 1)
+        self.assertEqual(self._deserialize_raw(serialized).aggregator_id,
+                         ['agg-2', 'relay'])
+        self.assertEqual(ztreamy.Deserializer().deserialize( \
+                                serialized, complete=True)[0].aggregator_id,
+                         ['agg-2', 'relay'])
+        raw_event = self._deserialize_raw(data.replace('agg-2',
+                                                       'agg-2 , agg-3'))
+        self.assertEqual(raw_event.aggregator_id, ['agg-2', 'agg-3'])
+
+    def test_append_aggregator_id(self):
+        raw_event = self._deserialize_raw(self.data)
+        raw_event.append_aggregator_id('agg-2')
+        self.assertFalse(raw_event._decoded)
+        raw_event.append_aggregator_id('agg-3')
+        event = self._deserialize_raw(str(raw_event))
+        self.assertEqual(event.aggregator_id, ['agg-1', 'agg-2', 'agg-3'])
+        self.assertEqual(event.extra_headers, {'X-Header': 'value'})
+        # Now with the headers decoded
+        raw_event = self._deserialize_raw(self.data)
+        self.assertEqual(raw_event.aggregator_id, ['agg-1'])
+        raw_event.append_aggregator_id('agg-2')
+        raw_event.aggregator_id.append('agg-3')
+        event = self._deserialize_raw(str(raw_event))
+        self.assertEqual(event.aggregator_id, ['agg-1', 'agg-2', 'agg-3'])
+
+    def test_modification(self):
+        raw_event = self._deserialize_raw(self.data)
+        raw_event.source_id = 'another-source-id'
+        raw_event.set_extra_header('X-Other', 'other')
+        event = ztreamy.Deserializer().deserialize(str(raw_event),
+                                                   complete=True)[0]
+        self.assertEqual(event.source_id, 'another-source-id')
+        self.assertEqual(event.extra_headers,
+                         {'X-Header': 'value', 'X-Other': 'other'})
+        self.assertEqual(event.aggregator_id, ['agg-1'])
+        with self.assertRaises(ValueError):
+            raw_event.event_type = 5
+
+    def test_set_extra_header(self):
+        raw_event = self._deserialize_raw(self.data)
+        raw_event.set_extra_header(ztreamy.sequence_header, '7')
+        raw_event.set_extra_header('X-Header', 'new value')
+        self.assertFalse(raw_event._decoded)
+        self.assertEqual(raw_event.sequence_number(), 7)
+        self.assertEqual(raw_event.get_extra_header('X-Header'), 'new value')
+        self.assertEqual(raw_event.get_extra_header('X-Other'), None)
+        self.assertFalse(raw_event._decoded)
+        event = ztreamy.Deserializer().deserialize(str(raw_event),
+                                                   complete=True)[0]
+        self.assertEqual(event.extra_headers,
+                         {'X-Header': 'new value',
+                          ztreamy.sequence_header: '7'})
+        self.assertEqual(event.sequence_number(), 7)
+        with self.assertRaises(ValueError):
+            raw_event.set_extra_header('Source-Id', 'another-source-id')
+
+    def test_stamp_sequence_number(self):
+        raw_event = self._deserialize_raw(self.data)
+        self.assertTrue(raw_event.stamp_sequence_number(3) is raw_event)
+        copy = raw_event.stamp_sequence_number(5)
+        self.assertFalse(copy is raw_event)
+        self.assertFalse(copy._decoded)
+        copy.append_aggregator_id('agg-2')
+        self.assertEqual(raw_event.sequence_number(), 3)
+        self.assertEqual(copy.sequence_number(), 5)
+        self.assertEqual(self._deserialize_raw(str(raw_event)).aggregator_id,
+                         ['agg-1'])
+        self.assertEqual(self._deserialize_raw(str(copy)).aggregator_id,
+                         ['agg-1', 'agg-2'])
+        event = events.Event('source-id-value', 'text/plain', 'a body',
+                             extra_headers={'X-Header': 'value'})
+        event.stamp_sequence_number(0)
+        copy = event.stamp_sequence_number(1)
+        self.assertEqual(event.sequence_number(), 0)
+        self.assertEqual(copy.sequence_number(), 1)
+        self.assertEqual(copy.get_extra_header('X-Header'), 'value')
+        self.assertEqual(copy.event_id, event.event_id)
+
+    def test_always_parsed_syntax(self):
+        command = events.create_command('source-id-value', 'Test-Connection')
+        evs = ztreamy.Deserializer().deserialize(str(command) + self.data,
+                                                 parse_body=False,
+                                                 complete=True)
+        self.assertTrue(isinstance(evs[0], ztreamy.Command))
+        self.assertTrue(isinstance(evs[1], ztreamy.RawEvent))
+
+    def _deserialize_raw(self, data):
+        deserializer = ztreamy.Deserializer()
+        return deserializer.deserialize(data, parse_body=False,
+                                        complete=True)[0]
+
+
+class TestSerializationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.event = events.JSONEvent('source-id-value',
+                                      ztreamy.json_media_type,
+                                      {'a': 1, 'b': 'blah!'},
+                                      aggregator_id=['agg-1'])
+
+    def test_cache_reuse(self):
+        serialized = self.event._serialize()
+        self.assertTrue(self.event._serialize() is serialized)
+        serialized_json = self.event.serialize_json()
+        self.assertTrue(self.event.serialize_json() is serialized_json)
+        self.assertTrue(self.event._serialize() is serialized)
+
+    def test_invalidation(self):
+        serialized = str(self.event)
+        self.event.source_id = 'another-source-id'
+        self.assertNotEqual(str(self.event), serialized)
+        self.assertTrue('another-source-id' in self.event.serialize_json())
+        serialized = str(self.event)
+        self.event.set_extra_header('X-Header', 'value')
+        self.assertTrue('X-Header: value' in str(self.event))
+        self.assertTrue('X-Header' in self.event.serialize_json())
+        self.event.append_aggregator_id('agg-2')
+        self.assertTrue('Aggregator-Ids: agg-1,agg-2' in str(self.event))
+        self.assertTrue('agg-2' in self.event.serialize_json())
+        self.event.body['c'] = 3
+        self.assertFalse('"c": 3' in self.event.serialize_json())
+        self.event.clear_serialization_cache()
+        self.assertTrue('"c": 3' in self.event.serialize_json())
+
+    def test_serialize_events_json(self):
+        evs = [self.event,
+               events.Event('source-id-value', 'text/plain', 'body')]
+        self.assertEqual(ztreamy.serialize_events_json(evs),
+                         json.dumps([e.as_json() for e in evs]))
+        self.assertEqual(ztreamy.serialize_events_json([]), json.dumps([]))
+
+
+class TestRDFEvent(unittest.TestCase):
+
+    body = ('@prefix ex: <http://example.com/> .\n'
+            'ex:sensor ex:value "1" .\n')
+
+    def test_lazy_body(self):
+        event = ztreamy.RDFEvent('source-id-value', 'text/n3', self.body)
+        self.assertEqual(event._graph, None)
+        self.assertEqual(event.serialize_body(), self.body)
+        digest = event.body_digest()
+        self.assertNotEqual(digest, None)
+        self.assertEqual(event._graph, None)
+        # Parsed when accessed
+        self.assertEqual(len(event.body), 1)
+        self.assertNotEqual(event._graph, None)
+        self.assertEqual(event.body_digest(), digest)
+
+    def test_touched_body(self):
+        event = ztreamy.RDFEvent('source-id-value', 'text/n3', self.body)
+        serialized = str(event)
+        self.assertTrue(self.body in serialized)
+        # The graph may be modified in place once accessed
+        event.body.add((rdflib.URIRef('http://example.com/sensor'),
+                        rdflib.URIRef('http://example.com/value'),
+                        rdflib.Literal('2')))
+        self.assertEqual(str(event), serialized)
+        event.clear_serialization_cache()
+        self.assertEqual(event.body_digest(), None)
+        self.assertTrue('"2"' in event.serialize_body())
+        # A new text body is parsed lazily again
+        event.body = self.body
+        self.assertEqual(event._graph, None)
+        self.assertEqual(event.serialize_body(), self.body)
+
+    def test_deserialized(self):
+        original = ztreamy.RDFEvent('source-id-value', 'text/n3', self.body)
+        data = str(original)
+        event = ztreamy.Deserializer().deserialize(data, complete=True)[0]
+        self.assertTrue(isinstance(event, ztreamy.RDFEvent))
+        self.assertEqual(str(event), data)
+        self.assertEqual(event._graph, None)
+        # Syntax errors are reported when the body is accessed
+        event.body = 'ex:a ex:b'
+        with self.assertRaises(ztreamy.ZtreamyException):
+            event.body
+        event.body = '<a> <b> @@@ !!'
+        with self.assertRaises(ztreamy.ZtreamyException):
+            event.check_body()
+
+
+class _PositionalEvent(events.Event):
+    """Subclass that does not forward keyword arguments."""
+    def __init__(self, source_id, syntax, body, event_id=None):
+        super(_PositionalEvent, self).__init__(source_id, syntax, body,
+                                               event_id=event_id)
+
+
+class TestEventLayout(unittest.TestCase):
+
+    def test_slots(self):
+        event = events.Event('source-id-value', 'text/plain', 'body',
+                             aggregator_id=None)
+        self.assertEqual(event.aggregator_id, [])
+        self.assertEqual(event.__dict__, {})
+        self.assertTrue(event._extra_headers is None)
+        self.assertFalse('X-' in str(event))
+        event.extra_headers['X-Header'] = 'value'
+        event.clear_serialization_cache()
+        self.assertTrue('X-Header: value' in str(event))
+        # Applications can still attach their own attributes
+        event.sequence_num = 3
+        self.assertEqual(event.__dict__, {'sequence_num': 3})
+
+    def test_trusted_constructor(self):
+        extra_headers = {'X-Header': 'value'}
+        event = events.Event._create_trusted('source-id-value',
+                                             ztreamy.json_media_type,
+                                             '{"a": 1}',
+                                             aggregator_id=['agg-1'],
+                                             extra_headers=extra_headers)
+        self.assertTrue(isinstance(event, events.JSONEvent))
+        self.assertEqual(event.body, {'a': 1})
+        self.assertTrue(event.extra_headers is extra_headers)
+        self.assertEqual(event.aggregator_id, ['agg-1'])
+        self.assertTrue(event.timestamp is not None)
+        # Validation still applies to later modifications
+        self.assertRaises(ValueError, setattr, event, 'source_id', 3)
+
+    def test_trusted_constructor_positional_subclass(self):
+        events.Event.register_syntax('x-positional', _PositionalEvent)
+        try:
+            event = events.Event._create_trusted('source-id-value',
+                                                 'x-positional', 'body',
+                                                 event_id='event-id-value')
+            self.assertTrue(isinstance(event, _PositionalEvent))
+            self.assertEqual(event.event_id, 'event-id-value')
+        finally:
+            del events.Event._subclasses['x-positional']
+            events.Event._trusted_syntaxes.discard('x-positional')
+
+    def test_json_deserializer_validation(self):
+        deserializer = events.JSONDeserializer()
+        data = {'Event-Id': 'event-id-value', 'Source-Id': 'source-id-value',
+                'Syntax': 'text/plain', 'Body': 'body'}
+        for header, value in (('X-Header', 3),
+                              ('Event-Type', ['type']),
+                              ('Aggregator-Ids', ['agg-1', 2])):
+            wrong = dict(data)
+            wrong[header] = value
+            self.assertRaises(ztreamy.ZtreamyException,
+                              deserializer.deserialize, json.dumps(wrong))
+        event = deserializer.deserialize(json.dumps(data))[0]
+        self.assertEqual(event.body, 'body')
+
+    def test_random_id(self):
+        import uuid
+        ids = set(ztreamy.random_id() for _ in range(100))
+        self.assertEqual(len(ids), 100)
+        for id_ in ids:
+            value = uuid.UUID(id_)
+            self.assertEqual(value.version, 4)
+            self.assertEqual(value.variant, uuid.RFC_4122)
+            self.assertEqual(str(value), id_)
@@ -19,9 +19,11 @@
 
 import unittest
 import itertools
+import re
 
 import ztreamy.events as events
 import ztreamy.filters as filters
+from ztreamy.rdfevents import RDFEvent
 
 class TestEventTypeFilter(unittest.TestCase):
 
@@ -83,6 +85,217 @@ class TestEventTypeFilter(unittest.TestCase):
         self.assertEqual(id(callback.events[4]), id(test_events[6]))
 
 
+class TestParseFilter(unittest.TestCase):
+
+    def test_parse_filter(self):
+        filter_ = filters.parse_filter('source: s2, s1,s2')
+        self.assertTrue(isinstance(filter_, filters.SourceFilter))
+        self.assertEqual(filter_.source_ids, set(['s1', 's2']))
+        self.assertEqual(filter_.expression, 'source:s1,s2')
+        filter_ = filters.parse_filter('application:AppA')
+        self.assertEqual(filter_.application_ids, set(['AppA']))
+        filter_ = filters.parse_filter('event-type:TypeB,TypeA@AppA')
+        self.assertEqual(filter_.expression, 'event-type:TypeA,TypeB@AppA')
+        callback = _FilterCallback()
+        filter_.callback = callback.callback
+        test_events = [
+            events.Event('', 'text/plain', '',
+                         event_type='TypeA', application_id='AppA'),
+            events.Event('', 'text/plain', '',
+                         event_type='TypeA', application_id='AppB'),
+        ]
+        filter_.filter_events(test_events)
+        self.assertEqual(callback.events, test_events[:1])
+        filter_ = filters.parse_filter('triple:<* http://example.com/p *>')
+        self.assertTrue(isinstance(filter_, filters.TripleFilter))
+
+    def test_parse_filter_errors(self):
+        for text in ('source', 'source:', 'unknown:x', 'application:a@b',
+                     'triple:<http://example.com/p>', 'sparql:SELECT'):
+            self.assertRaises(ValueError, filters.parse_filter, text)
+
+
+class TestFilterRouter(unittest.TestCase):
+
+    def test_router(self):
+        test_events = [
+            events.Event('s1', 'text/plain', '',
+                         event_type='TypeA', application_id='AppA'),
+            events.Event('s2', 'text/plain', '',
+                         event_type='TypeB', application_id='AppA'),
+            events.Event('s3', 'text/plain', '',
+                         event_type='TypeA', application_id='AppB'),
+            events.Event('s1', 'text/plain', '',
+                         event_type='TypeC', application_id='AppC'),
+        ]
+        callbacks = [_FilterCallback() for _ in range(7)]
+        filters_ = [
+            filters.SourceFilter(callbacks[0].callback, source_ids=['s1']),
+            filters.SourceFilter(callbacks[1].callback,
+                                 source_ids=['s1', 's3']),
+            filters.ApplicationFilter(callbacks[2].callback,
+                                      application_id='AppA'),
+            filters.EventTypeFilter(callbacks[3].callback, ['TypeA']),
+            filters.EventTypeFilter(callbacks[4].callback,
+                                    ['TypeA', 'TypeB'],
+                                    application_ids=['AppA']),
+            _SourceSubclassFilter(callbacks[5].callback, source_id='s2'),
+            filters.Filter(callbacks[6].callback),
+        ]
+        all_callback = _FilterCallback()
+        router = filters.FilterRouter(all_callback.callback, filters_)
+        self.assertEqual(len(router), 7)
+        router.filter_events(test_events)
+        selected = [[0, 3], [0, 2, 3], [0, 1], [0, 2], [0, 1], [1], []]
+        for callback, indices in zip(callbacks, selected):
+            self.assertEqual(callback.events,
+                             [test_events[i] for i in indices])
+        self.assertEqual(all_callback.events, test_events)
+        # Without some of the filters
+        for filter_ in filters_[:2] + filters_[3:4] + filters_[5:]:
+            router.remove_filter(filter_)
+        self.assertEqual(len(router), 2)
+        self.assertTrue(filters_[5].callback.__self__ is callbacks[5])
+        all_callback.events = []
+        router.filter_events(test_events)
+        self.assertEqual(all_callback.events, test_events[:2])
+
+
+class TestTripleFilter(unittest.TestCase):
+
+    def setUp(self):
+        bodies = [
+            """@prefix e: <http://example.com/> .
+               e:me e:liveAt e:here ; e:hasName "Paul" .
+               e:here e:locatedIn e:France .""",
+            """@prefix e: <http://example.com/> .
+               e:me e:liveAt e:there ; e:hasName "Maria" .
+               e:there e:locatedIn e:Spain .""",
+            """@prefix e: <http://example.com/> .
+               e:you e:liveAt e:here ; e:knows e:you .
+               e:here e:locatedIn e:France .""",
+        ]
+        self.events = [RDFEvent('source', 'text/n3', body)
+                       for body in bodies]
+        self.events.append(RDFEvent('source', 'text/n3', bodies[0]))
+
+    def test_compiled_evaluation(self):
+        expressions = [
+            '<http://example.com/me http://example.com/liveAt *>',
+            '< * http://example.com/liveAt http://example.com/here>',
+            '<http://example.com/me http://example.com/liveAt ?place>'
+            ' AND <?place http://example.com/locatedIn'
+            ' http://example.com/France>',
+            '<http://example.com/me http://example.com/liveAt ?place>'
+            ' AND (<?place http://example.com/locatedIn'
+            ' http://example.com/Spain> OR <* http://example.com/hasName'
+            ' "Paul">)',
+            '<?x http://example.com/knows ?x>',
+            '<?x http://example.com/liveAt ?x>',
+            '<* * "Maria">',
+        ]
+        for expression in expressions:
+            compiled = _FilterCallback()
+            sparql = _FilterCallback()
+            filters.TripleFilter(compiled.callback,
+                                 expression).filter_events(self.events)
+            filters.SPARQLFilter(sparql.callback,
+                                 filters._triple_filter_to_sparql( \
+                                            expression)).filter_events( \
+                                                                self.events)
+            self.assertEqual(compiled.events, sparql.events, expression)
+        self.assertEqual(len(compiled.events), 1)
+
+    def test_result_cache(self):
+        callback = _FilterCallback()
+        filter_ = filters.TripleFilter(callback.callback,
+                    '<http://example.com/me http://example.com/hasName *>')
+        evaluated = []
+        evaluate = filter_._evaluate
+        filter_._evaluate = lambda graph: evaluated.append(graph) \
+                                              or evaluate(graph)
+        filter_.filter_events(self.events)
+        self.assertEqual(callback.events, self.events[0:2] + self.events[3:])
+        self.assertEqual(len(evaluated), 3)
+        # Bodies given as a graph are always evaluated
+        event = RDFEvent('source', 'text/n3', self.events[0].body)
+        self.assertEqual(event.body_digest(), None)
+        filter_.filter_event(event)
+        self.assertEqual(len(evaluated), 4)
+        self.assertEqual(callback.events[-1], event)
+
+
+class TestVocabularyFilter(unittest.TestCase):
+
+    def test_prefix_regex(self):
+        prefixes = ['http://example.com/a', 'http://example.com/ab',
+                    'http://example.com/b#', 'http://xmlns.com/foaf/0.1/',
+                    'urn:x']
+        regex = re.compile(filters._prefix_regex(prefixes))
+        uris = ['http://example.com/', 'http://example.com/abc',
+                'http://example.com/b', 'http://example.com/b#c',
+                'http://xmlns.com/foaf/0.1/name', 'urn:y', 'urn:x',
+                'http://example.com/a']
+        for uri in uris:
+            self.assertEqual(regex.match(uri) is not None,
+                             any(uri.startswith(p) for p in prefixes), uri)
+        self.assertEqual(re.match(filters._prefix_regex([]), 'x'), None)
+
+    def test_parsed_and_raw_bodies(self):
+        bodies = [
+            """@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+               <http://example.com/me> foaf:name "Paul" .""",
+            """<http://example.com/me> <http://example.com/v#name> "Paul" .""",
+            """<http://example.com/me> <http://example.com/w#name>
+               "http://example.com/v#x" .""",
+        ]
+        data = ''.join(str(RDFEvent('source', 'text/n3', body))
+                       for body in bodies)
+        for parse_body, expected in ((True, [0, 1]), (False, [0, 1, 2])):
+            evs = events.Deserializer().deserialize(data,
+                                                    parse_body=parse_body,
+                                                    complete=True)
+            callback = _FilterCallback()
+            filter_ = filters.VocabularyFilter(callback.callback,
+                                               ['http://xmlns.com/foaf/',
+                                                'http://example.com/v#'])
+            filter_.filter_events(evs)
+            self.assertEqual(callback.events, [evs[i] for i in expected])
+
+    def test_prefixed_names(self):
+        # The prefix is longer than the namespace of the terms
+        bodies = [
+            """@prefix ex: <http://example.com/voc/> .
+               ex:sensor ex:temperature "21" .""",
+            """@prefix ex: <http://example.com/voc/> .
+               ex:sensor ex:humidity "40" .""",
+            """{"@context": {"ex": "http://example.com/voc/"},
+                "@id": "ex:sensor", "ex:temperature": "21"}""",
+            """@prefix ex: <http://example.com/voc/> .
+               ex:sensor ex:temperature "21""",
+        ]
+        syntaxes = ['text/n3', 'text/n3', 'application/ld+json', 'text/n3']
+        data = ''.join(str(events.Event('source', syntax, body))
+                       for syntax, body in zip(syntaxes, bodies))
+        for parse_body in (True, False):
+            evs = events.Deserializer().deserialize(data,
+                                                    parse_body=parse_body,
+                                                    complete=True)
+            callback = _FilterCallback()
+            filter_ = filters.VocabularyFilter(callback.callback,
+                                               'http://example.com/voc/temp')
+            filter_.filter_events(evs[:3] if parse_body else evs)
+            self.assertEqual(callback.events, [evs[0], evs[2]])
+
+
+
+class _SourceSubclassFilter(filters.SourceFilter):
+    # Not indexed by the router because of being a subclass
+    def filter_event(self, event):
+        if event.source_id in self.source_ids:
+            self.callback(event)
+
+
 class _FilterCallback(object):
     def __init__(self):
         self.events = []
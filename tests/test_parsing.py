@@ -0,0 +1,207 @@
+# ztreamy: a framework for publishing semantic events on the Web
+# Copyright (C) 2011-2015 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+import unittest
+import os
+import socket
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.httpclient
+
+import ztreamy
+from ztreamy import events
+from ztreamy.rdfevents import RDFEvent
+from ztreamy import parsing
+from ztreamy.parsing import ParserPool, ParseQueue
+from ztreamy.server import StreamServer, Stream
+
+
+_body = ('@prefix ex: <http://example.com/> .\n'
+         'ex:sensor{0} ex:value "{0}" .\n')
+
+
+class TestParserPool(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.pool = ParserPool(processes=2, ioloop=self.ioloop)
+        self.events = [events.Event.create('source-id-value', 'text/n3',
+                                           _body.format(i))
+                       for i in range(10)]
+        self.events.insert(3, events.Event('source-id-value', 'text/plain',
+                                           'Not RDF'))
+
+    def tearDown(self):
+        self.pool.close()
+        self.ioloop.close(all_fds=True)
+
+    def test_parse_events(self):
+        data = ztreamy.serialize_events(self.events)
+        deserializer = events.Deserializer()
+        queue = ParseQueue(self.pool)
+
+        @tornado.gen.coroutine
+        def run():
+            batches = [deserializer.deserialize(data, parse_body=False,
+                                                complete=True)
+                       for _ in range(3)]
+            futures = [queue.parse_events(evs) for evs in batches]
+            results = []
+            for future in futures:
+                results.append((yield future))
+            raise tornado.gen.Return(results)
+
+        results = self.ioloop.run_sync(run, timeout=30)
+        local = events.Deserializer().deserialize(data, complete=True)
+        self.assertEqual(len(results), 3)
+        for evs in results:
+            self.assertEqual([e.event_id for e in evs],
+                             [e.event_id for e in self.events])
+            for parsed, original in zip(evs, self.events):
+                self.assertEqual(isinstance(parsed, RDFEvent),
+                                 isinstance(original, RDFEvent))
+                self.assertEqual(parsed.source_id, original.source_id)
+                self.assertEqual(parsed.timestamp, original.timestamp)
+            self.assertEqual(len(evs[0].body), 1)
+            self.assertEqual(evs[0].body_digest(), local[0].body_digest())
+            self.assertEqual(str(evs[5]), str(local[5]))
+
+    def test_parse_error(self):
+        bad = events.Event('source-id-value', 'text/n3', 'ex:a ex:b')
+        data = ztreamy.serialize_events(self.events + [bad])
+        evs = events.Deserializer().deserialize(data, parse_body=False,
+                                                complete=True)
+        with self.assertRaises(ztreamy.ZtreamyException):
+            self.ioloop.run_sync(lambda: self.pool.parse_events(evs),
+                                 timeout=30)
+
+
+    def test_pool_failure(self):
+        evs = [events.Event('source-id-value', 'text/n3', _body.format(0))]
+        original = parsing._parse_bodies
+        # The workers of the pool inherit the replaced function
+        for function in (_raise_error, _exit_process):
+            function.__module__ = original.__module__
+            function.__name__ = original.__name__
+            parsing._parse_bodies = function
+            pool = ParserPool(processes=1, ioloop=self.ioloop, timeout=1)
+            try:
+                with self.assertRaises(ztreamy.ZtreamyException):
+                    self.ioloop.run_sync(lambda: pool.parse_events(evs),
+                                         timeout=10)
+            finally:
+                parsing._parse_bodies = original
+                pool.close()
+
+
+class TestParsedPublish(unittest.TestCase):
+
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.pool = ParserPool(processes=2, ioloop=self.ioloop)
+        self.server = StreamServer(self.port, ioloop=self.ioloop)
+        self.stream = Stream('/test', allow_publish=True,
+                             parser_pool=self.pool, ioloop=self.ioloop)
+        self.server.add_stream(self.stream)
+        self.received = []
+        self.stream.create_local_client(self.received.append)
+
+    def tearDown(self):
+        self.server.stop()
+        self.pool.close()
+        self.ioloop.close(all_fds=True)
+
+    def test_publish(self):
+        url = 'http://127.0.0.1:{}/test/publish'.format(self.port)
+        batches = [[events.Event('source-id-value', 'text/n3',
+                                 _body.format(10 * i + j))
+                    for j in range(5)]
+                   for i in range(4)]
+        self.server.start(loop=False)
+
+        @tornado.gen.coroutine
+        def run():
+            client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+            headers = {'Content-Type': ztreamy.event_media_type}
+            yield [client.fetch(url, method='POST', headers=headers,
+                                body=ztreamy.serialize_events(evs))
+                   for evs in batches]
+            response = yield client.fetch(url, method='POST',
+                                          headers=headers,
+                                          body=str(events.Event( \
+                                                'source-id-value',
+                                                'text/n3', 'ex:a ex:b')),
+                                          raise_error=False)
+            self.assertEqual(response.code, 400)
+            client.close()
+            deadline = time.time() + 5
+            while len(self.received) < 20 and time.time() < deadline:
+                yield tornado.gen.sleep(0.05)
+
+        self.ioloop.run_sync(run, timeout=30)
+        # The requests are concurrent, but each batch stays in order
+        ids = [e.event_id for e in self.received]
+        self.assertEqual(sorted(ids[i:i + 5] for i in range(0, 20, 5)),
+                         sorted([e.event_id for e in evs] for evs in batches))
+        self.assertTrue(all(isinstance(e, RDFEvent) for e in self.received))
+
+    def test_publish_stream_error(self):
+        # The parse error of the last batch is known before the
+        # request finishes
+        url = 'http://127.0.0.1:{}/test/publish-stream'.format(self.port)
+        self.stream.parse_queue = _FailingQueue()
+        evs = [events.Event('source-id-value', 'text/plain', 'Text')]
+        self.server.start(loop=False)
+
+        @tornado.gen.coroutine
+        def run():
+            client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+            headers = {'Content-Type': ztreamy.event_media_type}
+            response = yield client.fetch(url, method='POST',
+                                          headers=headers,
+                                          body=ztreamy.serialize_events(evs),
+                                          raise_error=False)
+            self.assertEqual(response.code, 400)
+            client.close()
+
+        self.ioloop.run_sync(run, timeout=30)
+        self.assertEqual(self.received, [])
+
+
+class _FailingQueue(object):
+    # Fails the batches in the next iteration of the IOLoop
+    def parse_events(self, evs):
+        future = tornado.concurrent.Future()
+        tornado.ioloop.IOLoop.current().add_callback( \
+                        future.set_exception,
+                        ztreamy.ZtreamyException('Bad body',
+                                                 'event_deserialize'))
+        return future
+
+
+def _raise_error(jobs):
+    raise ValueError('Parser error')
+
+def _exit_process(jobs):
+    os._exit(1)
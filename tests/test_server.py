@@ -17,10 +17,35 @@
 #
 
 import unittest
+import inspect
+import json
+import socket
+import time
+import zlib
+import shutil
+import tempfile
+import threading
 
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.httpclient
+import tornado.iostream
+import tornado.simple_httpclient
+import tornado.websocket
 from tornado.web import HTTPError
 
-from ztreamy.server import _GenericHandler, _RecentEventsBuffer
+import ztreamy
+import ztreamy.server
+from ztreamy import dispatchers
+from ztreamy import events
+from ztreamy import filters
+from ztreamy import logger
+from ztreamy.dispatchers import ClientProperties, ClientPropertiesFactory
+from ztreamy.parsing import ParserPool
+from ztreamy.server import (_GenericHandler, _RecentEventsBuffer,
+                            _AdaptiveBuffering, StreamServer, Stream,
+                            RelayStream)
 
 class TestServer(unittest.TestCase):
 
@@ -65,7 +90,7 @@ class TestEventBuffer(unittest.TestCase):
                        for i in range(100)]
 
     def test_buffer_complete_no_overflow(self):
-        buf = _RecentEventsBufferStrict(8)
+        buf = _RecentEventsBuffer(8)
         buf.append_event(self.events[0])
         buf.append_events(self.events[1:6])
         buf.append_event(self.events[6])
@@ -75,7 +100,7 @@ class TestEventBuffer(unittest.TestCase):
         self.assertEqual(len(buf.events), 7)
 
     def test_buffer_complete_overflow(self):
-        buf = _RecentEventsBufferStrict(8)
+        buf = _RecentEventsBuffer(8)
         buf.append_event(self.events[0])
         buf.append_events(self.events[1:6])
         buf.append_event(self.events[6])
@@ -86,7 +111,7 @@ class TestEventBuffer(unittest.TestCase):
         self.assertEqual(len(buf.events), 8)
 
     def test_buffer_complete_overflow_limit(self):
-        buf = _RecentEventsBufferStrict(8)
+        buf = _RecentEventsBuffer(8)
         buf.append_event(self.events[0])
         buf.append_events(self.events[1:6])
         buf.append_event(self.events[6])
@@ -97,7 +122,7 @@ class TestEventBuffer(unittest.TestCase):
         self.assertEqual(len(buf.events), 8)
 
     def test_buffer_incomplete_overflow_limit(self):
-        buf = _RecentEventsBufferStrict(8)
+        buf = _RecentEventsBuffer(8)
         buf.append_event(self.events[0])
         buf.append_events(self.events[1:6])
         buf.append_event(self.events[6])
@@ -108,7 +133,7 @@ class TestEventBuffer(unittest.TestCase):
         self.assertEqual(len(buf.events), 8)
 
     def test_buffer_full_overflow(self):
-        buf = _RecentEventsBufferStrict(8)
+        buf = _RecentEventsBuffer(8)
         buf.append_events(self.events[0:6])
         buf.append_events(self.events[6:32])
         data, complete = buf.newer_than('xxxx-xxxx-xx29')
@@ -117,7 +142,7 @@ class TestEventBuffer(unittest.TestCase):
         self.assertEqual(len(buf.events), 8)
 
     def test_buffer_many_removals(self):
-        buf = _RecentEventsBufferStrict(8)
+        buf = _RecentEventsBuffer(8)
         buf.append_events(self.events[0:6])
         buf.append_events(self.events[6:12])
         buf.append_events(self.events[12:17])
@@ -135,7 +160,7 @@ class TestEventBuffer(unittest.TestCase):
         self.assertEqual(len(buf.events), 8)
 
     def test_buffer_most_recent(self):
-        buf = _RecentEventsBufferStrict(8)
+        buf = _RecentEventsBuffer(8)
         buf.append_events(self.events[0:6])
         self.assertEqual(buf.most_recent(3), self.events[3:6])
         buf.append_events(self.events[6:10])
@@ -144,6 +169,1121 @@ class TestEventBuffer(unittest.TestCase):
         self.assertEqual(buf.most_recent(8), self.events[8:16])
         self.assertEqual(buf.most_recent(9), self.events[8:16])
 
+    def test_buffer_lookup(self):
+        buf = _RecentEventsBuffer(8)
+        buf.append_events(self.events[0:12])
+        self.assertEqual(buf.get_event('xxxx-xxxx-xx05'), self.events[5])
+        self.assertEqual(buf.get_event('xxxx-xxxx-xx03'), None)
+        self.assertEqual(buf.get_by_sequence(11), self.events[11])
+        self.assertEqual(buf.get_by_sequence(3), None)
+        self.assertEqual(buf.get_by_sequence(12), None)
+        view = buf.most_recent(6)
+        self.assertEqual(view[0], self.events[6])
+        self.assertEqual(view[-1], self.events[11])
+        self.assertEqual(view[1:-1], self.events[7:11])
+        self.assertEqual(list(reversed(view)), self.events[11:5:-1])
+        self.assertRaises(IndexError, view.__getitem__, 6)
+
+    def test_buffer_from_sequence(self):
+        buf = _RecentEventsBuffer(8)
+        buf.append_events(self.events[0:12])
+        view, complete = buf.from_sequence(7)
+        self.assertEqual(view, self.events[7:12])
+        self.assertTrue(complete)
+        view, complete = buf.from_sequence(12)
+        self.assertEqual(len(view), 0)
+        self.assertTrue(complete)
+        view, complete = buf.from_sequence(7, limit=3)
+        self.assertEqual(view, self.events[9:12])
+        self.assertFalse(complete)
+        # Evicted events are not replaced by older ones
+        view, complete = buf.from_sequence(2)
+        self.assertEqual(view, self.events[4:12])
+        self.assertFalse(complete)
+        # The stream was restarted
+        view, complete = buf.from_sequence(20)
+        self.assertEqual(view, self.events[4:12])
+        self.assertFalse(complete)
+        # Numbered events still buffered by the stream
+        view, complete = buf.from_sequence(14, next_sequence=15)
+        self.assertEqual(len(view), 0)
+        self.assertTrue(complete)
+        view, complete = buf.from_sequence(16, next_sequence=15)
+        self.assertEqual(view, self.events[4:12])
+        self.assertFalse(complete)
+
+    def test_buffer_max_bytes(self):
+        buf = _RecentEventsBuffer(8, max_bytes=40)
+        buf.append_events(self.events[0:2])
+        self.assertEqual(buf.stats()['bytes'], 28)
+        buf.append_events(self.events[2:5])
+        self.assertEqual(buf.most_recent(8), self.events[3:5])
+        self.assertEqual(len(buf.events), 2)
+        stats = buf.stats()
+        self.assertEqual(stats['events'], 2)
+        self.assertEqual(stats['bytes'], 28)
+        self.assertEqual(stats['evicted_by_bytes'], 3)
+        buf.append_event(_MockEvent('x' * 50))
+        self.assertEqual(len(buf), 1)
+
+    def test_buffer_max_age(self):
+        buf = _RecentEventsBuffer(8, max_age=60)
+        buf.append_events(self.events[0:3])
+        buf.times[:2] = [time.time() - 100] * 2
+        data, complete = buf.newer_than('xxxx-xxxx-xx00')
+        self.assertFalse(complete)
+        self.assertEqual(data, self.events[2:3])
+        self.assertEqual(buf.stats()['evicted_by_age'], 2)
+
+    def test_buffer_duplicate_ids(self):
+        buf = _RecentEventsBuffer(4)
+        buf.append_events(self.events[0:3])
+        buf.append_events(self.events[0:2])
+        data, complete = buf.newer_than('xxxx-xxxx-xx00')
+        self.assertTrue(complete)
+        self.assertEqual(data, self.events[1:2])
+        self.assertEqual(len(buf.events), 3)
+
+    def test_serialize_most_recent(self):
+        source_id = ztreamy.random_id()
+        evs = [events.Event(source_id, 'text/plain', 'Event {}'.format(i))
+               for i in range(40)]
+        buf = _RecentEventsBuffer(16)
+        buf.segment_size = 4
+        decoders = {
+            ClientProperties.ENCODING_PLAIN: lambda data: data,
+            ClientProperties.ENCODING_ZLIB: \
+                lambda data: zlib.decompressobj().decompress(data),
+            ClientProperties.ENCODING_GZIP: \
+                lambda data: zlib.decompress(data, 16 + zlib.MAX_WBITS),
+        }
+        for end in (3, 9, 21, 40):
+            buf.append_events(evs[buf.num_events:end])
+            for serialization in (ztreamy.SERIALIZATION_ZTREAMY,
+                                  ztreamy.SERIALIZATION_LDJSON,
+                                  ztreamy.SERIALIZATION_JSON):
+                for num_events in (0, 1, 4, 7, 13, 16, 20):
+                    expected = ztreamy.serialize_events( \
+                                    buf.most_recent(num_events),
+                                    serialization=serialization)
+                    for encoding, decode in decoders.items():
+                        data = buf.serialize_most_recent(num_events,
+                                                         serialization,
+                                                         encoding)
+                        self.assertEqual(decode(data), expected)
+        # Only the segments still in the buffer are kept
+        self.assertEqual(sorted(set(key[1] for key in buf.segments)),
+                         [7, 8, 9])
+
+
+class TestMultiProcessServer(unittest.TestCase):
+
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.server = StreamServer(self.port, ioloop=self.ioloop,
+                                   num_processes=2)
+        self.stream = Stream('/test', allow_publish=True, ioloop=self.ioloop)
+        self.server.add_stream(self.stream)
+        self.received = []
+        self.stream.create_local_client(self.received.append)
+
+    def tearDown(self):
+        self.server.stop()
+        self.ioloop.close(all_fds=True)
+
+    def test_fanout(self):
+        url = 'http://127.0.0.1:{}/test'.format(self.port)
+        master_event = events.Event('source-id-value', 'text/plain',
+                                    'from the master')
+        worker_event = events.Event('source-id-value', 'text/plain',
+                                    'from a worker')
+        event_ids = set([master_event.event_id, worker_event.event_id])
+        self.server.start(loop=False)
+        self.stream.dispatch_event(master_event)
+
+        @tornado.gen.coroutine
+        def run():
+            client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+            yield client.fetch(url + '/publish', method='POST',
+                               body=str(worker_event),
+                               headers={'Content-Type':
+                                        ztreamy.event_media_type})
+            # Any worker must eventually have both events
+            ids = []
+            for _ in range(6):
+                deadline = time.time() + 5
+                while time.time() < deadline:
+                    response = yield client.fetch(url + '/long-polling'
+                                                  '?past-events-limit=10'
+                                                  '&non-blocking=1')
+                    evs = events.Deserializer().deserialize(response.body,
+                                                            complete=True)
+                    ids = set(e.event_id for e in evs)
+                    if ids == event_ids:
+                        break
+                    yield tornado.gen.sleep(0.05)
+                self.assertEqual(ids, event_ids)
+            # Local clients receive events only in the master
+            while len(self.received) < 2 and time.time() < deadline:
+                yield tornado.gen.sleep(0.05)
+            client.close()
+
+        self.ioloop.run_sync(run, timeout=30)
+        self.assertEqual(set(e.event_id for e in self.received), event_ids)
+        self.assertEqual(len(self.received), 2)
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.path = tempfile.mkdtemp()
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.server = StreamServer(self.port, ioloop=self.ioloop)
+        self.stream = Stream('/test', event_log_dir=self.path,
+                             ioloop=self.ioloop)
+        self.server.add_stream(self.stream)
+        base_time = time.time() - 3600
+        self.events = [events.Event('source-id-value', 'text/plain',
+                                    'Event {}'.format(i),
+                                    timestamp=ztreamy.get_timestamp( \
+                                                    base_time + 60 * i))
+                       for i in range(50)]
+
+    def tearDown(self):
+        self.server.stop()
+        self.ioloop.close(all_fds=True)
+        shutil.rmtree(self.path)
+
+    def test_history(self):
+        url = 'http://127.0.0.1:{}/test/history'.format(self.port)
+        log = self.stream.dispatcher.event_log
+        log.index_interval = 200
+        self.server.start(loop=False)
+        self.stream.dispatch_events(self.events)
+
+        @tornado.gen.coroutine
+        def run():
+            deadline = time.time() + 5
+            while (log.segments[-1].num_events < len(self.events)
+                   and time.time() < deadline):
+                yield tornado.gen.sleep(0.05)
+            # libcurl would decode the deflate responses by itself
+            client = tornado.simple_httpclient.SimpleAsyncHTTPClient( \
+                                                        force_instance=True)
+            queries = [
+                ('', 0, 50),
+                ('?from=5&to=12', 5, 12),
+                ('?from=' + self.events[40].event_id, 40, 50),
+                ('?from=' + self.events[20].timestamp
+                 + '&to=' + self.events[30].event_id, 20, 30),
+            ]
+            for query, start, end in queries:
+                for encoding in ('identity', 'deflate'):
+                    response = yield client.fetch(url + query,
+                                    headers={'Accept-Encoding': encoding},
+                                    decompress_response=False)
+                    body = response.body
+                    if encoding == 'deflate':
+                        self.assertEqual( \
+                                    response.headers['Content-Encoding'],
+                                    'deflate')
+                        body = zlib.decompress(body)
+                    self.assertEqual(body, ztreamy.serialize_events( \
+                                                    self.events[start:end]))
+            response = yield client.fetch(url + '?from=xxxx',
+                                          raise_error=False)
+            self.assertEqual(response.code, 404)
+            client.close()
+
+        self.ioloop.run_sync(run, timeout=30)
+
+    def test_lookup_in_thread(self):
+        url = 'http://127.0.0.1:{}/test/history'.format(self.port)
+        log = self.stream.dispatcher.event_log
+        find_event = log.find_event
+        release = threading.Event()
+
+        def slow_find_event(event_id):
+            release.wait(5)
+            return find_event(event_id)
+
+        log.find_event = slow_find_event
+        self.server.start(loop=False)
+        self.stream.dispatch_events(self.events)
+
+        @tornado.gen.coroutine
+        def run():
+            deadline = time.time() + 5
+            while (log.segments[-1].num_events < len(self.events)
+                   and time.time() < deadline):
+                yield tornado.gen.sleep(0.05)
+            client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+            response = client.fetch(url + '?from='
+                                    + self.events[45].event_id)
+            # The IOLoop goes on while the event is being searched for
+            start = time.time()
+            yield tornado.gen.sleep(0.1)
+            self.assertTrue(time.time() - start < 2)
+            self.assertFalse(response.done())
+            release.set()
+            response = yield response
+            self.assertEqual(response.body,
+                             ztreamy.serialize_events(self.events[45:]))
+            client.close()
+
+        self.ioloop.run_sync(run, timeout=30)
+
+    def test_sequence_numbers(self):
+        url = 'http://127.0.0.1:{}/test/long-polling'.format(self.port)
+        self.server.start(loop=False)
+        self.stream.dispatch_events(self.events[:30])
+        self.assertEqual([e.sequence_number() for e in self.events[:30]],
+                         list(range(30)))
+
+        @tornado.gen.coroutine
+        def run():
+            client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+            response = yield client.fetch(url + '?from-seq=25'
+                                          '&non-blocking=1')
+            evs = events.Deserializer().deserialize(response.body,
+                                                    complete=True)
+            self.assertEqual([e.sequence_number() for e in evs],
+                             list(range(25, 30)))
+            response = yield client.fetch(url + '?from-seq=x',
+                                          raise_error=False)
+            self.assertEqual(response.code, 404)
+            client.close()
+
+        self.ioloop.run_sync(run, timeout=30)
+        # The numbering continues after restarting the stream
+        self.stream.dispatcher.close()
+        stream = Stream('/test', event_log_dir=self.path,
+                        ioloop=self.ioloop)
+        stream.dispatch_events(self.events[30:])
+        self.assertEqual(self.events[30].sequence_number(), 30)
+        view, complete = stream.dispatcher.recent_events.from_sequence(28)
+        self.assertEqual(list(view)[2:], self.events[30:])
+        self.assertTrue(complete)
+        stream.dispatcher.close()
+
+
+class TestSequenceNumbers(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.streams = [Stream('/first', ioloop=self.ioloop),
+                        Stream('/second', ioloop=self.ioloop)]
+
+    def tearDown(self):
+        for stream in self.streams:
+            stream.dispatcher.close()
+        self.ioloop.close(all_fds=True)
+
+    def test_chained_streams(self):
+        first, second = self.streams
+        received = []
+        second.dispatch_events([events.Event('source', 'text/plain', 'x')
+                                for _ in range(3)])
+        first.create_local_client(second.dispatch_events,
+                                  separate_events=False)
+        first.create_local_client(received.append)
+        data = ztreamy.serialize_events([events.Event('source', 'text/plain',
+                                                      str(i))
+                                         for i in range(4)])
+        first.dispatch_events(events.Deserializer().deserialize( \
+                                            data, parse_body=False))
+        first.dispatch_events([events.Event('source', 'text/plain', '4')])
+        self._check_sequence(first, 0, 5)
+        self._check_sequence(second, 3, 8)
+        self.assertEqual([e.sequence_number() for e in received],
+                         range(5))
+        # The same event published twice in a stream
+        event = received[0]
+        first.dispatch_event(event)
+        self._check_sequence(first, 0, 6)
+        self.assertEqual(event.sequence_number(), 0)
+        self.assertEqual(second.dispatcher.recent_events \
+                         .get_by_sequence(8).body, '0')
+
+    def _check_sequence(self, stream, first, end):
+        buf = stream.dispatcher.recent_events
+        for seq in range(first, end):
+            event = buf.get_by_sequence(seq)
+            self.assertEqual(event.sequence_number(), seq)
+            self.assertEqual(events.Deserializer().deserialize( \
+                                        str(event))[0].sequence_number(), seq)
+
+
+class TestFilteredClients(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.stream = Stream('/test', ioloop=self.ioloop)
+        self.events = [events.Event('source-id-value', 'text/plain',
+                                    'Event {}'.format(i),
+                                    application_id='app-{}'.format(i % 3))
+                       for i in range(12)]
+
+    def tearDown(self):
+        self.stream.dispatcher.close()
+        self.ioloop.close(all_fds=True)
+
+    def test_shared_filter(self):
+        dispatcher = self.stream.dispatcher
+        plain = ClientPropertiesFactory.create(streaming=True)
+        compressed = ClientPropertiesFactory.create( \
+                                    streaming=True,
+                                    encoding=ClientProperties.ENCODING_ZLIB)
+        clients = []
+        for properties in (plain, plain, compressed):
+            client = _MockClient(properties)
+            dispatcher.register_client(client, filter_=filters.parse_filter( \
+                                                'application:app-1,app-2'))
+            clients.append(client)
+        other = _MockClient(plain)
+        dispatcher.register_client(other,
+                            filter_=filters.parse_filter('application:app-0'))
+        self.assertEqual(len(dispatcher.filter_groups), 2)
+        self.assertEqual(dispatcher.num_clients, 4)
+        self.stream.dispatch_events(self.events[:6])
+        self.stream.dispatch_events(self.events[6:])
+        expected = [e for e in self.events if e.application_id != 'app-0']
+        for client in clients[:2]:
+            self.assertEqual(''.join(client.data),
+                             ztreamy.serialize_events(expected[:4])
+                             + ztreamy.serialize_events(expected[4:]))
+        self.assertEqual(zlib.decompressobj().decompress( \
+                                                ''.join(clients[2].data)),
+                         ztreamy.serialize_events(expected))
+        self.assertEqual(''.join(other.data),
+                         ztreamy.serialize_events(self.events[0:6:3])
+                         + ztreamy.serialize_events(self.events[6:12:3]))
+        # Past events are filtered too
+        client = _MockClient(compressed)
+        dispatcher.register_client(client, from_sequence=3,
+                                   filter_=filters.parse_filter('source:xxx'))
+        self.assertEqual(client.data, [])
+        client = _MockClient(ClientPropertiesFactory.create())
+        dispatcher.register_client(client, from_sequence=3,
+                                   non_blocking=True,
+                                   filter_=filters.parse_filter( \
+                                                    'application:app-0'))
+        self.assertEqual(client.data,
+                         [ztreamy.serialize_events(self.events[3:12:3])])
+
+    def test_filter_passes(self):
+        stream = Stream('/buffered', buffering_time=1000, ioloop=self.ioloop)
+        dispatcher = stream.dispatcher
+        passes = []
+        filter_events = dispatcher.filter_router.filter_events
+
+        def count_pass(evs):
+            passes.append(len(evs))
+            filter_events(evs)
+
+        dispatcher.filter_router.filter_events = count_pass
+        filter_ = filters.parse_filter('application:app-1')
+        client = _MockClient(ClientPropertiesFactory.create(streaming=True))
+        dispatcher.register_client(client, filter_=filter_)
+        stream.dispatch_events(self.events[:6])
+        # No priority clients: the events are filtered when dispatched
+        self.assertEqual(passes, [])
+        stream._dump_buffer()
+        self.assertEqual(passes, [6])
+        priority = _MockClient(ClientPropertiesFactory.create( \
+                                            streaming=True, priority=True))
+        dispatcher.register_client(priority, filter_=filter_)
+        stream.dispatch_events(self.events[6:])
+        self.assertEqual(passes, [6, 6])
+        self.assertEqual(''.join(priority.data),
+                         ztreamy.serialize_events(self.events[7:12:3]))
+        stream._dump_buffer()
+        self.assertEqual(passes, [6, 6, 6])
+        self.assertEqual(''.join(client.data),
+                         ztreamy.serialize_events(self.events[1:6:3])
+                         + ztreamy.serialize_events(self.events[7:12:3]))
+        dispatcher.close()
+
+    def test_filter_parameter(self):
+        url = 'http://127.0.0.1:{}/test/long-polling'
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = url.format(sock.getsockname()[1])
+        server = StreamServer(sock.getsockname()[1], ioloop=self.ioloop)
+        sock.close()
+        server.add_stream(self.stream)
+        server.start(loop=False)
+        self.stream.dispatch_events(self.events)
+
+        @tornado.gen.coroutine
+        def run():
+            client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+            response = yield client.fetch(url + '?filter=application:app-2'
+                                          '&past-events-limit=6'
+                                          '&non-blocking=1')
+            evs = events.Deserializer().deserialize(response.body,
+                                                    complete=True)
+            self.assertEqual([e.event_id for e in evs],
+                             [self.events[8].event_id,
+                              self.events[11].event_id])
+            response = yield client.fetch(url + '?filter=xxx',
+                                          raise_error=False)
+            self.assertEqual(response.code, 400)
+            client.close()
+
+        try:
+            self.ioloop.run_sync(run, timeout=30)
+        finally:
+            server.stop()
+
+
+class TestAdaptiveBuffering(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.events = [events.Event('source-id-value', 'text/plain',
+                                    'Event {}'.format(i))
+                       for i in range(20)]
+        self.ids = [e.event_id for e in self.events]
+        self.client = _MockClient(ClientPropertiesFactory.create( \
+                                                            streaming=True))
+
+    def tearDown(self):
+        self.ioloop.close(all_fds=True)
+
+    def test_period(self):
+        buffering = _AdaptiveBuffering(500, latency_target=200)
+        self.assertEqual(buffering.window(), 0.0)
+        buffering.batch_dispatched(1, 0.002)
+        self.assertAlmostEqual(buffering.period, 0.02)
+        # The period grows with the cost of each dispatch,
+        # up to the latency target
+        for _ in range(10):
+            buffering.batch_dispatched(100, 0.05)
+        self.assertAlmostEqual(buffering.period, 0.15)
+        self.assertAlmostEqual(buffering.window(), 0.15)
+        buffering.latency_target = None
+        buffering.batch_dispatched(100, 0.05)
+        self.assertAlmostEqual(buffering.period, 0.5)
+        # Low rates are not buffered
+        buffering.rate = 1.0
+        self.assertEqual(buffering.window(), 0.0)
+
+    def test_stream(self):
+        stream = self._stream(adaptive_buffering=True, latency_target=100)
+        # Idle streams send events immediately
+        stream.dispatch_events(self.events[:1])
+        self.assertEqual(self._received(), self.ids[:1])
+        self.assertEqual(stream.effective_buffering_time, 0.0)
+        stream._adaptive_buffering.rate = 1000.0
+        stream._adaptive_buffering.period = 0.02
+        self.assertAlmostEqual(stream.effective_buffering_time, 20.0)
+        stream.dispatch_events(self.events[1:5])
+        self.assertEqual(self._received(), self.ids[:1])
+        self.ioloop.run_sync(lambda: tornado.gen.sleep(0.1))
+        self.assertEqual(self._received(), self.ids[:5])
+        # A full buffer is sent without waiting
+        stream._adaptive_buffering.period = 0.02
+        stream.dispatch_events(self.events[5:10])
+        self.assertEqual(self._received(), self.ids[:5])
+        stream.dispatch_events(self.events[10:15])
+        self.assertEqual(self._received(), self.ids[:15])
+        stream.dispatch_events(self.events[15:])
+        stream.stop()
+        self.assertEqual(self._received(), self.ids)
+
+    def test_max_buffered_events(self):
+        stream = self._stream()
+        for i in range(0, 15, 5):
+            stream.dispatch_events(self.events[i:i + 5])
+        self.assertEqual(self._received(), self.ids[:10])
+        stream.stop()
+        self.assertEqual(self._received(), self.ids[:15])
+
+    def _stream(self, **kwargs):
+        stream = Stream('/test', buffering_time=1000, max_buffered_events=10,
+                        ioloop=self.ioloop, **kwargs)
+        stream.dispatcher.register_client(self.client)
+        return stream
+
+    def _received(self):
+        evs = events.Deserializer().deserialize(''.join(self.client.data),
+                                                complete=True)
+        return [e.event_id for e in evs]
+
+
+class TestLazyDispatchers(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.stream = Stream('/test', dispatch_tiers=[50], ioloop=self.ioloop)
+        self.events = [events.Event('source-id-value', 'text/plain',
+                                    'Event {}'.format(i))
+                       for i in range(5)]
+
+    def tearDown(self):
+        self.stream.dispatcher.close()
+        self.ioloop.close(all_fds=True)
+
+    def test_lazy_dispatchers(self):
+        dispatcher = self.stream.dispatcher
+        self.assertEqual(dispatcher.dispatchers, {})
+        compressed = ClientPropertiesFactory.create( \
+                                    streaming=True,
+                                    encoding=ClientProperties.ENCODING_ZLIB)
+        clients = [_MockClient(compressed),
+                   _MockClient(ClientPropertiesFactory.create( \
+                                                streaming=True, tier=50)),
+                   _MockClient(ClientPropertiesFactory.create( \
+                                                streaming=True,
+                                                priority=True))]
+        for client in clients:
+            dispatcher.register_client(client)
+        self.assertEqual(len(dispatcher.dispatchers), 3)
+        self.assertEqual(len(dispatcher.buffered_dispatchers), 1)
+        self.assertEqual(len(dispatcher.immediate_dispatchers), 1)
+        self.stream.dispatch_events(self.events)
+        self.assertEqual(zlib.decompressobj().decompress( \
+                                                ''.join(clients[0].data)),
+                         ztreamy.serialize_events(self.events))
+        # Idle dispatchers are removed, unless a suspended client
+        # is going to subscribe again
+        for client in clients:
+            client.dispatcher.unsubscribe(client)
+        clients[0].suspended = True
+        dispatcher.suspended_clients.add(clients[0])
+        dispatcher._periodic_maintenance()
+        self.assertEqual(dispatcher.dispatchers.keys(), [compressed])
+        self.assertEqual(dispatcher.tiers, {})
+        self.assertEqual(dispatcher.immediate_dispatchers, [])
+        dispatcher.suspended_clients.clear()
+        dispatcher._periodic_maintenance()
+        self.assertEqual(dispatcher.dispatchers, {})
+        self.assertEqual(dispatcher.buffered_dispatchers, [])
+
+    def test_log_events(self):
+        class Events(object):
+            def __iter__(self):
+                raise AssertionError('Events should not be iterated')
+        logger.events_dispatched(Events())
+        logger.events_delivered(Events())
+
+
+class TestDispatchTiers(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.stream = Stream('/test', buffering_time=1000,
+                             dispatch_tiers=[0, 50], ioloop=self.ioloop)
+        self.events = [events.Event('source-id-value', 'text/plain',
+                                    'Event {}'.format(i))
+                       for i in range(10)]
+
+    def tearDown(self):
+        self.stream.dispatcher.close()
+        self.ioloop.close(all_fds=True)
+
+    def test_tiers(self):
+        dispatcher = self.stream.dispatcher
+        clients = {}
+        for tier in (0, 50, None):
+            for encoding in (ClientProperties.ENCODING_PLAIN,
+                             ClientProperties.ENCODING_ZLIB):
+                properties = ClientPropertiesFactory.create( \
+                                        streaming=True,
+                                        serialization=\
+                                            ztreamy.SERIALIZATION_LDJSON,
+                                        encoding=encoding,
+                                        tier=tier)
+                clients[(tier, encoding)] = _MockClient(properties)
+                dispatcher.register_client(clients[(tier, encoding)])
+        # Only the dispatchers of the tiers in use are created
+        self.assertEqual(sorted(dispatcher.tiers), [0, 50])
+        self.assertEqual(len(dispatcher.dispatchers), 6)
+        self.stream.dispatch_events(self.events[:5])
+        self.stream.dispatch_events(self.events[5:])
+        self.assertEqual(self._received(clients, 0), self.events)
+        self.assertEqual(self._received(clients, 50), [])
+        self.ioloop.run_sync(lambda: tornado.gen.sleep(0.1))
+        self.assertEqual(self._received(clients, 50), self.events)
+        self.assertEqual(self._received(clients, None), [])
+        self.assertEqual(clients[(0, ClientProperties.ENCODING_PLAIN)] \
+                                                        .data[0].count('\n'),
+                         5)
+        with self.assertRaises(ValueError):
+            dispatcher.register_client(_MockClient( \
+                            ClientPropertiesFactory.create(streaming=True,
+                                                           tier=20)))
+
+    def test_resume_buffered(self):
+        # Events numbered but still buffered by the stream
+        self.stream.dispatch_events(self.events[:7])
+        self.stream._dump_buffer()
+        self.stream.dispatch_events(self.events[7:])
+        client = _MockClient(ClientPropertiesFactory.create( \
+                                        streaming=True,
+                                        serialization=\
+                                            ztreamy.SERIALIZATION_LDJSON,
+                                        tier=0))
+        self.stream.dispatcher.register_client(client, from_sequence=9)
+        self.assertEqual(client.data, [])
+
+    def test_resume_delayed_tier(self):
+        dispatcher = self.stream.dispatcher
+        properties = ClientPropertiesFactory.create( \
+                                        streaming=True,
+                                        serialization=\
+                                            ztreamy.SERIALIZATION_LDJSON,
+                                        encoding=ClientProperties.ENCODING_ZLIB,
+                                        tier=50)
+        dispatcher.register_client(_MockClient(properties))
+        self.stream.dispatch_events(self.events[:3])
+        self.stream._dump_buffer()
+        self.ioloop.run_sync(lambda: tornado.gen.sleep(0.1))
+        self.stream.dispatch_events(self.events[3:6])
+        self.stream._dump_buffer()
+        # Events 3 to 5 are in the buffer of the tier
+        clients = [_MockClient(properties), _MockClient(properties)]
+        dispatcher.register_client(clients[0], from_sequence=1)
+        dispatcher.register_client(clients[1], from_sequence=4)
+        self.stream.dispatch_events(self.events[6:])
+        self.ioloop.run_sync(lambda: tornado.gen.sleep(0.1))
+        for client, first in zip(clients, (1, 4)):
+            data = zlib.decompressobj().decompress(''.join(client.data))
+            self.assertEqual([int(json.loads(line)['Sequence-Num'])
+                              for line in data.splitlines()],
+                             list(range(first, 10)))
+
+    def test_tier_parameter(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:{}/test/stream'.format(sock.getsockname()[1])
+        server = StreamServer(sock.getsockname()[1], ioloop=self.ioloop)
+        sock.close()
+        server.add_stream(self.stream)
+        server.start(loop=False)
+
+        @tornado.gen.coroutine
+        def run():
+            client = tornado.simple_httpclient.SimpleAsyncHTTPClient( \
+                                                        force_instance=True)
+            for query, headers in (('?tier=20', {}),
+                                   ('?tier=x', {}),
+                                   ('', {ztreamy.tier_header: '20'}),
+                                   ('?tier=50&filter=source:x', {})):
+                response = yield client.fetch(url + query, headers=headers,
+                                              raise_error=False)
+                self.assertEqual(response.code, 400)
+            client.close()
+
+        try:
+            self.ioloop.run_sync(run, timeout=30)
+        finally:
+            server.stop()
+
+    def _received(self, clients, tier):
+        received = []
+        for encoding in (ClientProperties.ENCODING_PLAIN,
+                         ClientProperties.ENCODING_ZLIB):
+            data = ''.join(clients[(tier, encoding)].data)
+            if encoding == ClientProperties.ENCODING_ZLIB:
+                data = zlib.decompressobj().decompress(data)
+            received.append([json.loads(line)['Event-Id']
+                             for line in data.splitlines()])
+        self.assertEqual(received[0], received[1])
+        return [e for e in self.events if e.event_id in received[0]]
+
+
+class TestRelayStream(unittest.TestCase):
+
+    def setUp(self):
+        self.ioloop = tornado.ioloop.IOLoop()
+
+    def tearDown(self):
+        self.ioloop.close(all_fds=True)
+
+    def test_options(self):
+        pool = ParserPool(processes=1, ioloop=self.ioloop)
+        relay = RelayStream('/relay', 'http://127.0.0.1:8888/test/stream',
+                            parse_event_body=True,
+                            parser_pool=pool,
+                            max_client_pending_bytes=1024,
+                            slow_client_policy='skip',
+                            buffering_time=500,
+                            adaptive_buffering=True,
+                            latency_target=0.2,
+                            max_buffered_events=100,
+                            dispatch_tiers=[0, 100],
+                            ioloop=self.ioloop)
+        self.assertTrue(relay.parse_queue.pool is pool)
+        self.assertTrue(relay.client.clients[0]._parse_queue.pool is pool)
+        self.assertEqual(relay.dispatcher.max_client_pending_bytes, 1024)
+        self.assertEqual(relay.dispatcher.slow_client_policy, 'skip')
+        self.assertTrue(relay._adaptive_buffering is not None)
+        self.assertEqual(relay.max_buffered_events, 100)
+        self.assertEqual(relay.dispatcher.dispatch_tiers,
+                         frozenset([0, 100]))
+        relay.dispatcher.close()
+
+
+class TestWebSocket(unittest.TestCase):
+
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.url = 'ws://127.0.0.1:{}/test/websocket'.format( \
+                                                    sock.getsockname()[1])
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.server = StreamServer(sock.getsockname()[1], ioloop=self.ioloop)
+        sock.close()
+        self.stream = Stream('/test', dispatch_tiers=[0],
+                             ioloop=self.ioloop)
+        self.server.add_stream(self.stream)
+        self.server.start(loop=False)
+        self.events = [events.Event('source-id-value', 'text/plain',
+                                    'Event {}'.format(i))
+                       for i in range(30)]
+
+    def tearDown(self):
+        self.server.stop()
+        self.ioloop.close(all_fds=True)
+
+    def test_shared_compression(self):
+        self.stream.dispatch_events(self.events[:10])
+
+        @tornado.gen.coroutine
+        def run():
+            first = yield self._connect('', compression_options={})
+            self.stream.dispatch_events(self.events[10:20])
+            received = yield self._read(first, 10)
+            self.assertEqual(received, self.events[10:20])
+            # A client that resumes the stream later
+            # joins the same compressed stream
+            second = yield self._connect('?from-seq=5',
+                                         compression_options={})
+            received = yield self._read(second, 15)
+            self.assertEqual(received, self.events[5:20])
+            self.stream.dispatch_events(self.events[20:25])
+            self.stream.dispatch_events(self.events[25:])
+            for connection in (first, second):
+                received = yield self._read(connection, 10)
+                self.assertEqual(received, self.events[20:])
+            stats = self.stream.clients_stats()
+            self.assertEqual([c['properties'] for c in stats],
+                             ['streaming-zlib'] * 2)
+            self.assertEqual(len(self.stream.dispatcher.dispatchers), 1)
+            for connection in (first, second):
+                self.assertTrue(connection.protocol._compressor is not None)
+                connection.close()
+            yield tornado.gen.sleep(0.05)
+            self.assertEqual(self.stream.dispatcher.num_clients, 0)
+
+        self.ioloop.run_sync(run, timeout=30)
+
+    def test_tornado_internals(self):
+        # The shared compression depends on them
+        if not ztreamy.server._websocket_shared_compression:
+            self.skipTest('Shared compression is disabled')
+        compressor = tornado.websocket._PerMessageDeflateCompressor( \
+                                                            True, None)
+        self.assertEqual(compressor._max_wbits, zlib.MAX_WBITS)
+        self.assertTrue(compressor._compressor is not None)
+        # The messages are raw deflate data without the sync flush trailer
+        data = ztreamy.serialize_events(self.events[:3])
+        self.assertEqual(compressor.compress(data),
+                         dispatchers.compress_deflate_raw(data)[:-4])
+        protocol = tornado.websocket.WebSocketProtocol13
+        self.assertEqual(protocol.RSV1, 0x40)
+        self.assertTrue('flags' in inspect.getargspec( \
+                                                protocol._write_frame).args)
+
+    def test_fallback(self):
+        self.stream.dispatch_events(self.events[:10])
+        shared_compression = ztreamy.server._websocket_shared_compression
+        ztreamy.server._websocket_shared_compression = False
+
+        @tornado.gen.coroutine
+        def run():
+            connection = yield self._connect('?from-seq=5',
+                                             compression_options={})
+            received = yield self._read(connection, 5)
+            self.assertEqual(received, self.events[5:10])
+            self.stream.dispatch_events(self.events[10:])
+            received = yield self._read(connection, 20)
+            self.assertEqual(received, self.events[10:])
+            self.assertEqual(self.stream.clients_stats()[0]['properties'],
+                             'streaming')
+            # Tornado compresses the messages itself
+            self.assertTrue(connection.protocol._compressor is not None)
+            connection.close()
+
+        try:
+            self.ioloop.run_sync(run, timeout=30)
+        finally:
+            ztreamy.server._websocket_shared_compression = shared_compression
+
+    def test_ldjson(self):
+        last_seen = self.events[3].event_id
+
+        @tornado.gen.coroutine
+        def run():
+            self.stream.dispatch_events(self.events[:5])
+            connection = yield self._connect('?tier=0&last-seen=' + last_seen,
+                                             subprotocol='ldjson')
+            message = yield connection.read_message()
+            self.assertTrue(isinstance(message, unicode))
+            self.assertEqual([json.loads(line)['Event-Id']
+                              for line in message.splitlines()],
+                             [self.events[4].event_id])
+            self.assertEqual(self.stream.clients_stats()[0]['properties'],
+                             'streaming-ldjson-tier0')
+            connection.close()
+
+        self.ioloop.run_sync(run, timeout=30)
+
+    def test_bad_parameters(self):
+
+        @tornado.gen.coroutine
+        def run():
+            for query in ('?tier=50', '?from-seq=x'):
+                try:
+                    yield self._connect(query)
+                except tornado.httpclient.HTTPError as e:
+                    self.assertTrue(e.code in (400, 404))
+                else:
+                    self.fail('Connection accepted with ' + query)
+
+        self.ioloop.run_sync(run, timeout=30)
+
+    def _connect(self, query, subprotocol=None, compression_options=None):
+        headers = {}
+        if subprotocol is not None:
+            headers['Sec-WebSocket-Protocol'] = subprotocol
+        request = tornado.httpclient.HTTPRequest(self.url + query,
+                                                 headers=headers)
+        return tornado.websocket.websocket_connect(request,
+                                io_loop=self.ioloop,
+                                compression_options=compression_options)
+
+    @tornado.gen.coroutine
+    def _read(self, connection, num_events):
+        received = []
+        while len(received) < num_events:
+            message = yield connection.read_message()
+            received.extend(events.Deserializer().deserialize(message,
+                                                              complete=True))
+        raise tornado.gen.Return([self._original(e) for e in received])
+
+    def _original(self, event):
+        for original in self.events:
+            if original.event_id == event.event_id:
+                return original
+
+
+class TestSlowClients(unittest.TestCase):
+
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.ioloop = tornado.ioloop.IOLoop()
+        self.server = StreamServer(self.port, ioloop=self.ioloop)
+        self.body = 'x' * 4096
+
+    def tearDown(self):
+        self.server.stop()
+        self.ioloop.close(all_fds=True)
+
+    def test_close(self):
+        stream = self._stream('close')
+
+        @tornado.gen.coroutine
+        def run():
+            connection = yield self._connect(stream)
+            yield self._publish(stream, lambda: stream.dispatcher.num_clients)
+            self.assertEqual(stream.dispatcher.num_clients, 0)
+            # The data is discarded without sending it
+            data = yield connection.read_until_close()
+            self.assertTrue(len(data) < 8 * 1024 * 1024)
+
+        self.ioloop.run_sync(run, timeout=30)
+
+    def test_skip(self):
+        stream = self._stream('skip')
+
+        @tornado.gen.coroutine
+        def run():
+            connection = yield self._connect(stream)
+            evs = yield self._publish(stream,
+                                      lambda: not stream.dispatcher \
+                                                        .suspended_clients)
+            stats = stream.clients_stats()
+            self.assertEqual(len(stats), 1)
+            self.assertTrue(stats[0]['suspended'])
+            # The connection may have sent part of its data meanwhile
+            self.assertEqual(stats[0]['suspensions'], 1)
+            # Events published meanwhile are skipped
+            evs.extend((yield self._publish(stream, lambda: True, 100)))
+            # The client receives new events after reading its data
+            data = []
+            while stream.dispatcher.suspended_clients:
+                data.append((yield connection.read_bytes(65536,
+                                                         partial=True)))
+            last = events.Event('source-id-value', 'text/plain', 'Last')
+            evs.append(last)
+            stream.dispatch_events([last])
+            while last.event_id not in data[-1]:
+                data.append((yield connection.read_bytes(65536,
+                                                         partial=True)))
+            stats = stream.clients_stats()
+            self.assertEqual(stats[0]['suspensions'], 1)
+            self.assertFalse(stats[0]['suspended'])
+            # Let the server finish the request before closing
+            stream.dispatcher.close()
+            yield tornado.gen.sleep(0.01)
+            connection.close()
+            yield tornado.gen.sleep(0.01)
+            raise tornado.gen.Return((evs, ''.join(data)))
+
+        evs, data = self.ioloop.run_sync(run, timeout=30)
+        received = events.Deserializer().deserialize(_dechunk(data),
+                                                     complete=True)
+        sequence = [e.sequence_number() for e in received]
+        self.assertEqual(sequence[-1], evs[-1].sequence_number())
+        self.assertTrue(len(sequence) < len(evs))
+        self.assertEqual(sequence[:10], list(range(10)))
+
+    def test_demote(self):
+        stream = self._stream('demote', dispatch_tiers=[50, 1000])
+
+        @tornado.gen.coroutine
+        def run():
+            connection = yield self._connect(stream)
+            yield self._publish(stream,
+                                lambda: not stream.dispatcher \
+                                                    .suspended_clients)
+            while stream.dispatcher.suspended_clients:
+                yield connection.read_bytes(65536, partial=True)
+            stats = stream.clients_stats()
+            self.assertEqual(len(stats), 1)
+            self.assertFalse(stats[0]['suspended'])
+            self.assertIn('tier50', stats[0]['properties'])
+            self.assertEqual(list(stream.dispatcher.tiers), [50])
+            stream.dispatcher.close()
+            yield tornado.gen.sleep(0.01)
+            connection.close()
+            yield tornado.gen.sleep(0.01)
+
+        self.ioloop.run_sync(run, timeout=30)
+
+    def test_pending_bytes_without_write_indexes(self):
+        # Streams that do not expose Tornado's private write counters
+        connection_stream = _MockIOStream()
+        handler = _MockHandler(connection_stream)
+        client = ztreamy.server._Client(handler, handler.write, None)
+        client.send('x' * 100)
+        self.assertEqual(client.pending_bytes(), 100)
+        client.send('x' * 50)
+        self.assertEqual(client.pending_bytes(), 150)
+        # Only the data written before the drain was requested counts
+        connection_stream.drain()
+        self.assertEqual(client.pending_bytes(), 50)
+        connection_stream.drain()
+        self.assertEqual(client.pending_bytes(), 0)
+
+    def _stream(self, policy, dispatch_tiers=None):
+        stream = Stream('/test', max_client_pending_bytes=262144,
+                        slow_client_policy=policy,
+                        dispatch_tiers=dispatch_tiers, ioloop=self.ioloop)
+        self.server.add_stream(stream)
+        self.server.start(loop=False)
+        return stream
+
+    @tornado.gen.coroutine
+    def _connect(self, stream):
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        connection = tornado.iostream.IOStream(sock)
+        yield connection.connect(('127.0.0.1', self.port))
+        yield connection.write('GET /test/stream HTTP/1.1\r\n'
+                               'Host: 127.0.0.1\r\n'
+                               'Accept-Encoding: identity\r\n\r\n')
+        while not stream.dispatcher.num_clients:
+            yield tornado.gen.sleep(0.005)
+        raise tornado.gen.Return(connection)
+
+    @tornado.gen.coroutine
+    def _publish(self, stream, condition, limit=10000):
+        # Publishes events until the condition fails, with a limit
+        evs = []
+        while condition() and len(evs) < limit:
+            batch = [events.Event('source-id-value', 'text/plain',
+                                  self.body) for _ in range(10)]
+            stream.dispatch_events(batch)
+            evs.extend(batch)
+            for client in stream.dispatcher.suspended_clients:
+                self.assertTrue(client.pending_bytes() < 262144
+                                + 10 * len(str(batch[0])))
+            yield tornado.gen.moment
+        raise tornado.gen.Return(evs)
+
+
+class _MockIOStream(object):
+    def __init__(self):
+        self.futures = []
+
+    def write(self, data):
+        future = tornado.concurrent.Future()
+        self.futures.append(future)
+        return future
+
+    def closed(self):
+        return False
+
+    def drain(self):
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.set_result(None)
+
+
+class _MockHandler(object):
+    def __init__(self, stream):
+        self.request = _MockObject(connection=_MockObject(stream=stream))
+
+    def write(self, data, flush=True):
+        pass
+
+
+class _MockObject(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class _MockClient(object):
+    def __init__(self, properties):
+        self.properties = properties
+        self.dictionary = None
+        self.closed = False
+        self.is_fresh = True
+        self.data = []
+
+    def send(self, data, flush=True):
+        self.data.append(data)
+        if data:
+            self.is_fresh = False
+
+    def close(self):
+        self.closed = True
+
 
 class _MockEvent(object):
     def __init__(self, event_id):
@@ -153,9 +1293,12 @@ class _MockEvent(object):
         return self.event_id
 
 
-class _RecentEventsBufferStrict(_RecentEventsBuffer):
-    """Force a key error when removing an element not in the dict."""
-    def _remove_from_dict(self, position, num_events):
-        for i in range(position, position + num_events):
-            if self.buffer[i] is not None:
-                del self.events[self.buffer[i].event_id]
+def _dechunk(data):
+    data = data[data.index('\r\n\r\n') + 4:]
+    chunks = []
+    while data:
+        size, data = data.split('\r\n', 1)
+        size = int(size, 16)
+        chunks.append(data[:size])
+        data = data[size + 2:]
+    return ''.join(chunks)
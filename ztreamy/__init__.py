@@ -17,10 +17,10 @@
 #
 """ A framework for publishing semantic events on the Web."""
 
-import uuid
+import os
 import time
+import binascii
 from urlparse import urlparse
-import json
 
 import ztreamy.utils.rfc3339
 
@@ -30,6 +30,25 @@ json_media_type = 'application/json'
 ldjson_media_type = 'application/x-ldjson'
 json_ld_media_type = 'application/ld+json'
 
+# Streams compressed with a preset dictionary (see
+# 'dispatchers.CompressionDictionary') are requested with this token
+# in the Accept-Encoding header. The responses are not labelled with
+# a Content-Encoding, because HTTP libraries reject unknown codings,
+# but with a dictionary header whose value is the path of the
+# dictionary in the server.
+dictionary_encoding = 'x-deflate-dict'
+dictionary_header = 'X-Ztreamy-Dictionary'
+
+# Every stream numbers the events it dispatches, starting at zero,
+# in this extra header. Clients resume a stream from a sequence
+# number with the 'from-seq' parameter.
+sequence_header = 'Sequence-Num'
+
+# Streaming clients select a dispatch tier of the stream, identified
+# by its delay in milliseconds, with the 'tier' parameter or with
+# this header.
+tier_header = 'X-Ztreamy-Tier'
+
 SERIALIZATION_NONE = 0
 SERIALIZATION_ZTREAMY = 1
 SERIALIZATION_JSON = 2
@@ -62,8 +81,18 @@ def random_id():
        The hexadecimal representation of a 128 bit random number is
        returned as a string.
 
+       The id is formatted as a version 4 UUID, but it is built
+       directly from the random bytes, which is several times faster
+       than 'str(uuid.uuid4())'.
+
     """
-    return str(uuid.uuid4())
+    h = binascii.hexlify(os.urandom(16))
+    return '%s-%s-4%s-%s%s-%s' % (h[:8], h[8:12], h[13:16],
+                                  '89ab'[int(h[16], 16) & 3], h[17:20], h[20:])
+
+# Timestamps have a resolution of one second: the formatted timestamp
+# for the current second is cached as [second, timestamp]
+_current_timestamp = [None, None]
 
 def get_timestamp(date=None):
     """Returns a string with 'time' formatted according to :RFC:`3339`.
@@ -75,8 +104,11 @@ def get_timestamp(date=None):
     """
     if date is not None:
         return ztreamy.utils.rfc3339.rfc3339(date)
-    else:
-        return ztreamy.utils.rfc3339.rfc3339(time.time())
+    now = int(time.time())
+    if now != _current_timestamp[0]:
+        _current_timestamp[1] = ztreamy.utils.rfc3339.rfc3339(now)
+        _current_timestamp[0] = now
+    return _current_timestamp[1]
 
 _date_format = "%Y-%m-%dT%H:%M:%S"
 _date_format_alt = "%Y-%m-%d %H:%M:%S"
@@ -121,8 +153,9 @@ def serialize_events(events, serialization=SERIALIZATION_ZTREAMY):
     return ''.join(data)
 
 def serialize_events_json(events):
-    data = [e.as_json() for e in events]
-    return json.dumps(data)
+    # Equivalent to json.dumps() on the list of events,
+    # but it takes advantage of the serialization cache of the events
+    return '[' + ', '.join(e.serialize_json() for e in events) + ']'
 
 def serialize_events_ldjson(events):
     if events:
@@ -149,12 +182,14 @@ def split_url(url):
 # Imports of the main classes of the API provided by the framework,
 # in order to make them available in the "ztreamy" namespace.
 #
-from events import Deserializer, JSONDeserializer, Event, Command, JSONEvent
+from events import (Deserializer, JSONDeserializer, Event, Command, JSONEvent,
+                    RawEvent)
 from rdfevents import RDFEvent
 from filters import (Filter, SourceFilter, ApplicationFilter,
                      SimpleTripleFilter, VocabularyFilter,
-                     SPARQLFilter, TripleFilter)
+                     SPARQLFilter, TripleFilter, FilterRouter)
 from server import StreamServer, Stream, RelayStream
 from client import (Client, AsyncStreamingClient, SynchronousClient,
-                    EventPublisher, SynchronousEventPublisher,
+                    EventPublisher, BatchingEventPublisher,
+                    StreamingEventPublisher, SynchronousEventPublisher,
                     LocalClient, LocalEventPublisher)
@@ -26,13 +26,18 @@ other hand, 'SynchronousClient' implements a synchronous client for
 just one stream.
 
 'EventPublisher' is an asynchronous class that sends events to be
-served in a stream. 'SynchronousEventPublisher' has a similar
-interface, but is synchronous.
+served in a stream. 'BatchingEventPublisher' sends them in batches,
+and 'StreamingEventPublisher' through a long-lived request, for
+sources that publish at high rates. 'SynchronousEventPublisher' has
+a similar interface, but is synchronous.
 
 """
+import tornado.concurrent
+import tornado.gen
 import tornado.ioloop
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 from tornado.curl_httpclient import CurlAsyncHTTPClient
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
 import tornado.options
 import logging
 import sys
@@ -43,15 +48,24 @@ import random
 import os
 import os.path
 import base64
+import urlparse
+import zlib
+import collections
+import functools
 
 import ztreamy
-from ztreamy import Deserializer, Command, Filter
+from ztreamy import Deserializer, Command, Filter, ZtreamyException
 from ztreamy import logger
 from ztreamy import split_url
+from ztreamy import parsing
+from ztreamy.dispatchers import CompressionDictionary
 
 transferred_bytes = 0
 data_count = 0
 
+# Compression dictionaries already retrieved, by URL
+_dictionaries = {}
+
 #AsyncHTTPClient.configure("tornado.simple_httpclient.SimpleAsyncHTTPClient")
 AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
 
@@ -76,6 +90,17 @@ def configure_max_clients(max_clients):
     AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient",
                               max_clients=max_clients)
 
+def _reconnection_delay(connection_attempts):
+    # Random delay, exponentially longer after each failed attempt
+    return random.uniform(0.001, 0.2 * 2 ** min(connection_attempts, 10))
+
+def _add_parameter(url, name, value):
+    # The stream URL may already have parameters (e.g. a filter)
+    if '?' in url:
+        return url + '&' + name + '=' + value
+    else:
+        return url + '?' + name + '=' + value
+
 
 class Client(object):
     """Asynchronous client for multiple stream sources.
@@ -91,7 +116,7 @@ class Client(object):
                  source_start_callback=None, source_finish_callback=None,
                  label=None, retrieve_missing_events=False,
                  ioloop=None, parse_event_body=True, separate_events=True,
-                 disable_compression=False):
+                 disable_compression=False, parser_pool=None):
         """Creates a new client for one or more stream URLs.
 
         'streams' is a list of streams to connect to. Each stream can
@@ -117,6 +142,10 @@ class Client(object):
         apon calling the 'start()' method. If not, it will block on
         the default 'ioloop' of Tornado.
 
+        A 'parser_pool' ('parsing.ParserPool') may be given in order
+        to parse the bodies of the events received from remote streams
+        in other processes (see 'AsyncStreamingClient').
+
         """
         if not isinstance(streams, list):
             streams = [streams]
@@ -133,7 +162,8 @@ class Client(object):
                          retrieve_missing_events=retrieve_missing_events,
                          parse_event_body=parse_event_body,
                          separate_events=separate_events,
-                         disable_compression=disable_compression))
+                         disable_compression=disable_compression,
+                         parser_pool=parser_pool))
             else:
                 self.clients.append(LocalClient(stream,
                                             event_callback=event_callback,
@@ -223,7 +253,10 @@ class LocalClient(object):
 
         """
         if isinstance(event_callback, Filter):
-            event_callback = event_callback.filter_event
+            if separate_events:
+                event_callback = event_callback.filter_event
+            else:
+                event_callback = event_callback.filter_events
         self.stream = stream
         self.event_callback = event_callback
         self.separate_events = separate_events
@@ -257,7 +290,8 @@ class AsyncStreamingClient(object):
                  source_start_callback=None, source_finish_callback=None,
                  label=None, retrieve_missing_events=False,
                  ioloop=None, parse_event_body=True, separate_events=True,
-                 reconnect=True, disable_compression=False):
+                 reconnect=True, disable_compression=False,
+                 parser_pool=None):
         """Creates a new client for a given stream URL.
 
         The client connects to the stream URL given by 'url'.  For
@@ -268,10 +302,11 @@ class AsyncStreamingClient(object):
         will receive a list of events instead of a single events.
 
         A 'label' (string) may be set to this client. Setting a label
-        allows the client to save the id of the latest event it received
-        and ask for missed events when the client is run again.
-        Set 'retrieve_missing_events' to True in order to do that.
-        If 'retrieve_missing_events' is True, a non-empty label must be set.
+        allows the client to save the sequence number of the latest
+        event it received and ask for missed events when the client is
+        run again. Set 'retrieve_missing_events' to True in order to do
+        that. If 'retrieve_missing_events' is True, a non-empty label
+        must be set.
 
         If a 'ioloop' object is given, the client will block on it
         apon calling the 'start()' method. If not, it will block on
@@ -280,13 +315,28 @@ class AsyncStreamingClient(object):
         When 'reconnect' is True (which is the default), the client tries
         to automatically reconnect when it loses connection
         with the server, following an exponential back-off mechanism.
+        After reconnecting, the server sends the events that were
+        published in the meantime. The number of events that were
+        lost because the server no longer had them, or because it
+        skipped them while the client was too slow to receive them,
+        is logged, and kept in the 'lost_events' attribute.
+
+        If a 'parser_pool' ('parsing.ParserPool') is given and
+        'parse_event_body' is True, event bodies are parsed in the
+        processes of the pool, so that parsing does not block the
+        ioloop. The callbacks still receive the events in the order
+        they arrived. Bodies that cannot be parsed are reported to the
+        error callback, and the events of that batch are dropped.
 
         """
         if retrieve_missing_events and not label:
             raise ValueError('Retrieving missing events'
                              ' requires a client label')
         if isinstance(event_callback, Filter):
-            event_callback = event_callback.filter_event
+            if separate_events:
+                event_callback = event_callback.filter_event
+            else:
+                event_callback = event_callback.filter_events
         self.url = url
         self.event_callback = event_callback
         self.error_callback = error_callback
@@ -301,15 +351,26 @@ class AsyncStreamingClient(object):
         else:
             self.status_file = None
         self.last_event_id = None
+        self.last_sequence = None
+        self.lost_events = 0
+        self._filtered = 'filter' in urlparse.parse_qs( \
+                                            urlparse.urlparse(url).query)
         self.ioloop = ioloop or tornado.ioloop.IOLoop.instance()
         self.parse_event_body = parse_event_body
         self.separate_events = separate_events
+        if parser_pool is not None and parse_event_body:
+            self._parse_queue = parsing.ParseQueue(parser_pool)
+        else:
+            self._parse_queue = None
         self._closed = False
         self._looping = False
         self._deserializer = Deserializer()
         self.reconnect = reconnect
         self.disable_compression = disable_compression
         self.connection_attempts = 0
+        self._dictionary_url = None
+        self._decompressor = None
+        self._pending_data = []
 #        self.data_history = []
 
     def start(self, loop=False):
@@ -350,16 +411,21 @@ class AsyncStreamingClient(object):
 
     def _connect(self):
         http_client = AsyncHTTPClient()
-        last_event_received = self._read_last_event_id()
-        if last_event_received is None:
-            url = self.url
+        last_event_received, last_sequence = self._read_last_event_id()
+        if last_sequence is not None:
+            url = _add_parameter(self.url, 'from-seq', str(last_sequence + 1))
+        elif last_event_received is not None:
+            url = _add_parameter(self.url, 'last-seen', last_event_received)
         else:
-            url = self.url + '?last-seen=' + last_event_received
+            url = self.url
         if not self.disable_compression:
-            headers = {'Accept-Encoding': 'deflate;q=1, identity;q=0.5'}
+            headers = {'Accept-Encoding': (ztreamy.dictionary_encoding
+                                           + ';q=1, deflate;q=0.9, '
+                                           'identity;q=0.5')}
         else:
             headers = {'Accept-Encoding': 'identity'}
         req = HTTPRequest(url, streaming_callback=self._stream_callback,
+                          header_callback=self._header_callback,
                           headers=headers,
                           request_timeout=0, connect_timeout=0)
         http_client.fetch(req, self._request_callback)
@@ -371,8 +437,7 @@ class AsyncStreamingClient(object):
         self.ioloop.add_timeout(datetime.timedelta(seconds=t), self._connect)
 
     def _reconnection_delay(self):
-        return random.uniform(0.001,
-                              0.2 * 2 ** min(self.connection_attempts, 10))
+        return _reconnection_delay(self.connection_attempts)
 
     def _finish_internal(self, notify_connection_close):
         if self._closed:
@@ -385,8 +450,49 @@ class AsyncStreamingClient(object):
             self._looping = False
         self._closed = True
 
+    def _header_callback(self, line):
+        if line.startswith('HTTP/'):
+            # A new response begins
+            self._dictionary_url = None
+            self._decompressor = None
+            self._pending_data = []
+            return
+        name, _, value = line.partition(':')
+        if name.strip().lower() == ztreamy.dictionary_header.lower():
+            url = urlparse.urljoin(self.url, value.strip())
+            self._dictionary_url = url
+            if url in _dictionaries:
+                self._decompressor = _dictionaries[url].decompressor()
+            else:
+                AsyncHTTPClient().fetch(url, self._dictionary_callback)
+
+    def _dictionary_callback(self, response):
+        if response.request.url != self._dictionary_url:
+            # The client has reconnected in the meantime
+            return
+        if response.error:
+            logging.error('Error retrieving the compression dictionary: '
+                          + str(response.error))
+            if self.error_callback is not None:
+                self.error_callback('Error retrieving the compression '
+                                    'dictionary', http_error=response.error)
+            return
+        dictionary = CompressionDictionary(response.body)
+        _dictionaries[self._dictionary_url] = dictionary
+        self._decompressor = dictionary.decompressor()
+        data = ''.join(self._pending_data)
+        self._pending_data = []
+        if data:
+            self._process_received_data(self._decompressor.decompress(data))
+
     def _stream_callback(self, data):
         self.connection_attempts = 0
+        if self._dictionary_url is not None:
+            if self._decompressor is None:
+                # Wait until the dictionary is available
+                self._pending_data.append(data)
+                return
+            data = self._decompressor.decompress(data)
         self._process_received_data(data)
 
     def _request_callback(self, response):
@@ -413,17 +519,66 @@ class AsyncStreamingClient(object):
     def _process_received_data(self, data):
         global transferred_bytes
         transferred_bytes += len(data)
-        evs = self._deserialize(data, parse_body=self.parse_event_body)
-        for e in evs:
-            logger.logger.event_delivered(e)
+        if self._parse_queue is None:
+            evs = self._deserialize(data, parse_body=self.parse_event_body)
+            self._deliver_events(evs)
+        else:
+            evs = self._deserialize(data, parse_body=False)
+            if evs:
+                future = self._parse_queue.parse_events(evs)
+                self.ioloop.add_future(future, self._parsed_callback)
+
+    def _parsed_callback(self, future):
+        try:
+            evs = future.result()
+        except ZtreamyException as e:
+            logging.error(str(e))
+            if self.error_callback is not None:
+                self.error_callback(str(e))
+        else:
+            if not self._closed:
+                self._deliver_events(evs)
+
+    def _deliver_events(self, evs):
+        logger.events_delivered(evs)
+        # Sequence numbers are read before the callback, which may
+        # renumber the events (e.g. a relay stream)
+        if len(evs) > 0:
+            self._check_sequence(evs)
+            self._write_last_event_id(evs[-1])
         if self.event_callback is not None:
             if not self.separate_events:
                 self.event_callback(evs)
             else:
                 for ev in evs:
                     self.event_callback(ev)
-        if len(evs) > 0:
-            self._write_last_event_id(evs[-1])
+
+    def _check_sequence(self, evs):
+        # Gaps appear after reconnecting and also within a connection
+        # when the server skips events because the client is slow.
+        # The events of filtered streams are not consecutive.
+        if self._filtered:
+            return
+        last = self.last_sequence
+        first_seq = evs[0].sequence_number()
+        last_seq = evs[-1].sequence_number()
+        if (first_seq is not None and last_seq is not None
+            and last_seq - first_seq == len(evs) - 1
+            and (last is None or first_seq == last + 1)):
+            # Consecutive events: no need to check them one by one
+            return
+        lost = 0
+        for event in evs:
+            seq = event.sequence_number()
+            if seq is None:
+                continue
+            if last is not None and seq > last + 1:
+                lost += seq - last - 1
+            last = seq
+        if lost:
+            self.lost_events += lost
+            logging.warning('{} events of {} were lost'.format(lost,
+                                                               self.url))
 
     def _deserialize(self, data, parse_body=True):
         evs = []
@@ -464,23 +619,35 @@ class AsyncStreamingClient(object):
         return status_file
 
     def _write_last_event_id(self, event):
+        seq = event.sequence_number()
         if self.status_file is not None:
             with open(self.status_file, mode='w') as f:
-                f.write(event.event_id)
-        else:
-            self.last_event_id = event.event_id
+                if seq is None:
+                    f.write(event.event_id)
+                else:
+                    f.write(event.event_id + ' ' + str(seq))
+        self.last_event_id = event.event_id
+        self.last_sequence = seq
 
     def _read_last_event_id(self):
+        """Returns the id and sequence number of the last event seen.
+
+        Any of them may be None. Files written by older versions
+        of the client contain just the event id.
+
+        """
         if self.status_file is not None:
             with open(self.status_file) as f:
-                event_id_read = f.read().strip()
-            if event_id_read:
-                event_id = event_id_read
+                parts = f.read().split()
+            if not parts:
+                self.last_event_id = self.last_sequence = None
             else:
-                event_id = None
-        else:
-            event_id = self.last_event_id
-        return event_id
+                self.last_event_id = parts[0]
+                if len(parts) > 1 and parts[1].isdigit():
+                    self.last_sequence = int(parts[1])
+                else:
+                    self.last_sequence = None
+        return self.last_event_id, self.last_sequence
 
 
 class SynchronousClient(object):
@@ -493,21 +660,36 @@ class SynchronousClient(object):
                  last_event_seen=None):
         self.server_url = server_url
         self.last_event_seen = last_event_seen
+        self.last_sequence = None
         self.deserializer = Deserializer()
         self.parse_event_body = parse_event_body
         self.stream_finished = False
 
     def receive_events(self):
         url = self.server_url
-        if self.last_event_seen is not None:
-            url += '?last-seen=' + self.last_event_seen
-        connection = urllib2.urlopen(url)
+        if self.last_sequence is not None:
+            url = _add_parameter(url, 'from-seq', str(self.last_sequence + 1))
+        elif self.last_event_seen is not None:
+            url = _add_parameter(url, 'last-seen', self.last_event_seen)
+        request = urllib2.Request(url, headers={'Accept-Encoding': \
+                                (ztreamy.dictionary_encoding
+                                 + ';q=1, gzip;q=0.9, identity;q=0.5')})
+        connection = urllib2.urlopen(request)
         data = connection.read()
+        headers = connection.info()
+        connection.close()
+        if headers.getheader('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        dictionary_path = headers.getheader(ztreamy.dictionary_header)
+        if dictionary_path is not None:
+            dictionary = self._get_dictionary( \
+                                urlparse.urljoin(url, dictionary_path))
+            data = dictionary.decompress(data)
         evs = self.deserializer.deserialize(data, complete=True,
                                             parse_body=self.parse_event_body)
-        connection.close()
         if len(evs) > 0:
             self.last_event_seen = evs[-1].event_id
+            self.last_sequence = evs[-1].sequence_number()
         for event in evs:
             if (isinstance(event, Command)
                 and event.command == 'Stream-Finished'):
@@ -515,6 +697,13 @@ class SynchronousClient(object):
                 break
         return [e for e in evs if not isinstance(e, Command)]
 
+    def _get_dictionary(self, url):
+        if url not in _dictionaries:
+            connection = urllib2.urlopen(url)
+            _dictionaries[url] = CompressionDictionary(connection.read())
+            connection.close()
+        return _dictionaries[url]
+
 
 class EventPublisher(object):
     """Publishes events by sending them to a server. Asynchronous.
@@ -599,6 +788,343 @@ class EventPublisher(object):
         self.ioloop.add_callback(fetch)
 
 
+class BatchingEventPublisher(EventPublisher):
+    """Publishes events by sending them to a server in batches.
+
+    Events are accumulated for up to 'buffering_time' milliseconds,
+    or until they take 'max_batch_bytes' bytes, and then sent in a
+    single HTTP request. At most 'max_requests' requests are sent at
+    the same time, which reuse the persistent connections of the HTTP
+    client. While the server is slow, new events are coalesced into
+    the batches waiting to be sent.
+
+    A batch that fails because the server cannot be reached or
+    because of a server error is sent again, before the batches
+    that follow it, after a delay that grows exponentially like the
+    reconnection delay of 'AsyncStreamingClient'.
+
+    """
+    def __init__(self, server_url, io_loop=None,
+                 serialization_type=ztreamy.SERIALIZATION_ZTREAMY,
+                 buffering_time=100, max_batch_bytes=65536, max_requests=1,
+                 max_pending_bytes=1048576, batch_callback=None,
+                 drain_callback=None, error_callback=None):
+        """Creates a new 'BatchingEventPublisher' object.
+
+        With 'max_requests' set to 1 (the default), the server
+        receives the batches in the order they were published. Higher
+        values allow sending several batches at the same time, but
+        then the server may receive them in a different order.
+
+        If a 'batch_callback' is given, it is called every time the
+        server responds to a batch, with the list of events of the
+        batch and the tornado.httpclient.HTTPResponse object. Batches
+        that are sent again are reported only once, with the last
+        response.
+
+        The server may also reject a batch (e.g. with a 400 status
+        because of a malformed event). The batch is not sent again
+        then, and the error is reported to the 'error_callback', with
+        the same parameters as in 'AsyncStreamingClient'.
+
+        The publisher is 'saturated' when the events not yet
+        acknowledged by the server take 'max_pending_bytes' bytes
+        or more. Sources should stop publishing then until the
+        'drain_callback' (without parameters) is called.
+
+        """
+        super(BatchingEventPublisher, self).__init__(server_url,
+                                        io_loop=io_loop,
+                                        serialization_type=serialization_type)
+        self.buffering_time = buffering_time
+        self.max_batch_bytes = max_batch_bytes
+        self.max_requests = max_requests
+        self.max_pending_bytes = max_pending_bytes
+        self.batch_callback = batch_callback
+        self.drain_callback = drain_callback
+        self.error_callback = error_callback
+        self.pending_bytes = 0
+        self.num_requests = 0
+        self.failed_attempts = 0
+        self._batch = _PublishBatch()
+        self._queue = collections.deque()
+        self._timeout = None
+        self._retry_timeout = None
+        self._closing = False
+
+    @property
+    def saturated(self):
+        """True when the source should stop publishing for a while."""
+        return self.pending_bytes >= self.max_pending_bytes
+
+    def publish_events(self, events, callback=None):
+        """Publishes a list of events.
+
+        The events are added to the current batch. If a 'callback' is
+        given, it will be called when the response for that batch is
+        received from the server. The callback receives a
+        tornado.httpclient.HTTPResponse parameter.
+
+        """
+        if self.serialization_type == ztreamy.SERIALIZATION_JSON:
+            num_bytes = sum(len(e.serialize_json()) for e in events)
+        else:
+            num_bytes = sum(len(str(e)) for e in events)
+        batch = self._batch
+        batch.events.extend(events)
+        batch.num_bytes += num_bytes
+        if callback is not None:
+            batch.callbacks.append(callback)
+        self.pending_bytes += num_bytes
+        if not self.buffering_time or batch.num_bytes >= self.max_batch_bytes:
+            self._close_batch()
+        elif self._timeout is None:
+            self._timeout = self.ioloop.add_timeout( \
+                        datetime.timedelta(milliseconds=self.buffering_time),
+                        self._close_batch)
+
+    def flush(self):
+        """Sends the current batch without waiting for more events."""
+        self._close_batch()
+
+    def close(self):
+        """Closes the event publisher after sending the pending events.
+
+        This object should not be used anymore.
+
+        """
+        self._closing = True
+        self._close_batch()
+        if self.num_requests == 0 and not self._queue:
+            super(BatchingEventPublisher, self).close()
+
+    def _close_batch(self):
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        batch = self._batch
+        if not batch.events:
+            return
+        self._batch = _PublishBatch()
+        if (self._queue and (self._queue[-1].num_bytes + batch.num_bytes
+                             <= self.max_batch_bytes)):
+            # The server is slow: coalesce with the waiting batch
+            self._queue[-1].merge(batch)
+        else:
+            self._queue.append(batch)
+        self._send_batches()
+
+    def _send_batches(self):
+        while (self._queue and self.num_requests < self.max_requests
+               and self._retry_timeout is None):
+            batch = self._queue.popleft()
+            body = ztreamy.serialize_events(batch.events,
+                                        serialization=self.serialization_type)
+            self.num_requests += 1
+            self._send_request(body, callback=functools.partial( \
+                                                    self._batch_callback,
+                                                    batch))
+
+    def _batch_callback(self, batch, response):
+        self.num_requests -= 1
+        if response.error:
+            logging.error(response.error)
+            if response.code // 100 != 4:
+                # Sent again before the batches that follow it
+                self._queue.appendleft(batch)
+                self._retry()
+                return
+            if self.error_callback is not None:
+                self.error_callback('Error in HTTP request',
+                                    http_error=response.error)
+        self.failed_attempts = 0
+        was_saturated = self.saturated
+        self.pending_bytes -= batch.num_bytes
+        if self.batch_callback is not None:
+            self.batch_callback(batch.events, response)
+        for callback in batch.callbacks:
+            callback(response)
+        self._send_batches()
+        if self._closing:
+            if self.num_requests == 0:
+                super(BatchingEventPublisher, self).close()
+        elif (was_saturated and not self.saturated
+              and self.drain_callback is not None):
+            self.drain_callback()
+
+    def _retry(self):
+        if self._retry_timeout is not None:
+            return
+        self.failed_attempts += 1
+        t = _reconnection_delay(self.failed_attempts)
+        logging.info('Sending the batch again after {:.02f}s'.format(t))
+        self._retry_timeout = self.ioloop.add_timeout( \
+                                    datetime.timedelta(seconds=t),
+                                    self._retry_callback)
+
+    def _retry_callback(self):
+        self._retry_timeout = None
+        self._send_batches()
+
+
+class _PublishBatch(object):
+    __slots__ = ('events', 'callbacks', 'num_bytes')
+
+    def __init__(self):
+        self.events = []
+        self.callbacks = []
+        self.num_bytes = 0
+
+    def merge(self, other):
+        self.events.extend(other.events)
+        self.callbacks.extend(other.callbacks)
+        self.num_bytes += other.num_bytes
+
+
+class StreamingEventPublisher(object):
+    """Publishes events through a long-lived request. Asynchronous.
+
+    The events are written, as they are published, to the body of a
+    single HTTP request to the '/publish-stream' path of the stream,
+    sent with chunked transfer encoding. The server dispatches every
+    event as soon as it receives it, without the cost of a new
+    request per event. The request is opened again if it fails,
+    after a delay that grows exponentially while the server cannot
+    be reached, like in 'AsyncStreamingClient'.
+
+    Uses an asynchronous HTTP client, but does not manage an ioloop
+    itself. The ioloop must be run by the calling code.
+
+    """
+    _headers = {'Content-Type': ztreamy.event_media_type}
+
+    def __init__(self, server_url, io_loop=None, max_buffer_bytes=1048576,
+                 error_callback=None):
+        """Creates a new 'StreamingEventPublisher' object.
+
+        'server_url' is the URL of the stream, optionally followed by
+        '/publish-stream'. The publisher is 'saturated' when the
+        events waiting to be written to the connection take at least
+        'max_buffer_bytes' bytes, and sources should stop publishing
+        then for a while. Errors in the request are reported to the
+        'error_callback', with the same parameters as in
+        'AsyncStreamingClient'.
+
+        """
+        if server_url.endswith('/publish-stream'):
+            self.server_url = server_url
+        elif server_url.endswith('/'):
+            self.server_url = server_url + 'publish-stream'
+        else:
+            self.server_url = server_url + '/publish-stream'
+        self.ioloop = io_loop or tornado.ioloop.IOLoop.instance()
+        # libcurl cannot stream request bodies
+        self.http_client = SimpleAsyncHTTPClient(io_loop=io_loop,
+                                                 force_instance=True)
+        self.max_buffer_bytes = max_buffer_bytes
+        self.error_callback = error_callback
+        self.buffered_bytes = 0
+        self.connection_attempts = 0
+        self._buffer = []
+        self._waiter = None
+        self._connected = False
+        self._closing = False
+        self._reconnect_timeout = None
+
+    @property
+    def saturated(self):
+        """True when the source should stop publishing for a while."""
+        return self.buffered_bytes >= self.max_buffer_bytes
+
+    def publish(self, event):
+        """Publishes a new event."""
+        logger.logger.event_published(event)
+        self.publish_events([event])
+
+    def publish_events(self, events):
+        """Publishes a list of events."""
+        data = ztreamy.serialize_events(events)
+        self._buffer.append(data)
+        self.buffered_bytes += len(data)
+        if not self._connected and self._reconnect_timeout is None:
+            self._connect()
+        self._wake_up()
+
+    def close(self):
+        """Finishes the request after sending the pending events.
+
+        This object should not be used anymore.
+
+        """
+        self._closing = True
+        if self._connected:
+            self._wake_up()
+        else:
+            if self._reconnect_timeout is not None:
+                self.ioloop.remove_timeout(self._reconnect_timeout)
+                self._reconnect_timeout = None
+            self.http_client.close()
+
+    def _connect(self):
+        self._reconnect_timeout = None
+        req = HTTPRequest(self.server_url, method='POST',
+                          headers=self._headers,
+                          body_producer=self._produce_body,
+                          request_timeout=0, connect_timeout=0)
+        self._connected = True
+        self.connection_attempts += 1
+        self.http_client.fetch(req, self._request_callback)
+
+    def _reconnect(self):
+        t = _reconnection_delay(self.connection_attempts)
+        logging.info('Reconnecting to the stream after {:.02f}s'.format(t))
+        self._reconnect_timeout = self.ioloop.add_timeout( \
+                                    datetime.timedelta(seconds=t),
+                                    self._connect)
+
+    @tornado.gen.coroutine
+    def _produce_body(self, write):
+        while True:
+            while self._buffer:
+                # Everything published in the meantime goes in one chunk.
+                # It stays in the buffer until it is written, so that
+                # it is sent in the next request if this one fails.
+                data = ''.join(self._buffer)
+                self._buffer = [data]
+                yield write(data)
+                del self._buffer[0]
+                self.buffered_bytes -= len(data)
+                self.connection_attempts = 0
+            if self._closing:
+                break
+            self._waiter = tornado.concurrent.Future()
+            if not (yield self._waiter):
+                # The request finished
+                break
+
+    def _wake_up(self, proceed=True):
+        if self._waiter is not None:
+            waiter = self._waiter
+            self._waiter = None
+            waiter.set_result(proceed)
+
+    def _request_callback(self, response):
+        self._connected = False
+        self._wake_up(proceed=False)
+        if response.error:
+            logging.error(response.error)
+            if self.error_callback is not None:
+                self.error_callback('Error in HTTP request',
+                                    http_error=response.error)
+        if self._closing:
+            self.http_client.close()
+        elif self._buffer:
+            if response.error:
+                self._reconnect()
+            else:
+                self._connect()
+
+
 class SynchronousEventPublisher(object):
     """Publishes events by sending them to a server. Synchronous.
 
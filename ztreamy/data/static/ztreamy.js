@@ -30,6 +30,9 @@ ztreamy.Stream = function(url) {
     this.status = "disconnected";
     this.aborted = false;
     this.running = false;
+    // Use the WebSocket endpoint while it works, long-polling otherwise
+    this.useWebSocket = ("WebSocket" in window);
+    this.socket = null;
 
     this.consume = function() {
         if (this.running) {
@@ -38,6 +41,10 @@ ztreamy.Stream = function(url) {
         if (this.aborted) {
             this.aborted = false;
         }
+        if (this.useWebSocket) {
+            this.consumeWebSocket();
+            return;
+        }
         var params = {};
         if (this.lastSeen) {
             params = {
@@ -78,6 +85,58 @@ ztreamy.Stream = function(url) {
             });
     }
 
+    this.consumeWebSocket = function() {
+        var url = this.url.replace(/^http/, "ws") + "/websocket";
+        if (this.lastSeen) {
+            url += "?last-seen=" + encodeURIComponent(this.lastSeen)
+                + "&past-events-limit=" + this.maxDisplayedEvents;
+        }
+        var stream = this;
+        this.status = "connected";
+        this.running = true;
+        this.displayStatus();
+        this.socket = new WebSocket(url, "ldjson");
+        this.socket.onmessage = function(message) {
+            var events = [];
+            var lines = message.data.split("\n");
+            for (var i = 0; i < lines.length; i++) {
+                if (lines[i]) {
+                    var event = JSON.parse(lines[i]);
+                    // Skip the keep-alive commands of the server
+                    if (event["Syntax"] !== "ztreamy-command") {
+                        events.push(event);
+                    }
+                }
+            }
+            stream.atLeastOneSuccess = true;
+            stream.numErrors = 0;
+            if (events.length > 0) {
+                stream.lastSeen = events[events.length - 1]["Event-Id"];
+                stream.eventsCallback(events);
+            }
+        };
+        this.socket.onclose = function(event) {
+            stream.running = false;
+            stream.socket = null;
+            if (stream.aborted) {
+                return;
+            }
+            stream.numErrors += 1;
+            if (!stream.atLeastOneSuccess) {
+                // WebSockets may be blocked on the way to the server
+                stream.useWebSocket = false;
+                stream.consume();
+            } else if (stream.numErrors <= 3) {
+                // Try again
+                stream.consume();
+            } else {
+                stream.status = "closed (" + event.code + ")";
+                stream.displayStatus();
+                stream.errorCallback(null, "closed", event.code);
+            }
+        };
+    }
+
     this.mostRecent = function(num, callback) {
         if (this.running) {
             throw("Error: a request is already running");
@@ -116,6 +175,9 @@ ztreamy.Stream = function(url) {
         if (this.running) {
             this.aborted = true;
             this.status = "disconnected";
+            if (this.socket) {
+                this.socket.close();
+            }
             this.displayStatus();
         }
     }
@@ -27,6 +27,8 @@ import gzip
 import StringIO
 import time
 import logging
+import hashlib
+import struct
 
 import ztreamy
 from . import events
@@ -36,22 +38,26 @@ class ClientProperties(object):
     ENCODING_PLAIN = 0
     ENCODING_ZLIB = 1
     ENCODING_GZIP = 2
+    ENCODING_ZLIB_DICT = 3
     ENCODINGS = (
         ENCODING_PLAIN,
         ENCODING_ZLIB,
         ENCODING_GZIP,
+        ENCODING_ZLIB_DICT,
     )
 
     @staticmethod
     def create():
         pass
 
-    def __init__(self, streaming, serialization, encoding, local, priority):
+    def __init__(self, streaming, serialization, encoding, local, priority,
+                 tier=None):
         self.__streaming = streaming
         self.__serialization = serialization
         self.__encoding = encoding
         self.__local = local
         self.__priority = priority
+        self.__tier = tier
 
     @property
     def streaming(self):
@@ -73,6 +79,11 @@ class ClientProperties(object):
     def priority(self):
         return self.__priority
 
+    @property
+    def tier(self):
+        """Delay in milliseconds of the dispatch tier, or None."""
+        return self.__tier
+
     def __str__(self):
         parts = []
         if self.streaming:
@@ -87,10 +98,14 @@ class ClientProperties(object):
             parts.append('zlib')
         elif self.encoding == ClientProperties.ENCODING_GZIP:
             parts.append('gzip')
+        elif self.encoding == ClientProperties.ENCODING_ZLIB_DICT:
+            parts.append('zlib-dict')
         if self.local:
             parts.append('local')
         if self.priority:
             parts.append('priority')
+        if self.tier is not None:
+            parts.append('tier' + str(self.tier))
         return '-'.join(parts)
 
 
@@ -102,7 +117,8 @@ class ClientPropertiesFactory(object):
                serialization=ztreamy.SERIALIZATION_ZTREAMY,
                encoding=ClientProperties.ENCODING_PLAIN,
                local=False,
-               priority=False):
+               priority=False,
+               tier=None):
         if streaming not in (True, False):
             raise ValueError('Bad streaming value: ' + str(streaming))
         if serialization not in ztreamy.SERIALIZATIONS:
@@ -113,6 +129,11 @@ class ClientPropertiesFactory(object):
             raise ValueError('Bad local value: ' + str(local))
         if priority and not streaming:
             raise ValueError('Priority requires streaming mode')
+        if tier is not None:
+            if not isinstance(tier, int) or tier < 0:
+                raise ValueError('Bad tier value: ' + str(tier))
+            if not streaming or local or priority:
+                raise ValueError('Tiers require non-priority streaming mode')
         if encoding == ClientProperties.ENCODING_ZLIB and not streaming:
             raise ValueError('Zlib encoding requires streaming mode')
         if encoding == ClientProperties.ENCODING_GZIP and streaming:
@@ -123,7 +144,7 @@ class ClientPropertiesFactory(object):
              or encoding != ClientProperties.ENCODING_PLAIN
              or priority)):
             raise ValueError('Incompatible properties for a local client')
-        key = (streaming, serialization, encoding, local, priority)
+        key = (streaming, serialization, encoding, local, priority, tier)
         if key in ClientPropertiesFactory.instances:
             return ClientPropertiesFactory.instances[key]
         else:
@@ -202,9 +223,8 @@ class LocalDispatcher(Dispatcher):
 
     def dispatch(self, events_pack):
         if len(self.subscriptions):
-            logging.info('{} {}: {}'.format(self.stream.path,
-                                            self.properties,
-                                            len(self.subscriptions)))
+            logging.info('%s %s: %d', self.stream.path, self.properties,
+                         len(self.subscriptions))
         if len(self.subscriptions) and len(events_pack):
             for client in self.subscriptions:
                 client.send_events(events_pack.events)
@@ -213,12 +233,14 @@ class LocalDispatcher(Dispatcher):
 class SimpleDispatcher(Dispatcher):
     def __init__(self, stream, properties):
         if (properties.encoding != ClientProperties.ENCODING_PLAIN
-            and properties.encoding != ClientProperties.ENCODING_GZIP):
-            raise ValueError('PlainDispatcher requires PLAIN or GZIP encoding')
-        if (properties.encoding == ClientProperties.ENCODING_GZIP
+            and properties.encoding != ClientProperties.ENCODING_GZIP
+            and properties.encoding != ClientProperties.ENCODING_ZLIB_DICT):
+            raise ValueError('PlainDispatcher requires PLAIN, GZIP '
+                             'or ZLIB_DICT encoding')
+        if (properties.encoding != ClientProperties.ENCODING_PLAIN
             and properties.streaming):
             raise ValueError('Serialization is incompatible '
-                             'with GZIP encoding')
+                             'with GZIP and ZLIB_DICT encodings')
         super(SimpleDispatcher, self).__init__(stream, properties)
         self.last_event_time = time.time()
 
@@ -229,17 +251,28 @@ class SimpleDispatcher(Dispatcher):
 
     def dispatch(self, events_pack):
         if len(self.subscriptions):
-            logging.info('{} {}: {}'.format(self.stream.path,
-                                            self.properties,
-                                            len(self.subscriptions)))
+            logging.info('%s %s: %d', self.stream.path, self.properties,
+                         len(self.subscriptions))
         if len(self.subscriptions) and len(events_pack):
             self.last_event_time = time.time()
             data = events_pack.serialize(self.properties.serialization)
             if self.properties.encoding == ClientProperties.ENCODING_GZIP:
                 data = compress_gzip(data)
+            elif self.properties.encoding == ClientProperties.ENCODING_ZLIB_DICT:
+                self._dispatch_zlib_dict(data)
+                return
             for client in self.subscriptions:
                 client.send(data)
 
+    def _dispatch_zlib_dict(self, data):
+        # Compress once for every dictionary in use
+        compressed = {}
+        for client in self.subscriptions:
+            if client.dictionary not in compressed:
+                compressed[client.dictionary] = \
+                                    client.dictionary.compress(data)
+            client.send(compressed[client.dictionary])
+
     def periodic_maintenance(self):
         if len(self.subscriptions):
             current_time = time.time()
@@ -258,12 +291,33 @@ class SimpleDispatcher(Dispatcher):
 
 
 class ZlibDispatcher(Dispatcher):
-    def __init__(self, stream, properties):
-        if (properties.encoding != ClientProperties.ENCODING_ZLIB
+    """Dispatcher for zlib-compressed streaming clients.
+
+    By default, clients that subscribe while the stream is active
+    are put in a new subscription group, with its own compressor,
+    until the main compressor has not any reference to data those
+    clients did not receive (32 KB later). Until then, every batch
+    of events is compressed once per group.
+
+    With 'shared_compression', the main compressor does a full
+    flush at the batch boundary at which new clients arrive, and
+    they join the main group right away. Every batch is compressed
+    just once, at the cost of a worse compression ratio in the
+    batches at which clients join.
+
+    With the ZLIB_DICT encoding, every client has the preset
+    dictionary ('CompressionDictionary') it was told to use, and
+    clients are put only in groups compatible with it.
+
+    """
+    def __init__(self, stream, properties, shared_compression=False):
+        if ((properties.encoding != ClientProperties.ENCODING_ZLIB
+             and properties.encoding != ClientProperties.ENCODING_ZLIB_DICT)
             or not properties.streaming):
             raise ValueError('MainZlibDispatcher requires ZLIB encoding ',
                              'and streaming mode.')
         super(ZlibDispatcher, self).__init__(stream, properties)
+        self.shared_compression = shared_compression
         self.groups = [SubscriptionGroup(properties)]
         self.new_subscriptions = []
         self.last_event_time = time.time()
@@ -284,24 +338,25 @@ class ZlibDispatcher(Dispatcher):
 
     def dispatch(self, events_pack):
         self._group_maintenance()
-        if self.new_subscriptions:
-            if self.groups[-1].is_reset:
-                self.groups[-1].merge_clients(self.new_subscriptions)
+        for dictionary, clients in _by_dictionary(self.new_subscriptions):
+            if self.shared_compression:
+                self.groups[0].merge_clients(clients, dictionary=dictionary)
+            elif self.groups[-1].accepts(dictionary):
+                self.groups[-1].merge_clients(clients, dictionary=dictionary)
             else:
-                new_group = SubscriptionGroup(self.properties)
-                new_group.merge_clients(self.new_subscriptions)
+                new_group = SubscriptionGroup(self.properties,
+                                              dictionary=dictionary)
+                new_group.merge_clients(clients, dictionary=dictionary)
                 self.groups.append(new_group)
-            self.new_subscriptions = []
+        self.new_subscriptions = []
         if len(self.subscriptions):
-            logging.info('{} {}: {} ({} groups)'.format( \
-                                                self.stream.path,
-                                                self.properties,
-                                                len(self.subscriptions),
-                                                len(self.groups)))
+            logging.info('%s %s: %d (%d groups)', self.stream.path,
+                         self.properties, len(self.subscriptions),
+                         len(self.groups))
             if len(self.groups) > 1:
                 for i, group in enumerate(self.groups):
-                    logging.info('    #{}: {} | {}'.format(i, len(group),
-                                                           group.data_counter))
+                    logging.info('    #%d: %d | %d', i, len(group),
+                                 group.data_counter)
             if len(events_pack):
                 self.last_event_time = time.time()
                 for group in self.groups:
@@ -344,12 +399,20 @@ class ZlibDispatcher(Dispatcher):
 
 
 class SubscriptionGroup(object):
-    def __init__(self, properties, compression_level=6):
+    def __init__(self, properties, compression_level=6, dictionary=None):
         self.properties = properties
         self.subscriptions = []
+        # The dictionary the history of the compressor depends on
+        self.dictionary = dictionary
         if properties.encoding == ClientProperties.ENCODING_ZLIB:
             self.compressor = zlib.compressobj(compression_level)
             self.initial_data = self.compressor.compress('')
+        elif properties.encoding == ClientProperties.ENCODING_ZLIB_DICT:
+            # Clients prime their decompressors, zlib header included,
+            # with the dictionary, so there is no initial data to send
+            self.compression_level = compression_level
+            self._prime_compressor(dictionary)
+            self.initial_data = b''
         else:
             self.compressor = None
             self.initial_data = None
@@ -393,6 +456,15 @@ class SubscriptionGroup(object):
     def is_empty(self):
         return not self.subscriptions
 
+    def accepts(self, dictionary):
+        """Checks whether clients can join without a full flush.
+
+        'dictionary' is the dictionary the clients use, or None.
+
+        """
+        return self.is_reset and (self.dictionary is None
+                                  or self.dictionary is dictionary)
+
     def merge_group(self, group, full_flush=True):
         if not group.is_empty():
             if not self.is_reset and full_flush:
@@ -400,9 +472,13 @@ class SubscriptionGroup(object):
             self.subscriptions.extend(group.subscriptions)
         group.terminated = True
 
-    def merge_clients(self, clients):
+    def merge_clients(self, clients, dictionary=None):
         if clients:
-            if not self.is_reset:
+            if (self.properties.encoding == ClientProperties.ENCODING_ZLIB_DICT
+                and self.is_empty() and self.dictionary is not dictionary):
+                # Nobody depends on the current state of the compressor
+                self._prime_compressor(dictionary)
+            elif not self.accepts(dictionary):
                 self._full_flush()
             self.subscribe_clients(clients)
 
@@ -429,9 +505,23 @@ class SubscriptionGroup(object):
     def __iter__(self):
         return iter(self.subscriptions)
 
+    def _prime_compressor(self, dictionary):
+        if dictionary is not None:
+            self.compressor = dictionary.compressor(self.compression_level)
+        else:
+            self.compressor = zlib.compressobj(self.compression_level)
+            self.compressor.compress('')
+        self.dictionary = dictionary
+        self.is_reset = True
+
     def _full_flush(self):
+        # The data dispatched so far ended with a sync flush,
+        # therefore the empty block this flush outputs can be dropped.
+        # New clients can join the group after it.
         if self.compressor is not None:
             self.compressor.flush(zlib.Z_FULL_FLUSH)
+        self.is_reset = True
+        self.dictionary = None
 
 
 def compress_gzip(data):
@@ -445,3 +535,118 @@ def compress_zlib(data):
     data = compressor.compress(data)
     data += compressor.flush(zlib.Z_SYNC_FLUSH)
     return data
+
+def compress_deflate_raw(data, compression_level=6):
+    """Compresses 'data' as raw deflate blocks, ended by a sync flush.
+
+    The output does not depend on any other data, and can therefore
+    be concatenated with other pieces compressed the same way.
+    Use 'wrap_zlib' and 'wrap_gzip' for putting a sequence of pieces
+    into a zlib or gzip stream.
+
+    """
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def wrap_zlib(pieces):
+    """Returns a zlib stream made of raw deflate pieces.
+
+    Like in 'compress_zlib', the stream is not finished, so that
+    more data can be sent later in the same stream.
+
+    """
+    return _zlib_header + b''.join(pieces)
+
+def wrap_gzip(pieces, crc, size):
+    """Returns a complete gzip file made of raw deflate pieces.
+
+    'crc' and 'size' are the CRC-32 and length of the uncompressed data.
+
+    """
+    header = (b'\x1f\x8b\x08\x00' + struct.pack(b'<I', int(time.time()))
+              + b'\x00\xff')
+    # An empty final block closes the deflate stream
+    trailer = b'\x03\x00' + struct.pack(b'<II', crc & 0xffffffff,
+                                        size & 0xffffffff)
+    return header + b''.join(pieces) + trailer
+
+_zlib_header = zlib.compressobj().compress(b'')
+
+def _by_dictionary(clients):
+    """Splits a list of clients by the dictionary they use."""
+    groups = []
+    for client in clients:
+        dictionary = getattr(client, 'dictionary', None)
+        for group_dictionary, group_clients in groups:
+            if group_dictionary is dictionary:
+                group_clients.append(client)
+                break
+        else:
+            groups.append((dictionary, [client]))
+    return groups
+
+
+class CompressionDictionary(object):
+    """Preset dictionary for zlib compression.
+
+    The zlib module of Python 2 does not support preset dictionaries.
+    They are emulated by compressing (or decompressing) the dictionary
+    and discarding the output before processing the actual data, which
+    leaves the dictionary in the window of the compressor (or
+    decompressor). The compressed data starts right after the
+    compressed dictionary, without zlib header, and cannot be decoded
+    by standard zlib decoders.
+
+    """
+    def __init__(self, data, compression_level=6):
+        self.data = data
+        self.dictionary_id = hashlib.sha1(data).hexdigest()[:16]
+        self._compressor = zlib.compressobj(compression_level)
+        self._compressor.compress(data)
+        self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._decompressor = zlib.decompressobj()
+        self._decompressor.decompress(compress_zlib(data))
+
+    def compressor(self, compression_level=6):
+        """Returns a new compressor primed with the dictionary."""
+        if compression_level == 6:
+            return self._compressor.copy()
+        compressor = zlib.compressobj(compression_level)
+        compressor.compress(self.data)
+        compressor.flush(zlib.Z_SYNC_FLUSH)
+        return compressor
+
+    def decompressor(self):
+        """Returns a new decompressor primed with the dictionary."""
+        return self._decompressor.copy()
+
+    def compress(self, data):
+        compressor = self._compressor.copy()
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def decompress(self, data):
+        decompressor = self._decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+    @staticmethod
+    def train(evs, max_size=16384):
+        """Creates a dictionary from the serialization of some events.
+
+        The most recent events (at the end of the list) are kept
+        when the serialization of all of them is bigger than
+        'max_size'. Returns None if there is not enough data.
+
+        """
+        parts = []
+        size = 0
+        for event in reversed(evs):
+            data = str(event)
+            if size + len(data) > max_size:
+                break
+            parts.append(data)
+            size += len(data)
+        if not parts:
+            return None
+        parts.reverse()
+        return CompressionDictionary(b''.join(parts))
@@ -0,0 +1,636 @@
+# ztreamy: a framework for publishing semantic events on the Web
+# Copyright (C) 2011-2015 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+"""Persistent, append-only log of the events of a stream.
+
+The log is a directory with segment files. Every segment stores
+consecutive events in the ztreamy serialization, and is named after
+the sequence number of its first event. A sparse index file next to
+each segment maps some of its events (sequence number and event id)
+to their offset in the segment.
+
+The events are written by a background thread, so that the server
+is never blocked by the disk. Data is flushed to the disk
+('fsync') in batches, at most once every 'fsync_interval' seconds.
+
+"""
+import os
+import os.path
+import mmap
+import time
+import bisect
+import logging
+import threading
+import Queue
+
+import ztreamy
+from ztreamy import events
+
+
+class EventLog(object):
+    """An append-only log of events stored in segment files.
+
+    Events are numbered by consecutive sequence numbers, which go on
+    from the last event in the log when it is opened again.
+
+    """
+    segment_max_bytes = 64 * 1024 * 1024
+    index_interval = 4096
+
+    def __init__(self, path, max_bytes=None, max_age=None,
+                 fsync_interval=1.0):
+        """Opens the log stored in the directory 'path'.
+
+        The directory is created if it does not exist. Old segments
+        are deleted when the log takes more than 'max_bytes' bytes or
+        their events are older than 'max_age' seconds. The active
+        segment is never deleted.
+
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync_interval = fsync_interval
+        self.writable = True
+        self.segments = []
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._writer = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load()
+
+    @property
+    def first_sequence(self):
+        """Sequence number of the oldest event in the log."""
+        with self._lock:
+            return self.segments[0].first_sequence
+
+    def append(self, evs):
+        """Appends events to the log.
+
+        It returns immediately. The events are written to the disk
+        by a background thread.
+
+        """
+        if not self.writable or not evs:
+            return
+        data = [(event.event_id, _crlf_headers(str(event)))
+                for event in evs]
+        self.next_sequence += len(data)
+        self._queue.put(data)
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run_writer,
+                                            name='ztreamy-event-log')
+            self._writer.daemon = True
+            self._writer.start()
+
+    def close(self):
+        """Writes the pending events and stops the writer thread."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def read_recent(self, num_events, parse_body=False):
+        """Returns the most recent events in the log.
+
+        At most 'num_events' events are returned. Returns a tuple
+        with the list of events and the sequence number of the first
+        one.
+
+        """
+        with self._lock:
+            segments = list(self.segments)
+            next_sequence = self.next_sequence
+        first = max(next_sequence - num_events, segments[0].first_sequence)
+        evs = []
+        deserializer = events.Deserializer()
+        for segment in segments:
+            if segment.end_sequence <= first:
+                continue
+            data = segment.read_from(first)
+            if data:
+                evs.extend(deserializer.deserialize(data,
+                                                    parse_body=parse_body,
+                                                    complete=True))
+        return evs, next_sequence - len(evs)
+
+    def locate(self, sequence):
+        """Returns the segment and offset of an event.
+
+        'sequence' is the sequence number of the event. Returns None
+        if the event is not in the log.
+
+        """
+        with self._lock:
+            firsts = [segment.first_sequence for segment in self.segments]
+            pos = bisect.bisect_right(firsts, sequence) - 1
+            if pos < 0:
+                return None
+            segment = self.segments[pos]
+        if sequence >= segment.end_sequence:
+            return None
+        return segment, segment.offset_of(sequence)
+
+    def find_event(self, event_id):
+        """Returns the sequence number of the event with 'event_id'.
+
+        The newest segments are searched first. Returns None if the
+        event is not in the log.
+
+        """
+        with self._lock:
+            segments = list(self.segments)
+        for segment in reversed(segments):
+            sequence = segment.find_event(event_id)
+            if sequence is not None:
+                return sequence
+        return None
+
+    def find_time(self, timestamp):
+        """Returns the sequence number of the first event not older
+        than 'timestamp' (seconds since the epoch).
+
+        The events are assumed to be stored in chronological order.
+        Returns the sequence number of the next event to be appended
+        if all the events are older.
+
+        """
+        with self._lock:
+            segments = list(self.segments)
+        # The last segment whose first event is older than 'timestamp'
+        low, high = 0, len(segments)
+        while low < high:
+            middle = (low + high) // 2
+            first_time = segments[middle].timestamp_at(0)
+            if first_time is not None and first_time < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return segments[0].first_sequence
+        return segments[low - 1].find_time(timestamp)
+
+    def refresh(self):
+        """Reloads the state of the log from the disk.
+
+        Used by the instances that do not write the log (in the
+        worker processes of the server) in order to see the events
+        that the master process has written.
+
+        """
+        known = dict((segment.first_sequence, segment)
+                     for segment in self.segments[:-1])
+        segments = []
+        for first_sequence in self._segment_names():
+            segment = known.get(first_sequence)
+            if segment is None:
+                segment = _Segment(self.path, first_sequence)
+            segments.append(segment)
+        if not segments:
+            return
+        for segment, next_segment in zip(segments, segments[1:]):
+            segment.num_events = (next_segment.first_sequence
+                                  - segment.first_sequence)
+        segments[-1].recover(self.index_interval, truncate=False)
+        with self._lock:
+            self.segments = segments
+            self.next_sequence = segments[-1].end_sequence
+
+    def _init_worker(self):
+        # Only the master process of the server writes the log
+        self.writable = False
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def _segment_names(self):
+        names = []
+        for filename in os.listdir(self.path):
+            name, extension = os.path.splitext(filename)
+            if extension == '.log' and name.isdigit():
+                names.append(int(name))
+        return sorted(names)
+
+    def _load(self):
+        for first_sequence in self._segment_names():
+            self.segments.append(_Segment(self.path, first_sequence))
+        for segment, next_segment in zip(self.segments, self.segments[1:]):
+            segment.num_events = (next_segment.first_sequence
+                                  - segment.first_sequence)
+        if self.segments:
+            self.segments[-1].recover(self.index_interval)
+            self.next_sequence = self.segments[-1].end_sequence
+        else:
+            self.segments.append(_Segment(self.path, 0))
+            self.next_sequence = 0
+
+    def _run_writer(self):
+        segment = self.segments[-1]
+        segment.open_for_writing()
+        last_sync = time.time()
+        pending_sync = False
+        stop = False
+        while not stop:
+            try:
+                if pending_sync:
+                    batches = [self._queue.get(timeout=self.fsync_interval)]
+                else:
+                    batches = [self._queue.get()]
+            except Queue.Empty:
+                batches = []
+            while True:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in batches:
+                stop = True
+            for batch in batches:
+                if batch is None:
+                    continue
+                if segment.written_size >= self.segment_max_bytes:
+                    segment = self._rotate(segment)
+                segment.write(batch, self.index_interval)
+                pending_sync = True
+            if pending_sync:
+                segment.flush()
+            if pending_sync and (stop or
+                                 time.time() - last_sync >= self.fsync_interval):
+                segment.sync()
+                last_sync = time.time()
+                pending_sync = False
+                self._apply_retention()
+        segment.close()
+
+    def _rotate(self, segment):
+        segment.flush()
+        segment.sync()
+        segment.close()
+        new_segment = _Segment(self.path, segment.end_sequence)
+        new_segment.open_for_writing()
+        with self._lock:
+            self.segments.append(new_segment)
+        self._apply_retention()
+        return new_segment
+
+    def _apply_retention(self):
+        deleted = []
+        with self._lock:
+            total = sum(segment.size for segment in self.segments)
+            limit = time.time() - self.max_age if self.max_age else None
+            while len(self.segments) > 1:
+                oldest = self.segments[0]
+                if ((self.max_bytes is not None and total > self.max_bytes)
+                    or (limit is not None and oldest.modified < limit)):
+                    total -= oldest.size
+                    deleted.append(self.segments.pop(0))
+                else:
+                    break
+        for segment in deleted:
+            logging.info('Event log: deleting segment ' + segment.filename)
+            segment.delete()
+
+
+class _Segment(object):
+    def __init__(self, path, first_sequence):
+        base = os.path.join(path, '{0:020d}'.format(first_sequence))
+        self.filename = base + '.log'
+        self.index_filename = base + '.idx'
+        self.first_sequence = first_sequence
+        self.num_events = 0
+        # Sparse index: list of (sequence, offset, event_id)
+        self.index = []
+        self._file = None
+        self._index_file = None
+        self._last_indexed = None
+        if os.path.exists(self.filename):
+            self.size = os.path.getsize(self.filename)
+            self.modified = os.path.getmtime(self.filename)
+            self._read_index()
+        else:
+            self.size = 0
+            self.modified = time.time()
+
+    @property
+    def end_sequence(self):
+        """Sequence number of the next event after this segment."""
+        return self.first_sequence + self.num_events
+
+    def recover(self, index_interval, truncate=True):
+        """Scans the end of the segment after an unclean shutdown.
+
+        Counts the events after the last index entry and removes an
+        incomplete event at the end of the segment, if any. If
+        'truncate' is False, the incomplete event is left in the file,
+        because it may be being written by another process.
+
+        """
+        self.index = [entry for entry in self.index if entry[1] < self.size]
+        if self.index:
+            sequence, offset, _ = self.index.pop()
+        else:
+            sequence, offset = self.first_sequence, 0
+        if self.index:
+            self._last_indexed = self.index[-1][1]
+        end = offset
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        for start, event_end, event_id in _scan_events(data):
+            if (self._last_indexed is None
+                or offset + start - self._last_indexed >= index_interval):
+                self.index.append((sequence, offset + start, event_id))
+                self._last_indexed = offset + start
+            sequence += 1
+            end = offset + event_end
+        self.num_events = sequence - self.first_sequence
+        if not truncate:
+            # The files belong to the process that writes them
+            self.size = end
+            return
+        if end < self.size:
+            logging.warning('Event log: truncating {0} at {1}'.format( \
+                                                    self.filename, end))
+            with open(self.filename, 'r+b') as f:
+                f.truncate(end)
+            self.size = end
+        self._rewrite_index()
+
+    def open_for_writing(self):
+        self._file = open(self.filename, 'ab')
+        self._index_file = open(self.index_filename, 'ab')
+        if self._last_indexed is None and self.index:
+            self._last_indexed = self.index[-1][1]
+        # Written, but maybe not flushed yet
+        self.written_size = self.size
+        self._written_events = self.num_events
+        self._pending_entries = []
+
+    def write(self, batch, index_interval):
+        offset = self.written_size
+        sequence = self.first_sequence + self._written_events
+        for event_id, data in batch:
+            if (self._last_indexed is None
+                or offset - self._last_indexed >= index_interval):
+                self._pending_entries.append((sequence, offset, event_id))
+                self._index_file.write('{0} {1} {2}\n'.format(sequence,
+                                                              offset,
+                                                              event_id))
+                self._last_indexed = offset
+            self._file.write(data)
+            offset += len(data)
+            sequence += 1
+        self.written_size = offset
+        self._written_events = sequence - self.first_sequence
+
+    def flush(self):
+        """Makes the written events visible to readers."""
+        self._file.flush()
+        self._index_file.flush()
+        self.index.extend(self._pending_entries)
+        self._pending_entries = []
+        self.num_events = self._written_events
+        self.size = self.written_size
+        self.modified = time.time()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        os.fsync(self._index_file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._index_file.close()
+            self._file = self._index_file = None
+
+    def delete(self):
+        for filename in (self.filename, self.index_filename):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def read_from(self, sequence):
+        """Returns the serialization of the events from 'sequence' on."""
+        offset = self.offset_of(max(sequence, self.first_sequence))
+        if offset is None:
+            return ''
+        data = self._map(offset)
+        if data is None:
+            return ''
+        try:
+            return data[offset:]
+        finally:
+            data.close()
+
+    def offset_of(self, sequence):
+        """Returns the offset of the event with the sequence number."""
+        if not self.first_sequence <= sequence < self.end_sequence:
+            return None
+        pos = bisect.bisect_right(self.index, (sequence, float('inf'))) - 1
+        entry_sequence, offset, _ = self.index[pos]
+        if entry_sequence == sequence:
+            return offset
+        data = self._map(offset)
+        if data is None:
+            return None
+        try:
+            for start, _, _ in _scan_events(data, offset):
+                if entry_sequence == sequence:
+                    return start
+                entry_sequence += 1
+        finally:
+            data.close()
+        return None
+
+    def find_event(self, event_id):
+        """Returns the sequence number of the event with 'event_id'."""
+        for sequence, _, indexed_id in self.index:
+            if indexed_id == event_id:
+                return sequence
+        data = self._map(0)
+        if data is None:
+            return None
+        try:
+            pattern = 'Event-Id: ' + event_id + '\r\n'
+            pos = data.rfind(pattern)
+            while pos != -1:
+                sequence = self._sequence_at(data, pos)
+                if sequence is not None:
+                    return sequence
+                # The text appeared inside the body of an event
+                pos = data.rfind(pattern, 0, pos)
+        finally:
+            data.close()
+        return None
+
+    def timestamp_at(self, offset):
+        """Returns the timestamp of the event at 'offset', or None."""
+        data = self._map(offset)
+        if data is None:
+            return None
+        try:
+            return _event_timestamp(data, offset)
+        finally:
+            data.close()
+
+    def find_time(self, timestamp):
+        """Returns the sequence number of the first event not older
+        than 'timestamp', or the end of the segment if there is none.
+
+        """
+        data = self._map(0)
+        if data is None:
+            return self.end_sequence
+        try:
+            # The last index entry older than 'timestamp'
+            low, high = 0, len(self.index)
+            while low < high:
+                middle = (low + high) // 2
+                entry_time = _event_timestamp(data, self.index[middle][1])
+                if entry_time is not None and entry_time < timestamp:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low == 0:
+                return self.first_sequence
+            sequence, offset, _ = self.index[low - 1]
+            for start, _, _ in _scan_events(data, offset):
+                event_time = _event_timestamp(data, start)
+                if event_time is not None and event_time >= timestamp:
+                    return sequence
+                sequence += 1
+            return self.end_sequence
+        finally:
+            data.close()
+
+    def _sequence_at(self, data, offset):
+        pos = bisect.bisect_right([entry[1] for entry in self.index],
+                                  offset) - 1
+        if pos < 0:
+            return None
+        sequence, start, _ = self.index[pos]
+        for event_start, _, _ in _scan_events(data, start):
+            if event_start == offset:
+                return sequence
+            elif event_start > offset:
+                break
+            sequence += 1
+        return None
+
+    def map(self):
+        """Returns a read-only memory map of the events in the segment.
+
+        The caller must close it. Returns None if the segment is empty.
+
+        """
+        if not self.size:
+            return None
+        with open(self.filename, 'rb') as f:
+            return mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+
+    def _map(self, offset):
+        if offset >= self.size:
+            return None
+        return self.map()
+
+    def _read_index(self):
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'rb') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and line.endswith('\n'):
+                        self.index.append((int(parts[0]), int(parts[1]),
+                                           parts[2]))
+
+    def _rewrite_index(self):
+        with open(self.index_filename, 'wb') as f:
+            for entry in self.index:
+                f.write('{0} {1} {2}\n'.format(*entry))
+
+
+def _crlf_headers(data):
+    """Returns a serialized event with CRLF endings in its header lines.
+
+    Raw events are serialized with the header lines they were
+    received with, which the deserializer accepts with LF endings.
+    The scans of the log, however, expect the CRLF endings
+    of the events serialized by ztreamy.
+
+    """
+    header_end = data.find('\r\n\r\n')
+    if (header_end != -1
+        and data.count('\n', 0, header_end) \
+            == data.count('\r\n', 0, header_end)):
+        return data
+    lines = []
+    pos = 0
+    while True:
+        eol = data.find('\n', pos)
+        if eol == -1:
+            return data
+        line = data[pos:eol]
+        if line.endswith('\r'):
+            line = line[:-1]
+        pos = eol + 1
+        if not line:
+            break
+        lines.append(line + '\r\n')
+    lines.append('\r\n')
+    lines.append(data[pos:])
+    return ''.join(lines)
+
+def _event_timestamp(data, offset):
+    # Timestamp, in seconds since the epoch, of the event at 'offset'
+    header_end = data.find('\r\n\r\n', offset)
+    if header_end == -1:
+        return None
+    for line in data[offset:header_end].split('\r\n'):
+        if line.startswith('Timestamp:'):
+            try:
+                return ztreamy.rfc3339_as_time(line[10:].strip())
+            except ztreamy.ZtreamyException:
+                return None
+    return None
+
+def _scan_events(data, offset=0):
+    """Yields the position of the events serialized in 'data'.
+
+    Yields tuples (start, end, event_id) for every complete event
+    from 'offset' on. It relies on the serialization of the events
+    written by ztreamy: CRLF line endings and a 'Body-Length' header.
+
+    """
+    size = len(data)
+    while offset < size:
+        header_end = data.find('\r\n\r\n', offset)
+        if header_end == -1:
+            return
+        event_id = None
+        body_length = 0
+        for line in data[offset:header_end].split('\r\n'):
+            header, _, value = line.partition(':')
+            if header == 'Event-Id':
+                event_id = value.strip()
+            elif header == 'Body-Length':
+                body_length = int(value)
+        end = header_end + 4 + body_length
+        if end > size:
+            return
+        yield offset, end, event_id
+        offset = end
@@ -21,6 +21,8 @@
 import logging
 import time
 import json
+import inspect
+import re
 
 import ztreamy
 from ztreamy import ZtreamyException
@@ -35,6 +37,13 @@ class Deserializer(object):
     events. When a partial event is at the end of a chunk, its data is
     maintained for the next parse attempt.
 
+    The buffer is a 'bytearray' with a read cursor: parsing an event
+    just advances the cursor, and the consumed prefix of the buffer
+    is discarded only when it grows beyond 'compaction_threshold'
+    bytes (or when the whole buffer has been consumed). Therefore,
+    the cost of parsing a chunk is linear in its size regardless of
+    how many events it contains.
+
     It maintains a context, so a separate deserialized must be used
     for each event client, in order to not mix the contexts of
     different events.
@@ -46,23 +55,43 @@ class Deserializer(object):
         events = deserializer.deserialize(new_data)
 
     """
+    compaction_threshold = 65536
+
     def __init__(self):
         """Creates a new 'Deserializer' object."""
         self.reset()
 
     def append_data(self, data):
-        """Appends new data to the data buffer of the deserializer."""
-        self._data = self._data + data
-        self._previous_len = len(self._data)
+        """Appends new data to the data buffer of the deserializer.
+
+        Unicode strings are encoded as UTF-8.
+
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if self._pos > 0:
+            if self._pos == len(self._data):
+                del self._data[:]
+                self._pos = 0
+            elif self._pos >= self.compaction_threshold:
+                del self._data[:self._pos]
+                self._pos = 0
+        self._data.extend(data)
+        self._consumed_mark = self._pos
 
     def data_consumed(self):
         """Amount of bytes consumed since the last 'append_data()'."""
-        return self._previous_len - len(self._data)
+        return self._pos - self._consumed_mark
+
+    def pending_data(self):
+        """Amount of bytes in the buffer not consumed yet."""
+        return len(self._data) - self._pos
 
     def reset(self):
         """Resets the state of the parser and discards pending data."""
-        self._data = ''
-        self.previous_len = 0
+        self._data = bytearray()
+        self._pos = 0
+        self._consumed_mark = 0
         self._event_reset()
         self.warning_lf_eol_reported = False
 
@@ -70,6 +99,7 @@ class Deserializer(object):
         """Method to be called internally after an event is read."""
         self._event = {}
         self._extra_headers = {}
+        self._raw_headers = None
         self._header_complete = False
 
     def deserialize(self, data, parse_body=True, complete=False):
@@ -85,7 +115,9 @@ class Deserializer(object):
         If 'parse_body' is True (the default value), the parser will
         deserialize also the body of the events according to their
         types. If not, their body will be stored only in their
-        serialized form (as a string).
+        serialized form (as a string). In that case, events of
+        syntaxes that are not always parsed (see 'register_syntax()'
+        in 'Event') are returned as 'RawEvent' objects.
 
         The list of deserialized event objects is returned. The list
         is empty when no events are deserialized.
@@ -98,7 +130,7 @@ class Deserializer(object):
         while event is not None:
             events.append(event)
             event = self.deserialize_next(parse_body=parse_body)
-        if complete and len(self._data) > 0:
+        if complete and self.pending_data() > 0:
             self.reset()
             raise ZtreamyException('Spurious data in the input event',
                                    'event_deserialize')
@@ -113,37 +145,29 @@ class Deserializer(object):
         If 'parse_body' is True (the default value), the parser will
         deserialize also the body of the events according to their
         types. If not, their body will be stored only in their
-        serialized form (as a string).
+        serialized form (as a string). In that case, events of
+        syntaxes that are not always parsed (see 'register_syntax()'
+        in 'Event') are returned as 'RawEvent' objects.
 
         """
-        # Read headers
-        pos = 0
-        while not self._header_complete and pos < len(self._data):
-            end = self._data.find('\n', pos)
-            if end == -1:
-                self._data = self._data[pos:]
+        # Memory views are created only temporarily, because the
+        # buffer cannot be resized while a view on it exists
+        data = self._data
+        pos = self._pos
+        # Read headers (only when the whole header block is available)
+        if not self._header_complete:
+            header_end, body_start = self._find_header_end(data, pos)
+            if header_end == -1:
                 return None
-            part = self._data[pos:end]
-            # End-of-line delimiter is CRLF; LF is accepted but deprecated
+            if header_end > pos:
+                block = memoryview(data)[pos:header_end + 1].tobytes()
+                if parse_body or not self._read_raw_headers(block):
+                    self._read_headers(block)
             if (not self.warning_lf_eol_reported
-                and (not part or part[-1] != '\r')):
-                self.warning_lf_eol_reported = True
-                logging.warning('LF end-of-line received, but CRLF expected. '
-                                'LF EOLs are deprecated.')
-            pos = end + 1
-            if not part or part == '\r':
-                self._header_complete = True
-                break
-            comps = part.split(':')
-            if len(comps) < 2:
-                    raise ZtreamyException('Event syntax error',
-                                           'event_deserialize')
-            header = comps[0].strip()
-            value = part[len(comps[0]) + 1:].strip()
-            self._update_header(header, value)
-        if not self._header_complete:
-            self._data = self._data[pos:]
-            return None
+                and body_start - header_end < 3):
+                self._warn_lf_eol()
+            self._header_complete = True
+            pos = self._pos = body_start
         if not 'Body-Length' in self._event:
             body_length = 0
         else:
@@ -154,13 +178,15 @@ class Deserializer(object):
             raise ZtreamyException('Missing headers in event',
                                    'event_deserialize')
         end = pos + int(body_length)
-        if end > len(self._data):
-            self._data = self._data[pos:]
+        if end > len(data):
             return None
-        body = self._data[pos:end]
-        self._data = self._data[end:]
-        if parse_body or self._event['Syntax'] in Event._always_parse:
-            event = Event.create( \
+        body = memoryview(data)[pos:end].tobytes()
+        self._pos = end
+        if self._raw_headers is not None:
+            event = RawEvent(self._raw_headers, body,
+                             self._event['Event-Id'], self._event['Syntax'])
+        elif parse_body or self._event['Syntax'] in Event._always_parse:
+            event = Event._create_trusted( \
                 self._event.get('Source-Id'),
                 self._event.get('Syntax'),
                 body,
@@ -180,7 +206,8 @@ class Deserializer(object):
                 aggregator_id=self._event.get('Aggregator-Ids', []),
                 event_type=self._event.get('Event-Type'),
                 timestamp=self._event.get('Timestamp'),
-                extra_headers=self._extra_headers)
+                extra_headers=self._extra_headers,
+                _trusted=True)
         self._event_reset()
         return event
 
@@ -200,6 +227,80 @@ class Deserializer(object):
                 if events:
                     yield events
 
+    def _read_headers(self, block):
+        lines = block.split('\n')
+        lines.pop()
+        for part in lines:
+            # End-of-line delimiter is CRLF; LF is accepted but deprecated
+            if (not self.warning_lf_eol_reported
+                and (not part or part[-1] != '\r')):
+                self._warn_lf_eol()
+            header, sep, value = part.partition(':')
+            if not sep:
+                raise ZtreamyException('Event syntax error',
+                                       'event_deserialize')
+            self._update_header(header.strip(), value.strip())
+
+    def _read_raw_headers(self, block):
+        """Prepares the creation of a 'RawEvent' from the header block.
+
+        Only the headers needed for delimiting the event and
+        for deciding whether it can be kept in its raw form are read.
+        Returns False if the event needs to be parsed normally.
+
+        """
+        event_id = _raw_header_value(block, 'Event-Id')
+        syntax = _raw_header_value(block, 'Syntax')
+        if (event_id is None or syntax is None
+            or syntax in Event._always_parse
+            or _find_raw_header(block, 'Source-Id') == -1):
+            return False
+        # Malformed blocks are parsed normally, which reports the error
+        if _malformed_header_line.search(block):
+            return False
+        names = _unique_header_line.findall(block)
+        if len(names) != len(set(names)):
+            return False
+        body_length = _raw_header_value(block, 'Body-Length')
+        if body_length is not None:
+            self._event['Body-Length'] = body_length
+        elif 'Body-Length' in block:
+            return False
+        self._event['Event-Id'] = event_id
+        self._event['Source-Id'] = None
+        self._event['Syntax'] = syntax
+        self._raw_headers = block
+        return True
+
+    def _find_header_end(self, data, pos):
+        """Locates the empty line that finishes the header block.
+
+        Returns a tuple with the position of the line feed of the last
+        header line and the position of the first byte of the body, or
+        (-1, -1) if the header block is not complete yet.
+
+        """
+        if data.startswith('\r\n', pos):
+            return pos, pos + 2
+        elif data.startswith('\n', pos):
+            return pos, pos + 1
+        end = data.find('\n\r\n', pos)
+        if end == -1:
+            lf_end = data.find('\n\n', pos)
+        else:
+            lf_end = data.find('\n\n', pos, end + 1)
+        if lf_end != -1:
+            return lf_end, lf_end + 2
+        elif end != -1:
+            return end, end + 3
+        else:
+            return -1, -1
+
+    def _warn_lf_eol(self):
+        self.warning_lf_eol_reported = True
+        logging.warning('LF end-of-line received, but CRLF expected. '
+                        'LF EOLs are deprecated.')
+
     def _update_header(self, header, value):
         if header not in Event.headers:
             self._extra_headers[header] = value
@@ -241,14 +342,24 @@ class JSONDeserializer(object):
         else:
             body = d['Body'].encode('utf-8')
         if ('Aggregator-Ids' in d
-            and not isinstance(d['Aggregator-Ids'], list)):
+            and (not isinstance(d['Aggregator-Ids'], list)
+                 or not all(isinstance(item, basestring)
+                            for item in d['Aggregator-Ids']))):
             raise ZtreamyException('Incorrect Aggregator-Id data',
                                    'event_deserialize')
         extra_headers = {}
-        for header in d:
-            if not header in Event.headers and header != 'Body':
-                extra_headers[header] = d[header]
-        event = Event.create(d['Source-Id'],
+        for header, value in d.iteritems():
+            if not header in Event.headers:
+                if header != 'Body':
+                    if not isinstance(value, basestring):
+                        raise ZtreamyException('Incorrect extra header value',
+                                               'event_deserialize')
+                    extra_headers[header] = value
+            elif value is not None and not isinstance(value, basestring):
+                if header != 'Aggregator-Ids':
+                    raise ZtreamyException('Incorrect header value',
+                                           'event_deserialize')
+        event = Event._create_trusted(d['Source-Id'],
                              d['Syntax'],
                              body,
                              event_id=d['Event-Id'],
@@ -266,10 +377,31 @@ class Event(object):
     It is intended to be subclassed for application-specific types
     of events.
 
+    The standard properties of events are stored in slots, and the
+    dictionary of extra headers is created only when the event
+    has extra headers, which reduces the memory used by each event.
+    The instance dictionary is still available for the attributes
+    subclasses and applications may add to events.
+
     """
+    __slots__ = (
+        'event_id',
+        'source_id',
+        'syntax',
+        'body',
+        'application_id',
+        'aggregator_id',
+        'event_type',
+        'timestamp',
+        '_extra_headers',
+        '_serialization_cache',
+        '_stamped',
+        '__dict__',
+    )
 
     _subclasses = {}
     _always_parse = []
+    _trusted_syntaxes = set()
     headers = (
         'Event-Id',
         'Source-Id',
@@ -301,6 +433,12 @@ class Event(object):
         Event._subclasses[syntax] = subclass
         if always_parse:
             Event._always_parse.append(syntax)
+        # Subclasses can be created through the trusted constructor
+        # only if they forward their keyword arguments to 'Event'
+        if inspect.getargspec(subclass.__init__).keywords is not None:
+            Event._trusted_syntaxes.add(syntax)
+        else:
+            Event._trusted_syntaxes.discard(syntax)
 
     @staticmethod
     def create(source_id, syntax, body, **kwargs):
@@ -318,9 +456,28 @@ class Event(object):
             subclass = Event
         return subclass(source_id, syntax, body, **kwargs)
 
+    @staticmethod
+    def _create_trusted(source_id, syntax, body, **kwargs):
+        """Like 'create()', but skips the validation of the headers.
+
+        Intended for the deserializers, which provide string values
+        for all the headers, a list of strings for the aggregator
+        ids and a dictionary for the extra headers that the new event
+        can keep.
+
+        """
+        if syntax in Event._subclasses:
+            subclass = Event._subclasses[syntax]
+            if syntax in Event._trusted_syntaxes:
+                kwargs['_trusted'] = True
+        else:
+            subclass = Event
+            kwargs['_trusted'] = True
+        return subclass(source_id, syntax, body, **kwargs)
+
     def __init__(self, source_id, syntax, body, event_id=None,
                  application_id=None, aggregator_id=[], event_type=None,
-                 timestamp=None, extra_headers=None):
+                 timestamp=None, extra_headers=None, _trusted=False):
         """Creates a new event.
 
         'body' must be the textual representation of the event, or an
@@ -330,13 +487,38 @@ class Event(object):
         subclass (e.g. an 'RDFEvent'), the static 'create()' method
         should be used instead.
 
+        The serializations of the event are cached. Setting any
+        attribute, 'set_extra_header()' and 'append_aggregator_id()'
+        invalidate the cache, but modifications made in place to
+        mutable attributes (e.g. the list of aggregator ids, the
+        dictionary of extra headers or an RDF graph in the body) are
+        not detected. Call 'clear_serialization_cache()' after such
+        modifications.
+
         """
+        if _trusted:
+            # Fast path for the deserializers: no type checking
+            _set = object.__setattr__
+            _set(self, '_serialization_cache', None)
+            _set(self, '_stamped', False)
+            _set(self, 'event_id', event_id or ztreamy.random_id())
+            _set(self, 'source_id', source_id)
+            _set(self, 'syntax', syntax)
+            _set(self, 'body', body)
+            _set(self, 'aggregator_id', aggregator_id or [])
+            _set(self, 'event_type', event_type)
+            _set(self, 'timestamp', timestamp or ztreamy.get_timestamp())
+            _set(self, 'application_id', application_id)
+            _set(self, '_extra_headers', extra_headers or None)
+            return
+        self._serialization_cache = None
+        self._stamped = False
         self.event_id = event_id or ztreamy.random_id()
         self.source_id = source_id
         self.syntax = syntax
         self.body = body
         if aggregator_id is None:
-            aggregator_id = []
+            self.aggregator_id = []
         elif type(aggregator_id) is not list:
             self.aggregator_id = [str(aggregator_id)]
         else:
@@ -344,12 +526,23 @@ class Event(object):
         self.event_type = event_type
         self.timestamp = timestamp or ztreamy.get_timestamp()
         self.application_id = application_id
-        self.extra_headers = {}
+        self._extra_headers = None
         if extra_headers is not None:
             # Do this in order to ensure type checking
             for header, value in extra_headers.iteritems():
                 self.set_extra_header(header, value)
 
+    @property
+    def extra_headers(self):
+        """Dictionary with the extra headers of the event."""
+        if self._extra_headers is None:
+            object.__setattr__(self, '_extra_headers', {})
+        return self._extra_headers
+
+    @extra_headers.setter
+    def extra_headers(self, value):
+        self._extra_headers = value
+
     def __setattr__(self, name, value):
         """Check the values of some event properties."""
         if (name in Event._string_properties
@@ -364,6 +557,8 @@ class Event(object):
                     if not isinstance(item, basestring):
                         raise ValueError('Aggregator ids must be strings')
         super(Event, self).__setattr__(name, value)
+        if name != '_serialization_cache':
+            super(Event, self).__setattr__('_serialization_cache', None)
 
     def set_extra_header(self, header, value):
         """Adds an extra header to the event."""
@@ -373,10 +568,91 @@ class Event(object):
         if header in Event.headers or header == 'Body':
             raise ValueError('Reserved extra heder name: ' + header)
         self.extra_headers[header] = value
+        self._serialization_cache = None
+
+    def get_extra_header(self, header, default=None):
+        """Returns the value of an extra header, or 'default'."""
+        if self._extra_headers is None:
+            return default
+        return self._extra_headers.get(header, default)
+
+    def sequence_number(self):
+        """Returns the sequence number the stream gave to the event.
+
+        Returns None if the event has no sequence number.
+
+        """
+        seq = self.get_extra_header(ztreamy.sequence_header)
+        if seq is None or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def stamp_sequence_number(self, seq):
+        """Stamps the event with the sequence number a stream gives to it.
+
+        An event already stamped by a stream of this process is kept
+        unmodified, because that stream holds it in its buffers and
+        event log. A copy of the event is stamped and returned
+        instead. Otherwise, the event itself is returned.
+
+        """
+        event = self.copy() if self._stamped else self
+        event.set_extra_header(ztreamy.sequence_header, str(seq))
+        object.__setattr__(event, '_stamped', True)
+        return event
+
+    def copy(self):
+        """Returns a shallow copy of the event.
+
+        The body is shared with the original event, but the list of
+        aggregator ids and the dictionary of extra headers are copied,
+        so that they can be modified independently.
+
+        """
+        cls = type(self)
+        new = cls.__new__(cls)
+        _get = object.__getattribute__
+        _set = object.__setattr__
+        for name in _slot_names(cls):
+            try:
+                value = _get(self, name)
+            except AttributeError:
+                # Unset slot (e.g. a header of a raw event not decoded)
+                continue
+            if type(value) is list:
+                value = list(value)
+            elif type(value) is dict:
+                value = dict(value)
+            _set(new, name, value)
+        if self.__dict__:
+            new.__dict__.update(self.__dict__)
+        _set(new, '_serialization_cache', None)
+        _set(new, '_stamped', False)
+        return new
 
     def append_aggregator_id(self, aggregator_id):
         """Appends a new aggregator id to the event."""
         self.aggregator_id.append(aggregator_id)
+        self._serialization_cache = None
+
+    def clear_serialization_cache(self):
+        """Discards the cached serializations of the event.
+
+        It needs to be called only after modifying in place a mutable
+        attribute of an event that has already been serialized.
+
+        """
+        self._serialization_cache = None
+
+    def check_body(self):
+        """Checks that the body of the event is well formed.
+
+        Events whose body is parsed upon first access (e.g. RDF
+        events) parse it now. Raises a 'ZtreamyException' if the
+        body cannot be parsed.
+
+        """
+        pass
 
     def __str__(self):
         """Returns the string serialization of the event."""
@@ -428,8 +704,9 @@ class Event(object):
             data['Event-Type'] = self.event_type
         if self.timestamp is not None:
             data['Timestamp'] = self.timestamp
-        for header, value in self.extra_headers.iteritems():
-            data[header] = value
+        if self._extra_headers:
+            for header, value in self._extra_headers.iteritems():
+                data[header] = value
         if json:
             body = self.body_as_json()
             syntax = self.syntax_as_json()
@@ -453,9 +730,28 @@ class Event(object):
         return None
 
     def serialize_json(self):
-        return json.dumps(self.as_json())
+        """Returns the JSON serialization of the event (cached)."""
+        return self._cached_serialization(ztreamy.SERIALIZATION_JSON,
+                                          self._serialize_json)
 
     def _serialize(self):
+        """Returns the ztreamy serialization of the event (cached)."""
+        return self._cached_serialization(ztreamy.SERIALIZATION_ZTREAMY,
+                                          self._serialize_ztreamy)
+
+    def _cached_serialization(self, serialization, serialize_func):
+        cache = self._serialization_cache
+        if cache is None:
+            cache = self._serialization_cache = {}
+        elif serialization in cache:
+            return cache[serialization]
+        data = cache[serialization] = serialize_func()
+        return data
+
+    def _serialize_json(self):
+        return json.dumps(self.as_json())
+
+    def _serialize_ztreamy(self):
         data = []
         data.append('Event-Id: ' + str(self.event_id))
         data.append('Source-Id: ' + str(self.source_id))
@@ -469,8 +765,9 @@ class Event(object):
             data.append('Event-Type: ' + str(self.event_type))
         if self.timestamp is not None:
             data.append('Timestamp: ' + str(self.timestamp))
-        for header, value in self.extra_headers.iteritems():
-            data.append(str(header) + ': ' + str(value))
+        if self._extra_headers:
+            for header, value in self._extra_headers.iteritems():
+                data.append(str(header) + ': ' + str(value))
         serialized_body = self.serialize_body()
         data.append('Body-Length: ' + str(len(serialized_body)))
         data.append('')
@@ -485,6 +782,8 @@ class Command(Event):
     to the rest of the application.
 
     """
+    __slots__ = ('command', )
+
     valid_commands = [
         'Test-Connection',
         'Event-Source-Started',
@@ -519,6 +818,8 @@ class TestEvent(Event):
     The event encapsulates a sequence number and a timestamp.
 
     """
+    __slots__ = ('float_time', 'sequence_num')
+
     def __init__(self, source_id, syntax, body, sequence_num=0, **kwargs):
         """Creates a new command event.
 
@@ -555,6 +856,7 @@ Event.register_syntax('ztreamy-test', TestEvent, always_parse=True)
 
 class JSONEvent(Event):
     """Event consisting of a JSON object."""
+    __slots__ = ()
 
     supported_syntaxes = [ztreamy.json_media_type]
 
@@ -581,8 +883,226 @@ for syntax in JSONEvent.supported_syntaxes:
     Event.register_syntax(syntax, JSONEvent, always_parse=True)
 
 
+class RawEvent(Event):
+    """Event that keeps the serialized form it was received in.
+
+    The deserializer creates these events when it is asked not to
+    parse event bodies, which is the normal case in relays. Only the
+    'event_id' and 'syntax' headers are read upon creation. The rest
+    of the headers are decoded the first time one of them is
+    accessed. Unless a header is modified, the event is serialized by
+    copying its original data, with just the new aggregator ids
+    appended, which is much cheaper than serializing the event again.
+
+    Instances should not be created directly from user code.
+
+    """
+    __slots__ = (
+        '_raw_headers',
+        '_decoded',
+        '_modified',
+        '_new_aggregator_ids',
+    )
+
+    _lazy_properties = (
+        'source_id',
+        'application_id',
+        'aggregator_id',
+        'event_type',
+        'timestamp',
+        '_extra_headers',
+    )
+
+    def __init__(self, raw_headers, body, event_id, syntax):
+        """Creates a new raw event.
+
+        'raw_headers' is the serialized header block, including the
+        end of line of the last header but not the empty line that
+        finishes the block. 'body' is the serialized body.
+
+        """
+        _set = object.__setattr__
+        _set(self, '_raw_headers', raw_headers)
+        _set(self, '_decoded', False)
+        _set(self, '_modified', False)
+        _set(self, '_new_aggregator_ids', [])
+        _set(self, '_serialization_cache', None)
+        _set(self, '_stamped', False)
+        _set(self, 'event_id', event_id)
+        _set(self, 'syntax', syntax)
+        _set(self, 'body', body)
+
+    def __getattr__(self, name):
+        # Called only for the attributes that are still unset
+        if name in RawEvent._lazy_properties and not self._decoded:
+            self._decode_headers()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if (name in RawEvent._lazy_properties
+            or name in ('event_id', 'syntax', 'body', 'extra_headers')):
+            if not self._decoded:
+                self._decode_headers()
+            object.__setattr__(self, '_modified', True)
+        super(RawEvent, self).__setattr__(name, value)
+
+    def set_extra_header(self, header, value):
+        """Adds an extra header to the event."""
+        if (not self._decoded and isinstance(header, basestring)
+            and isinstance(value, basestring) and value
+            and header not in Event.headers and header != 'Body'):
+            # Replace the header line without decoding the headers
+            _set = object.__setattr__
+            _set(self, '_raw_headers',
+                 _set_raw_header(self._raw_headers, header, value))
+            _set(self, '_serialization_cache', None)
+            return
+        if not self._decoded:
+            self._decode_headers()
+        super(RawEvent, self).set_extra_header(header, value)
+        object.__setattr__(self, '_modified', True)
+
+    def get_extra_header(self, header, default=None):
+        """Returns the value of an extra header, or 'default'."""
+        if self._decoded:
+            return super(RawEvent, self).get_extra_header(header, default)
+        value = _raw_header_value(self._raw_headers, header)
+        if value is None:
+            return default
+        return value
+
+    def append_aggregator_id(self, aggregator_id):
+        """Appends a new aggregator id to the event."""
+        if self._decoded:
+            super(RawEvent, self).append_aggregator_id(aggregator_id)
+        else:
+            self._new_aggregator_ids.append(aggregator_id)
+            object.__setattr__(self, '_serialization_cache', None)
+
+    def _serialize_ztreamy(self):
+        if self._modified:
+            return super(RawEvent, self)._serialize_ztreamy()
+        raw_headers = self._raw_headers
+        if self._decoded:
+            raw_headers = _set_raw_header(raw_headers, 'Aggregator-Ids',
+                                   ','.join(str(s) for s in self.aggregator_id))
+        elif self._new_aggregator_ids:
+            aggregator_ids = [str(s) for s in self._new_aggregator_ids]
+            value = _raw_header_value(raw_headers, 'Aggregator-Ids')
+            if value:
+                aggregator_ids.insert(0, value)
+            raw_headers = _set_raw_header(raw_headers, 'Aggregator-Ids',
+                                          ','.join(aggregator_ids))
+        return raw_headers + '\r\n' + self.body
+
+    def _decode_headers(self):
+        values = {}
+        extra_headers = {}
+        for part in self._raw_headers.splitlines():
+            header, sep, value = part.partition(':')
+            if not sep:
+                raise ZtreamyException('Event syntax error',
+                                       'event_deserialize')
+            header = header.strip()
+            value = value.strip()
+            if header not in Event.headers:
+                extra_headers[header] = value
+            elif header not in values or header == 'Aggregator-Ids':
+                values[header] = value
+            else:
+                raise ZtreamyException('Duplicate header in event',
+                                       'event_deserialize')
+        if 'Aggregator-Ids' in values:
+            aggregator_id = parse_aggregator_id(values['Aggregator-Ids'])
+        else:
+            aggregator_id = []
+        aggregator_id.extend(self._new_aggregator_ids)
+        _set = object.__setattr__
+        _set(self, 'source_id', values.get('Source-Id'))
+        _set(self, 'application_id', values.get('Application-Id'))
+        _set(self, 'aggregator_id', aggregator_id)
+        _set(self, 'event_type', values.get('Event-Type'))
+        _set(self, 'timestamp', values.get('Timestamp'))
+        _set(self, '_extra_headers', extra_headers or None)
+        _set(self, '_decoded', True)
+        _set(self, '_new_aggregator_ids', [])
+
+
+_slot_names_cache = {}
+
+def _slot_names(cls):
+    """Returns the names of the slots of an event class and its bases."""
+    names = _slot_names_cache.get(cls)
+    if names is None:
+        names = []
+        for class_ in cls.__mro__:
+            slots = class_.__dict__.get('__slots__', ())
+            if isinstance(slots, basestring):
+                slots = (slots, )
+            names.extend(name for name in slots if name != '__dict__')
+        _slot_names_cache[cls] = names
+    return names
+
 def create_command(source_id, command):
     return Command(source_id, 'ztreamy-command', command)
 
 def parse_aggregator_id(data):
     return [v.strip() for v in data.split(',') if v != '']
+
+def _find_raw_header(raw_headers, header):
+    """Returns the position of a header line in a raw header block.
+
+    If the header is repeated, the position of its last line is
+    returned, because the value of the last line is the one that
+    the parser keeps. Returns -1 if the header is not found.
+
+    """
+    pos = raw_headers.rfind('\n' + header + ':')
+    if pos != -1:
+        return pos + 1
+    elif raw_headers.startswith(header + ':'):
+        return 0
+    else:
+        return -1
+
+# Header lines without a colon
+_malformed_header_line = re.compile(r'^[^:\n]*\n', re.M)
+
+# Lines of the headers that cannot be repeated
+_unique_header_line = re.compile(r'^[ \t]*(' + '|'.join( \
+                        re.escape(header) for header in Event.headers
+                        if header != 'Aggregator-Ids') + r')[ \t]*:', re.M)
+
+def _raw_header_value(raw_headers, header):
+    """Returns the value of a header in a raw header block, or None."""
+    start = _find_raw_header(raw_headers, header)
+    if start == -1:
+        return None
+    end = raw_headers.find('\n', start)
+    return raw_headers[start + len(header) + 1:end].strip()
+
+def _set_raw_header(raw_headers, header, value):
+    """Returns a raw header block with a header line replaced.
+
+    The line is added if the header was not present, and removed if
+    'value' is empty. If the header was repeated, all its lines are
+    replaced by the new one.
+
+    """
+    if value:
+        line = header + ': ' + value + '\r\n'
+    else:
+        line = ''
+    start = _find_raw_header(raw_headers, header)
+    if start == -1:
+        return raw_headers + line
+    end = raw_headers.find('\n', start) + 1
+    raw_headers = raw_headers[:start] + line + raw_headers[end:]
+    # Lines of the header before the replaced one
+    start = _find_raw_header(raw_headers[:start], header)
+    while start != -1:
+        end = raw_headers.find('\n', start) + 1
+        raw_headers = raw_headers[:start] + raw_headers[end:]
+        start = _find_raw_header(raw_headers[:start], header)
+    return raw_headers
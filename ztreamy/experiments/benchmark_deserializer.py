@@ -0,0 +1,139 @@
+# ztreamy: a framework for publishing semantic events on the Web
+# Copyright (C) 2011-2015 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+"""Compares the deserializer with the previous string-based buffer.
+
+The previous implementation appended every chunk to a string and
+sliced the string again after every event, which made the cost of
+parsing a chunk quadratic in the number of events it contained.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+import time
+from optparse import OptionParser
+
+import ztreamy
+from ztreamy import events
+
+
+class ConcatenatingDeserializer(events.Deserializer):
+    """Deserializer with the buffer management of ztreamy 0.4.2.
+
+    Used only as a baseline for the benchmark.
+
+    """
+    def append_data(self, data):
+        self._legacy_data = self._legacy_data + data
+
+    def pending_data(self):
+        return len(self._legacy_data)
+
+    def reset(self):
+        super(ConcatenatingDeserializer, self).reset()
+        self._legacy_data = ''
+
+    def deserialize_next(self, parse_body=True):
+        pos = 0
+        while not self._header_complete and pos < len(self._legacy_data):
+            end = self._legacy_data.find('\n', pos)
+            if end == -1:
+                self._legacy_data = self._legacy_data[pos:]
+                return None
+            part = self._legacy_data[pos:end]
+            pos = end + 1
+            if not part or part == '\r':
+                self._header_complete = True
+                break
+            comps = part.split(':')
+            header = comps[0].strip()
+            value = part[len(comps[0]) + 1:].strip()
+            self._update_header(header, value)
+        if not self._header_complete:
+            self._legacy_data = self._legacy_data[pos:]
+            return None
+        body_length = int(self._event.get('Body-Length', 0))
+        end = pos + body_length
+        if end > len(self._legacy_data):
+            self._legacy_data = self._legacy_data[pos:]
+            return None
+        body = self._legacy_data[pos:end]
+        self._legacy_data = self._legacy_data[end:]
+        event = events.Event( \
+                self._event.get('Source-Id'),
+                self._event.get('Syntax'),
+                body,
+                event_id=self._event.get('Event-Id'),
+                application_id=self._event.get('Application-Id'),
+                aggregator_id=self._event.get('Aggregator-Ids', []),
+                event_type=self._event.get('Event-Type'),
+                timestamp=self._event.get('Timestamp'),
+                extra_headers=self._extra_headers)
+        self._event_reset()
+        return event
+
+
+def create_data(num_events, body_size):
+    source_id = ztreamy.random_id()
+    body = 'x' * body_size
+    evs = [events.Event(source_id, 'text/plain', body,
+                        application_id='benchmark')
+           for _ in range(num_events)]
+    return ztreamy.serialize_events(evs)
+
+def run(deserializer, data, chunk_size):
+    num_events = 0
+    t0 = time.time()
+    for pos in range(0, len(data), chunk_size):
+        evs = deserializer.deserialize(data[pos:pos + chunk_size],
+                                       parse_body=False)
+        num_events += len(evs)
+    return num_events, time.time() - t0
+
+def read_cmd_options():
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option('-n', '--num-events', dest='num_events', type='int',
+                      default=20000, help='number of events to parse')
+    parser.add_option('-b', '--body-size', dest='body_size', type='int',
+                      default=100, help='size of the body of the events')
+    parser.add_option('-c', '--chunk-sizes', dest='chunk_sizes',
+                      default='1024,65536,1048576',
+                      help='comma-separated list of chunk sizes')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments')
+    options.chunk_sizes = [int(s) for s in options.chunk_sizes.split(',')]
+    return options
+
+def main():
+    options = read_cmd_options()
+    data = create_data(options.num_events, options.body_size)
+    print('{0} events, {1} bytes'.format(options.num_events, len(data)))
+    print('chunk\timplementation\tevents/s\tMB/s')
+    for chunk_size in options.chunk_sizes:
+        for name, class_ in (('bytearray', events.Deserializer),
+                             ('concatenation', ConcatenatingDeserializer)):
+            num_events, elapsed = run(class_(), data, chunk_size)
+            assert num_events == options.num_events
+            print('{0}\t{1}\t{2:.0f}\t{3:.2f}'.format( \
+                                chunk_size, name,
+                                num_events / elapsed,
+                                len(data) / elapsed / 1048576))
+
+if __name__ == "__main__":
+    main()
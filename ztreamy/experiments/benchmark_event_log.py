@@ -0,0 +1,95 @@
+# ztreamy: a framework for publishing semantic events on the Web
+# Copyright (C) 2011-2015 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+"""Measures how fast the persistent event log stores events.
+
+The events are appended in batches, as the server does after every
+buffering period. The benchmark reports the time the caller spends
+in 'append()' (which is the time the server is blocked) and the
+throughput of the writer thread until all the events are on disk.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+import ztreamy
+from ztreamy import events
+from ztreamy.eventlog import EventLog
+
+
+def create_batches(num_events, batch_size, body_size):
+    source_id = ztreamy.random_id()
+    body = 'x' * body_size
+    evs = [events.Event(source_id, 'text/plain', body,
+                        application_id='benchmark')
+           for _ in range(num_events)]
+    # Serialize them in advance, as the dispatchers of the server do
+    for event in evs:
+        str(event)
+    return [evs[i:i + batch_size] for i in range(0, num_events, batch_size)]
+
+def run(path, batches, fsync_interval):
+    log = EventLog(path, fsync_interval=fsync_interval)
+    t0 = time.time()
+    append_time = 0.0
+    for batch in batches:
+        t1 = time.time()
+        log.append(batch)
+        append_time += time.time() - t1
+    log.close()
+    return append_time, time.time() - t0
+
+def read_cmd_options():
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option('-n', '--num-events', dest='num_events', type='int',
+                      default=200000, help='number of events to store')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+                      default=50, help='number of events per batch')
+    parser.add_option('-s', '--body-size', dest='body_size', type='int',
+                      default=500, help='size of the body of the events')
+    parser.add_option('-f', '--fsync-interval', dest='fsync_interval',
+                      type='float', default=1.0,
+                      help='maximum time between fsync calls (s)')
+    parser.add_option('-d', '--directory', dest='directory', default=None,
+                      help='directory in which the log is created '
+                           '(a temporary directory by default)')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments')
+    return options
+
+def main():
+    options = read_cmd_options()
+    batches = create_batches(options.num_events, options.batch_size,
+                             options.body_size)
+    path = tempfile.mkdtemp(dir=options.directory)
+    try:
+        append_time, total_time = run(path, batches, options.fsync_interval)
+    finally:
+        shutil.rmtree(path)
+    print('append: {0:.0f} events/s'.format(options.num_events
+                                            / append_time))
+    print('on disk: {0:.0f} events/s'.format(options.num_events
+                                             / total_time))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# ztreamy: a framework for publishing semantic events on the Web
+# Copyright (C) 2011-2015 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+"""Measures the memory used by events and how fast they are created.
+
+The memory of an event is the size of the event object and the
+containers it owns (instance dictionary, list of aggregator ids and
+dictionary of extra headers), excluding the strings, which are the
+same for every layout. The previous layout, with all the properties
+in the instance dictionary, is included as a baseline.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import time
+from optparse import OptionParser
+
+import ztreamy
+from ztreamy import events
+
+
+class DictLayoutEvent(object):
+    """Event with the memory layout of ztreamy 0.4.2.
+
+    Used only as a baseline for the benchmark.
+
+    """
+    def __init__(self, source_id, syntax, body, event_id=None,
+                 application_id=None, aggregator_id=[], event_type=None,
+                 timestamp=None, extra_headers=None):
+        self.event_id = event_id
+        self.source_id = source_id
+        self.syntax = syntax
+        self.body = body
+        self.aggregator_id = list(aggregator_id)
+        self.event_type = event_type
+        self.timestamp = timestamp
+        self.application_id = application_id
+        self.extra_headers = dict(extra_headers or {})
+
+
+def event_size(event):
+    size = sys.getsizeof(event)
+    if hasattr(event, '__dict__'):
+        size += sys.getsizeof(event.__dict__)
+    size += sys.getsizeof(event.aggregator_id)
+    if isinstance(event, events.Event):
+        extra_headers = event._extra_headers
+    else:
+        extra_headers = event.extra_headers
+    if extra_headers is not None:
+        size += sys.getsizeof(extra_headers)
+    return size
+
+def create_kwargs(num_events):
+    source_id = ztreamy.random_id()
+    timestamp = ztreamy.get_timestamp()
+    return [dict(source_id=source_id,
+                 syntax='text/plain',
+                 body='x' * 100,
+                 event_id=ztreamy.random_id(),
+                 application_id='benchmark',
+                 aggregator_id=[source_id],
+                 timestamp=timestamp)
+            for _ in range(num_events)]
+
+def run_constructor(constructor, all_kwargs):
+    t0 = time.time()
+    evs = [constructor(**kwargs) for kwargs in all_kwargs]
+    elapsed = time.time() - t0
+    return evs, elapsed
+
+def run_deserializer(data, num_events):
+    deserializer = events.Deserializer()
+    t0 = time.time()
+    evs = deserializer.deserialize(data, complete=True)
+    elapsed = time.time() - t0
+    assert len(evs) == num_events
+    return evs, elapsed
+
+def read_cmd_options():
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option('-n', '--num-events', dest='num_events', type='int',
+                      default=100000, help='number of events to create')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments')
+    return options
+
+def main():
+    options = read_cmd_options()
+    all_kwargs = create_kwargs(options.num_events)
+    results = [
+        ('dict layout', run_constructor(DictLayoutEvent, all_kwargs)),
+        ('Event()', run_constructor(events.Event, all_kwargs)),
+        ('trusted', run_constructor(events.Event._create_trusted,
+                                    all_kwargs)),
+    ]
+    data = ztreamy.serialize_events(results[1][1][0])
+    results.append(('deserializer',
+                    run_deserializer(data, options.num_events)))
+    print('implementation\tbytes/event\tevents/s')
+    for name, (evs, elapsed) in results:
+        size = sum(event_size(e) for e in evs) / len(evs)
+        print('{0}\t{1:.0f}\t{2:.0f}'.format(name, size,
+                                             len(evs) / elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# ztreamy: a framework for publishing semantic events on the Web
+# Copyright (C) 2011-2015 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+"""Compares the filter router with evaluating every filter.
+
+A set of subscriptions (source, application and event type filters,
+as for per-device and per-tenant consumers) receives a sequence of
+events. The benchmark reports how many events per second are routed
+to the subscriptions by calling the 'filter_event()' method of every
+filter and by a 'FilterRouter'. Both must deliver the same events.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+import time
+import random
+from optparse import OptionParser
+
+from ztreamy import events
+from ztreamy import filters
+
+
+class _Counter(object):
+    def __init__(self):
+        self.count = 0
+
+    def callback(self, event):
+        self.count += 1
+
+
+def create_filters(num_filters, num_sources, num_applications,
+                   num_event_types):
+    rnd = random.Random(1234)
+    subscriptions = []
+    for i in range(num_filters):
+        counter = _Counter()
+        kind = i % 3
+        if kind == 0:
+            filter_ = filters.SourceFilter(counter.callback,
+                            source_id='source-{}'.format( \
+                                            rnd.randrange(num_sources)))
+        elif kind == 1:
+            filter_ = filters.ApplicationFilter(counter.callback,
+                            application_id='app-{}'.format( \
+                                            rnd.randrange(num_applications)))
+        else:
+            filter_ = filters.EventTypeFilter(counter.callback,
+                            ['type-{}'.format(rnd.randrange(num_event_types))],
+                            application_ids=['app-{}'.format( \
+                                            rnd.randrange(num_applications))])
+        subscriptions.append((filter_, counter))
+    return subscriptions
+
+def create_events(num_events, num_sources, num_applications,
+                  num_event_types):
+    rnd = random.Random(4321)
+    return [events.Event('source-{}'.format(rnd.randrange(num_sources)),
+                         'text/plain', 'x' * 100,
+                         application_id='app-{}'.format( \
+                                            rnd.randrange(num_applications)),
+                         event_type='type-{}'.format( \
+                                            rnd.randrange(num_event_types)))
+            for _ in range(num_events)]
+
+def run_all_filters(subscriptions, evs):
+    t0 = time.time()
+    for event in evs:
+        for filter_, _ in subscriptions:
+            filter_.filter_event(event)
+    return time.time() - t0
+
+def run_router(subscriptions, evs):
+    router = filters.FilterRouter(filters=[f for f, _ in subscriptions])
+    t0 = time.time()
+    router.filter_events(evs)
+    return time.time() - t0
+
+def _reset(subscriptions):
+    for _, counter in subscriptions:
+        counter.count = 0
+
+def read_cmd_options():
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option('-f', '--num-filters', dest='num_filters', type='int',
+                      default=10000, help='number of subscriptions')
+    parser.add_option('-n', '--num-events', dest='num_events', type='int',
+                      default=50000, help='number of events to route')
+    parser.add_option('-b', '--baseline-events', dest='baseline_events',
+                      type='int', default=500,
+                      help='number of events for evaluating every filter')
+    parser.add_option('-s', '--num-sources', dest='num_sources', type='int',
+                      default=20000, help='number of different sources')
+    parser.add_option('-a', '--num-applications', dest='num_applications',
+                      type='int', default=500,
+                      help='number of different applications')
+    parser.add_option('-t', '--num-event-types', dest='num_event_types',
+                      type='int', default=20,
+                      help='number of different event types')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments')
+    return options
+
+def main():
+    options = read_cmd_options()
+    subscriptions = create_filters(options.num_filters, options.num_sources,
+                                   options.num_applications,
+                                   options.num_event_types)
+    evs = create_events(options.num_events, options.num_sources,
+                        options.num_applications, options.num_event_types)
+    baseline_evs = evs[:options.baseline_events]
+    elapsed = run_all_filters(subscriptions, baseline_evs)
+    expected = [counter.count for _, counter in subscriptions]
+    _reset(subscriptions)
+    run_router(subscriptions, baseline_evs)
+    assert [counter.count for _, counter in subscriptions] == expected
+    _reset(subscriptions)
+    print('{} filters'.format(options.num_filters))
+    print('implementation\tevents\tevents/s\tdeliveries/event')
+    print('all filters\t{}\t{:.0f}\t{:.2f}'.format( \
+                                len(baseline_evs),
+                                len(baseline_evs) / elapsed,
+                                sum(expected) / len(baseline_evs)))
+    elapsed = run_router(subscriptions, evs)
+    deliveries = sum(counter.count for _, counter in subscriptions)
+    print('router\t{}\t{:.0f}\t{:.2f}'.format(len(evs), len(evs) / elapsed,
+                                              deliveries / len(evs)))
+
+if __name__ == "__main__":
+    main()
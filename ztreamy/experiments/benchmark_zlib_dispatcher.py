@@ -0,0 +1,174 @@
+# ztreamy: a framework for publishing semantic events on the Web
+# Copyright (C) 2011-2015 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+"""Compares the two compression modes of the zlib dispatcher.
+
+A stream of batches of events is dispatched while new clients join
+the stream (a reconnection storm at the beginning, followed by a few
+new clients now and then). The benchmark reports the CPU time spent
+by the dispatcher, the number of times batches were compressed and
+the compression ratio seen by the clients.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+import time
+import zlib
+import random
+from optparse import OptionParser
+
+import ztreamy
+from ztreamy import events
+from ztreamy import dispatchers
+from ztreamy.dispatchers import ClientPropertiesFactory, ClientProperties
+
+
+class _Stream(object):
+    path = '/benchmark'
+
+
+class _Client(object):
+    def __init__(self, properties, keep_data=False):
+        self.properties = properties
+        self.is_fresh = True
+        self.keep_data = keep_data
+        self.data = []
+        self.num_bytes = 0
+
+    def send(self, data, flush=True):
+        self.num_bytes += len(data)
+        if self.keep_data:
+            self.data.append(data)
+        if data:
+            self.is_fresh = False
+
+    def close(self):
+        pass
+
+
+class _CountingGroup(dispatchers.SubscriptionGroup):
+    compressions = 0
+
+    def dispatch(self, events_pack):
+        if len(self.subscriptions):
+            _CountingGroup.compressions += 1
+        super(_CountingGroup, self).dispatch(events_pack)
+
+
+def create_batches(num_batches, batch_size, body_size):
+    source_id = ztreamy.random_id()
+    rnd = random.Random(1234)
+    words = ['temperature', 'humidity', 'sensor', 'room', 'value',
+             'status', 'ok', 'alarm', 'battery', 'level']
+    batches = []
+    for _ in range(num_batches):
+        evs = []
+        for _ in range(batch_size):
+            body = ' '.join(rnd.choice(words) for _ in range(body_size // 7))
+            evs.append(events.Event(source_id, 'text/plain', body,
+                                    application_id='benchmark'))
+        batches.append(evs)
+    return batches
+
+def run(batches, shared_compression, storm_batches, storm_clients,
+        join_period):
+    properties = ClientPropertiesFactory.create( \
+                                streaming=True,
+                                encoding=ClientProperties.ENCODING_ZLIB)
+    # Make the dispatcher create groups that count compressions
+    dispatchers.SubscriptionGroup = _CountingGroup
+    _CountingGroup.compressions = 0
+    try:
+        return _run(batches, properties, shared_compression,
+                    storm_batches, storm_clients, join_period)
+    finally:
+        dispatchers.SubscriptionGroup = _CountingGroup.__bases__[0]
+
+def _run(batches, properties, shared_compression, storm_batches,
+         storm_clients, join_period):
+    dispatcher = dispatchers.ZlibDispatcher(_Stream(), properties,
+                                    shared_compression=shared_compression)
+    clients = []
+    received = []
+    elapsed = 0.0
+    for i, evs in enumerate(batches):
+        if i < storm_batches:
+            new_clients = storm_clients
+        elif i % join_period == 0:
+            new_clients = 1
+        else:
+            new_clients = 0
+        for _ in range(new_clients):
+            client = _Client(properties, keep_data=(len(clients) % 50 == 0))
+            clients.append(client)
+            received.append(0)
+            dispatcher.subscribe(client)
+        pack = dispatchers.EventsPack(evs)
+        serialized = pack.serialize(properties.serialization)
+        t0 = time.clock()
+        dispatcher.dispatch(pack)
+        elapsed += time.clock() - t0
+        for j in range(len(clients)):
+            received[j] += len(serialized)
+    # Check that the clients can decompress what they received
+    for client, num_bytes in zip(clients, received):
+        if client.keep_data:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(''.join(client.data))
+            assert len(data) == num_bytes
+    compressed = sum(client.num_bytes for client in clients)
+    return elapsed, _CountingGroup.compressions, compressed / sum(received)
+
+def read_cmd_options():
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option('-n', '--num-batches', dest='num_batches', type='int',
+                      default=1000, help='number of batches of events')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int',
+                      default=5, help='number of events per batch')
+    parser.add_option('-s', '--body-size', dest='body_size', type='int',
+                      default=200, help='size of the body of the events')
+    parser.add_option('-c', '--storm-clients', dest='storm_clients',
+                      type='int', default=20,
+                      help='clients joining in each batch of the storm')
+    parser.add_option('-t', '--storm-batches', dest='storm_batches',
+                      type='int', default=50,
+                      help='number of batches the storm lasts')
+    parser.add_option('-p', '--join-period', dest='join_period',
+                      type='int', default=25,
+                      help='a client joins every this number of batches '
+                           'after the storm')
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments')
+    return options
+
+def main():
+    options = read_cmd_options()
+    batches = create_batches(options.num_batches, options.batch_size,
+                             options.body_size)
+    print('mode\tCPU (s)\tcompressions\tratio')
+    for name, shared in (('groups', False), ('shared', True)):
+        elapsed, compressions, ratio = run(batches, shared,
+                                           options.storm_batches,
+                                           options.storm_clients,
+                                           options.join_period)
+        print('{0}\t{1:.3f}\t{2}\t{3:.4f}'.format(name, elapsed,
+                                                  compressions, ratio))
+
+if __name__ == "__main__":
+    main()
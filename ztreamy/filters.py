@@ -35,11 +35,19 @@ receives a list or iterable of events instead of a single event.
 A way of implementing a custom filter is to extend the 'Filter' class
 and override its 'filter_event()' method.
 
+Filters can also be created from a textual expression with
+'parse_filter()'. Servers use these expressions for filtering events
+on behalf of their clients (the 'filter' parameter of the stream URLs).
+
 """
+import re
+from collections import OrderedDict
+
 import rdflib
-from rdflib.plugins.sparql.parser import parseQuery
+from rdflib.plugins.sparql import prepareQuery
 from pyparsing import Word, Literal, NotAny, QuotedString, Group, Forward, \
-                      Keyword, ZeroOrMore, printables, alphanums
+                      Keyword, ZeroOrMore, printables, alphanums, \
+                      ParseBaseException
 
 from ztreamy import ZtreamyException, RDFEvent
 
@@ -156,29 +164,75 @@ class VocabularyFilter(Filter):
         events that contain a URI matching at least one of the
         prefixes are selected. The rest are filtered out.
 
+        The prefixes are arranged in a trie, which is matched by a
+        single regular expression, so the cost of testing a URI does
+        not grow with the number of prefixes.
+
+        RDF events whose body was not parsed (e.g. in relays, which
+        do not parse bodies by default) are tested without parsing
+        them: their N3 or JSON-LD text is searched for URIs (between
+        angle brackets or double quotes) that begin with one of the
+        prefixes. Since namespace declarations are URIs too, terms
+        written as prefixed names match through the declaration of
+        their namespace. Unlike with parsed events, a declared
+        namespace that no triple uses, or a literal value that looks
+        like a URI, also selects the event. When the text contains a
+        URI that is shorter than a prefix and begins it (e.g. the
+        namespace 'http://example.com/voc/' for the prefix
+        'http://example.com/voc/temp'), the prefixed names cannot be
+        tested from the text, and the body is parsed instead.
+
         """
         super(VocabularyFilter, self).__init__(callback)
         if isinstance(uri_prefixes, basestring):
             self.uri_prefixes = [uri_prefixes]
         else:
             self.uri_prefixes = uri_prefixes
+        pattern = _prefix_regex(self.uri_prefixes)
+        self._uri_re = re.compile(pattern)
+        self._text_re = re.compile('[<"]' + pattern)
 
     def filter_event(self, event):
-        if self.callback is not None and isinstance(event, RDFEvent):
-            for triple in event.body:
-                if (self._test_uri(triple[0])
-                    or self._test_uri(triple[1])
-                    or self._test_uri(triple[2])):
-                    self.callback(event)
-                    break
+        if self.callback is None:
+            return
+        if isinstance(event, RDFEvent):
+            if self._match_graph(event._read_body()):
+                self.callback(event)
+        elif (event.syntax in RDFEvent.supported_syntaxes
+              and isinstance(event.body, basestring)):
+            if (self._text_re.search(event.body)
+                or (self._has_namespace(event.body)
+                    and self._match_text_parsed(event))):
+                self.callback(event)
 
-    def _test_uri(self, uriref):
-        if isinstance(uriref, rdflib.term.URIRef):
+    def _match_graph(self, graph):
+        match = self._uri_re.match
+        for triple in graph:
+            for term in triple:
+                if isinstance(term, rdflib.term.URIRef) and match(term):
+                    return True
+        return False
+
+    def _has_namespace(self, text):
+        # True if a URI in the text is a proper prefix of a prefix
+        # of the filter, which prefixed names may then match
+        for uri in _text_uri_re.findall(text):
             for prefix in self.uri_prefixes:
-                if uriref.startswith(prefix):
+                if len(prefix) > len(uri) and prefix.startswith(uri):
                     return True
         return False
 
+    def _match_text_parsed(self, event):
+        try:
+            graph = RDFEvent('', event.syntax, event.body)._read_body()
+        except ZtreamyException:
+            return False
+        return self._match_graph(graph)
+
+    def _test_uri(self, uriref):
+        return (isinstance(uriref, rdflib.term.URIRef)
+                and self._uri_re.match(uriref) is not None)
+
 
 class SimpleTripleFilter(Filter):
     """Filters events matching a given pattern of subject, predicate and object
@@ -215,7 +269,7 @@ class SimpleTripleFilter(Filter):
     def filter_event(self, event):
         if self.callback is not None and isinstance(event, RDFEvent):
             try:
-                generator = event.body.triples(self.pattern)
+                generator = event._read_body().triples(self.pattern)
                 generator.next()
             except StopIteration:
                 pass
@@ -228,20 +282,40 @@ class SPARQLFilter(Filter):
 
     Only the events that match the query can pass the filter.
 
+    The result for the last 'cache_size' different bodies is cached
+    (see 'RDFEvent.body_digest()'), so that the query is evaluated
+    only once for events with the same body.
+
     """
+    cache_size = 1024
+
     def __init__(self, callback, sparql_query):
         """Creates a SPARQL filter for RDF triples."""
         if sparql_query.strip()[:3].lower() != 'ask':
             raise ZtreamyException('Only ASK queries are allowed '
                                    'in SPARQLFilter')
         super(SPARQLFilter, self).__init__(callback)
-        self.query = parseQuery(sparql_query)
+        self.query = prepareQuery(sparql_query)
+        self._results = OrderedDict()
 
     def filter_event(self, event):
         if self.callback is not None and isinstance(event, RDFEvent):
-            if event.body.query(self.query).askAnswer:
+            digest = event.body_digest()
+            if digest is None:
+                selected = self._evaluate(event._read_body())
+            else:
+                selected = self._results.get(digest)
+                if selected is None:
+                    selected = self._evaluate(event._read_body())
+                    self._results[digest] = selected
+                    if len(self._results) > self.cache_size:
+                        self._results.popitem(last=False)
+            if selected:
                 self.callback(event)
 
+    def _evaluate(self, graph):
+        return graph.query(self.query).askAnswer
+
 
 class TripleFilter(SPARQLFilter):
     """Filters events containing certain triple patterns.
@@ -275,10 +349,247 @@ class TripleFilter(SPARQLFilter):
 
     """
     def __init__(self, callback, filter_expression):
-        """Creates a filter for RDF triples."""
-        sparql_query = _triple_filter_to_sparql(filter_expression)
-        ## print(sparql_query)
-        super(TripleFilter, self).__init__(callback, sparql_query)
+        """Creates a filter for RDF triples.
+
+        The expression is evaluated directly on the indexes of the
+        graph of the events, instead of through the equivalent SPARQL
+        query (which is still available in the 'query' attribute).
+        Triple patterns are probed in order of selectivity, and the
+        evaluation stops as soon as a match is found.
+
+        """
+        parse_results = _parse_triple_filter(filter_expression)
+        super(TripleFilter, self).__init__(callback,
+                                           _build_sparql(parse_results))
+        self.pattern = _compile_pattern(parse_results)
+
+    def _evaluate(self, graph):
+        for _ in self.pattern.solutions(graph, {}):
+            return True
+        return False
+
+
+class FilterRouter(Filter):
+    """Routes events to the filters, among many, that select them.
+
+    The plain 'SourceFilter', 'ApplicationFilter' and
+    'EventTypeFilter' objects are indexed by the ids and types they
+    accept, so that routing an event costs a few dictionary lookups
+    plus the callbacks of the filters that select it, regardless of
+    how many filters there are. Any other filter (including
+    subclasses of those three) is evaluated for every event.
+
+    The router invokes the callbacks of the filters that select
+    every event. If the router has a callback too, it is invoked
+    once for every event selected by at least one filter, which
+    allows using the router as the filter of a 'RelayStream' or as
+    the event callback of a client.
+
+    Indexed filters must not be modified while they are in the router.
+
+    """
+    def __init__(self, callback=None, filters=[]):
+        super(FilterRouter, self).__init__(callback)
+        self._by_source = {}
+        self._by_application = {}
+        self._by_event_type = {}
+        self._by_application_event_type = {}
+        self._other = []
+        self._num_filters = 0
+        self._matched = False
+        for filter_ in filters:
+            self.add_filter(filter_)
+
+    def add_filter(self, filter_):
+        keys = self._index_keys(filter_)
+        if keys is None:
+            # The callback is wrapped in order to know whether
+            # the filter selected the event
+            filter_.callback = _RoutedCallback(self, filter_.callback)
+            self._other.append(filter_)
+        else:
+            for index, key in keys:
+                index.setdefault(key, []).append(filter_)
+        self._num_filters += 1
+
+    def remove_filter(self, filter_):
+        keys = self._index_keys(filter_)
+        if keys is None:
+            self._other.remove(filter_)
+            filter_.callback = filter_.callback.callback
+        else:
+            for index, key in keys:
+                filters = index[key]
+                filters.remove(filter_)
+                if not filters:
+                    del index[key]
+        self._num_filters -= 1
+
+    def filter_event(self, event):
+        selected = False
+        if self._by_source:
+            filters = self._by_source.get(event.source_id)
+            if filters:
+                _call_filters(filters, event)
+                selected = True
+        if self._by_application:
+            filters = self._by_application.get(event.application_id)
+            if filters:
+                _call_filters(filters, event)
+                selected = True
+        if self._by_event_type:
+            filters = self._by_event_type.get(event.event_type)
+            if filters:
+                _call_filters(filters, event)
+                selected = True
+        if self._by_application_event_type:
+            filters = self._by_application_event_type.get( \
+                                    (event.application_id, event.event_type))
+            if filters:
+                _call_filters(filters, event)
+                selected = True
+        if self._other:
+            self._matched = False
+            for filter_ in self._other:
+                filter_.filter_event(event)
+            selected = selected or self._matched
+        if selected and self.callback is not None:
+            self.callback(event)
+
+    def __len__(self):
+        return self._num_filters
+
+    def _index_keys(self, filter_):
+        # Returns a list of (index, key) pairs, or None for the filters
+        # that cannot be indexed
+        class_ = type(filter_)
+        if class_ is SourceFilter:
+            return [(self._by_source, source_id)
+                    for source_id in filter_.source_ids]
+        elif class_ is ApplicationFilter:
+            return [(self._by_application, application_id)
+                    for application_id in filter_.application_ids]
+        elif class_ is EventTypeFilter:
+            application_ids = getattr(filter_, 'application_ids', None)
+            if application_ids:
+                return [(self._by_application_event_type,
+                         (application_id, event_type))
+                        for application_id in application_ids
+                        for event_type in filter_.event_types]
+            else:
+                return [(self._by_event_type, event_type)
+                        for event_type in filter_.event_types]
+        else:
+            return None
+
+
+class _RoutedCallback(object):
+    def __init__(self, router, callback):
+        self.router = router
+        self.callback = callback
+
+    def __call__(self, event):
+        self.router._matched = True
+        if self.callback is not None:
+            self.callback(event)
+
+
+def _call_filters(filters, event):
+    for filter_ in filters:
+        if filter_.callback is not None:
+            filter_.callback(event)
+
+
+def parse_filter(text, callback=None):
+    """Creates a filter from a textual expression.
+
+    The expression is the kind of filter, a colon and its arguments:
+
+    source:ID[,ID...]
+    application:ID[,ID...]
+    event-type:TYPE[,TYPE...][@APPLICATION_ID[,APPLICATION_ID...]]
+    triple:EXPRESSION (see 'TripleFilter')
+    sparql:QUERY (a SPARQL ASK query)
+
+    The 'expression' attribute of the new filter is a normalized
+    version of 'text', which is the same for equivalent lists of
+    ids. Raises ValueError if the expression is not valid.
+
+    """
+    kind, sep, arguments = text.partition(':')
+    kind = kind.strip()
+    arguments = arguments.strip()
+    if not sep or not arguments:
+        raise ValueError('Bad filter expression: ' + text)
+    if kind in ('source', 'application', 'event-type'):
+        arguments, _, application_ids = arguments.partition('@')
+        ids = _split_ids(arguments)
+        application_ids = _split_ids(application_ids)
+        if not ids or (application_ids and kind != 'event-type'):
+            raise ValueError('Bad filter expression: ' + text)
+        if kind == 'source':
+            filter_ = SourceFilter(callback, source_ids=ids)
+        elif kind == 'application':
+            filter_ = ApplicationFilter(callback, application_ids=ids)
+        else:
+            filter_ = EventTypeFilter(callback, ids,
+                                      application_ids=application_ids)
+        arguments = ','.join(ids)
+        if application_ids:
+            arguments += '@' + ','.join(application_ids)
+    else:
+        try:
+            if kind == 'triple':
+                filter_ = TripleFilter(callback, arguments)
+            elif kind == 'sparql':
+                filter_ = SPARQLFilter(callback, arguments)
+            else:
+                raise ValueError('Unknown filter: ' + kind)
+        except (ParseBaseException, ZtreamyException) as e:
+            raise ValueError('Bad filter expression: ' + str(e))
+    filter_.expression = kind + ':' + arguments
+    return filter_
+
+# URIs in N3 or JSON-LD text
+_text_uri_re = re.compile(r'[<"]([^<>"\s]+)[>"]')
+
+def _prefix_regex(prefixes):
+    """Returns a regular expression that matches any of the prefixes.
+
+    The alternatives are factored as in a trie, so that the regular
+    expression engine compares every character once.
+
+    """
+    trie = {}
+    for prefix in prefixes:
+        node = trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # End of a prefix
+        node[''] = None
+    if not trie:
+        # Nothing matches
+        return '(?!)'
+    return _trie_regex(trie)
+
+def _trie_regex(node):
+    parts = []
+    while True:
+        if '' in node:
+            # Longer prefixes add nothing to this one
+            return ''.join(parts)
+        if len(node) > 1:
+            break
+        char, node = node.items()[0]
+        parts.append(re.escape(char))
+    alternatives = [re.escape(char) + _trie_regex(child)
+                    for char, child in sorted(node.items())]
+    parts.append('(?:' + '|'.join(alternatives) + ')')
+    return ''.join(parts)
+
+def _split_ids(text):
+    return sorted(set(part.strip() for part in text.split(',')
+                      if part.strip()))
 
 
 #
@@ -305,11 +616,14 @@ def _create_filter_parser():
     expr << (and_group.setResultsName('and') ^ or_group.setResultsName('or'))
     return expr
 
-def _triple_filter_to_sparql(text):
+def _parse_triple_filter(text):
     global _filter_parser
     if _filter_parser is None:
         _filter_parser = _create_filter_parser()
-    return _build_sparql(_filter_parser.parseString(text, parseAll=True))
+    return _filter_parser.parseString(text, parseAll=True)
+
+def _triple_filter_to_sparql(text):
+    return _build_sparql(_parse_triple_filter(text))
 
 def _build_sparql(parse_results):
     parts = ['ASK']
@@ -365,3 +679,110 @@ def _represent_uri_term(parse_results, num_used_variables):
     else:
         result = '<' + parse_results + '>'
     return result
+
+
+#
+# Direct evaluation of filtering expressions on graphs.
+#
+# Patterns generate the solutions (dictionaries that bind variables
+# to terms) that extend a given solution. They are generators, so
+# that the evaluation stops as soon as the first solution is found.
+#
+class _TriplePattern(object):
+    def __init__(self, subject, predicate, object_):
+        # Terms are None for wildcards
+        self.terms = (subject, predicate, object_)
+        self.variables = [(i, term) for i, term in enumerate(self.terms)
+                          if isinstance(term, rdflib.term.Variable)]
+        self.num_constants = len([term for term in self.terms
+                                  if term is not None]) - len(self.variables)
+
+    def solutions(self, graph, bindings):
+        if not self.variables:
+            for _ in graph.triples(self.terms):
+                yield bindings
+                break
+            return
+        pattern = list(self.terms)
+        unbound = []
+        for i, variable in self.variables:
+            value = bindings.get(variable)
+            pattern[i] = value
+            if value is None:
+                unbound.append((i, variable))
+        if not unbound:
+            for _ in graph.triples(tuple(pattern)):
+                yield bindings
+                break
+            return
+        for triple in graph.triples(tuple(pattern)):
+            solution = dict(bindings)
+            for i, variable in unbound:
+                value = solution.get(variable)
+                if value is None:
+                    solution[variable] = triple[i]
+                elif value != triple[i]:
+                    # The variable appears twice in the pattern
+                    break
+            else:
+                yield solution
+
+
+class _AndPattern(object):
+    def __init__(self, operands):
+        # The most selective patterns go first
+        self.operands = sorted(operands, key=_selectivity, reverse=True)
+        self.num_constants = max(_selectivity(operand)
+                                 for operand in operands)
+
+    def solutions(self, graph, bindings):
+        return self._join(graph, 0, bindings)
+
+    def _join(self, graph, i, bindings):
+        if i == len(self.operands):
+            yield bindings
+        else:
+            for solution in self.operands[i].solutions(graph, bindings):
+                for result in self._join(graph, i + 1, solution):
+                    yield result
+
+
+class _OrPattern(object):
+    def __init__(self, operands):
+        self.operands = operands
+        self.num_constants = -1
+
+    def solutions(self, graph, bindings):
+        for operand in self.operands:
+            for solution in operand.solutions(graph, bindings):
+                yield solution
+
+
+def _selectivity(pattern):
+    return pattern.num_constants
+
+def _compile_pattern(parse_results):
+    name = parse_results.getName()
+    if name == 'triple':
+        subject = _compile_term(parse_results[0])
+        predicate = _compile_term(parse_results[1])
+        if parse_results[2].getName() == 'objlit':
+            object_ = rdflib.term.Literal(parse_results[2][0])
+        else:
+            object_ = _compile_term(parse_results[2][0])
+        return _TriplePattern(subject, predicate, object_)
+    operands = [_compile_pattern(expr) for expr in parse_results]
+    if len(operands) == 1:
+        return operands[0]
+    elif name == 'and':
+        return _AndPattern(operands)
+    else:
+        return _OrPattern(operands)
+
+def _compile_term(text):
+    if text == '*':
+        return None
+    elif text.startswith('?'):
+        return rdflib.term.Variable(text[1:])
+    else:
+        return rdflib.term.URIRef(text)
@@ -25,6 +25,9 @@ import time
 from socket import gethostname
 
 class ZtreamyDefaultLogger(object):
+    # Whether the per-event methods log anything
+    logs_events = False
+
     def __init__(self):
         self.log_file = None
         self.auto_flush = False
@@ -76,6 +79,8 @@ class ZtreamyDefaultLogger(object):
 
 
 class ZtreamyLogger(ZtreamyDefaultLogger):
+    logs_events = True
+
     def __init__(self, node_id, filename):
         super(ZtreamyLogger, self).__init__()
         self._open_file(node_id, filename)
@@ -146,5 +151,22 @@ class CompactServerLogger(ZtreamyDefaultLogger):
 def timestamp():
     return '%.6f'%time.time()
 
+def events_dispatched(evs):
+    """Logs the dispatch of a batch of events.
+
+    It does nothing, without iterating over the events, unless the
+    current logger logs events.
+
+    """
+    if logger.logs_events:
+        for event in evs:
+            logger.event_dispatched(event)
+
+def events_delivered(evs):
+    """Logs the delivery of a batch of events (see 'events_dispatched')."""
+    if logger.logs_events:
+        for event in evs:
+            logger.event_delivered(event)
+
 # Default logger
 logger = ZtreamyDefaultLogger()
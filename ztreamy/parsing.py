@@ -0,0 +1,209 @@
+# ztreamy: a framework for publishing semantic events on the Web
+# Copyright (C) 2011-2015 Jesus Arias Fisteus
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+#
+"""Parsing of event bodies in a pool of processes.
+
+Parsing RDF bodies is by far the most expensive step in the
+processing of RDF events. Clients and streams normally parse them in
+the thread of the IOLoop, which stops any other I/O meanwhile. With a
+'ParserPool', the bodies are parsed by other processes, and the
+IOLoop just receives the resulting graphs.
+
+A pool can be shared by several clients and streams. Each of them
+uses its own 'ParseQueue', which returns the parsed events in the
+same order they were received.
+
+"""
+import collections
+import multiprocessing
+
+import rdflib
+import tornado.concurrent
+import tornado.ioloop
+
+import ztreamy
+from ztreamy import events, ZtreamyException
+from ztreamy.rdfevents import RDFEvent
+
+
+_rdflib_formats = {
+    'text/n3': 'n3',
+    ztreamy.json_ld_media_type: 'json-ld',
+}
+
+
+class ParserPool(object):
+    """Pool of processes that parse the bodies of RDF events.
+
+    The processes are created the first time they are needed, so
+    that a server creates them after forking its worker processes.
+
+    """
+    def __init__(self, processes=None, ioloop=None, timeout=30.0):
+        """Creates a new pool.
+
+        The pool has 'processes' processes (by default, as many as
+        CPUs). Results are delivered through the given 'ioloop' (by
+        default, the current one when events are submitted).
+
+        A batch of events fails if its results are not received
+        within 'timeout' seconds, which happens when a process of
+        the pool dies while parsing them.
+
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self.ioloop = ioloop
+        self.timeout = timeout
+        self._pool = None
+
+    def parse_events(self, evs):
+        """Parses the bodies of events received without parsing them.
+
+        'evs' is a list of events deserialized with 'parse_body' set
+        to False. Returns a Future that resolves to a list with the
+        same events, parsed. RDF bodies are parsed in the pool, and
+        the rest of the bodies in this process. The Future fails with
+        a 'ZtreamyException' if a body cannot be parsed or the pool
+        fails to return the results.
+
+        """
+        future = tornado.concurrent.Future()
+        evs = list(evs)
+        jobs = []
+        for i, event in enumerate(evs):
+            subclass = events.Event._subclasses.get(event.syntax)
+            if subclass is None or isinstance(event, subclass):
+                continue
+            if event.syntax in _rdflib_formats and subclass is RDFEvent:
+                jobs.append((i, event.syntax, event.body))
+            else:
+                evs[i] = _with_body(event, event.body)
+        if not jobs:
+            future.set_result(evs)
+            return future
+        ioloop = self.ioloop or tornado.ioloop.IOLoop.current()
+        size = -(-len(jobs) // self.processes)
+        chunks = [[(syntax, body) for _, syntax, body in jobs[i:i + size]]
+                  for i in range(0, len(jobs), size)]
+
+        def callback(results):
+            # Called from a thread of the pool
+            ioloop.add_callback(self._finish, future, evs, jobs, results)
+
+        # The callback is not called when the batch fails
+        result = self._get_pool().map_async(_parse_bodies, chunks,
+                                            callback=callback)
+        self._watch(future, result, ioloop, ioloop.time() + self.timeout)
+        return future
+
+    def close(self):
+        """Terminates the processes of the pool."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        return self._pool
+
+    def _watch(self, future, result, ioloop, deadline):
+        if future.done():
+            return
+        if result.ready() and not result.successful():
+            try:
+                result.get()
+            except Exception as e:
+                message = str(e) or e.__class__.__name__
+            future.set_exception(ZtreamyException( \
+                                    'Error in the parser pool: ' + message,
+                                    'event_deserialize'))
+        elif ioloop.time() >= deadline and not result.ready():
+            future.set_exception(ZtreamyException( \
+                                    'Timeout in the parser pool',
+                                    'event_deserialize'))
+        else:
+            ioloop.call_later(min(1.0, self.timeout), self._watch,
+                              future, result, ioloop, deadline)
+
+    def _finish(self, future, evs, jobs, results):
+        if future.done():
+            # The batch timed out
+            return
+        graphs = [result for chunk in results for result in chunk]
+        for (i, _, body), (graph, error) in zip(jobs, graphs):
+            if error is not None:
+                future.set_exception(ZtreamyException( \
+                                        'Error parsing event body: ' + error,
+                                        'event_deserialize'))
+                return
+            # The event keeps the text in order to be serialized
+            evs[i] = _with_body(evs[i], body)
+            evs[i]._set_parsed_body(graph)
+        future.set_result(evs)
+
+
+class ParseQueue(object):
+    """Parses batches of events in a pool, keeping their order.
+
+    The Future returned for a batch resolves only after the Futures
+    of the batches submitted before it through this queue.
+
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self._pending = collections.deque()
+
+    def parse_events(self, evs):
+        parsed = self.pool.parse_events(evs)
+        ordered = tornado.concurrent.Future()
+        self._pending.append((parsed, ordered))
+        parsed.add_done_callback(self._release)
+        return ordered
+
+    def _release(self, future):
+        while self._pending and self._pending[0][0].done():
+            parsed, ordered = self._pending.popleft()
+            tornado.concurrent.chain_future(parsed, ordered)
+
+
+def _parse_bodies(jobs):
+    # Runs in the processes of the pool. Exceptions are returned
+    # as messages because the pool would not report them.
+    results = []
+    for syntax, body in jobs:
+        try:
+            graph = rdflib.Graph()
+            graph.parse(data=body, format=_rdflib_formats[syntax])
+        except Exception as e:
+            results.append((None, str(e) or e.__class__.__name__))
+        else:
+            results.append((graph, None))
+    return results
+
+def _with_body(event, body):
+    # Creates the event of the class registered for its syntax
+    return events.Event._create_trusted( \
+                                event.source_id,
+                                event.syntax,
+                                body,
+                                event_id=event.event_id,
+                                application_id=event.application_id,
+                                aggregator_id=list(event.aggregator_id),
+                                event_type=event.event_type,
+                                timestamp=event.timestamp,
+                                extra_headers=dict(event.extra_headers))
@@ -21,6 +21,7 @@
 
 import rdflib
 import json
+import hashlib
 
 import ztreamy
 import ztreamy.events as events
@@ -31,30 +32,94 @@ class RDFEvent(events.Event):
 
     Right now, only the Notation3 and JSON-LD serializations are allowed.
 
+    The body is parsed the first time it is accessed, so events
+    whose body is never inspected do not pay for parsing it. Until
+    then, the event is serialized with the text it was created from.
+
     """
+    __slots__ = (
+        '_graph',
+        '_body_text',
+        '_body_digest',
+        '_body_touched',
+    )
+
     supported_syntaxes = ['text/n3', ztreamy.json_ld_media_type]
 
     def __init__(self, source_id, syntax, body, **kwargs):
         """Creates a new event.
 
-        `body` must be the textual representation of the event or
-        provide that textual representation through `str()`.
+        `body` must be an `rdflib.Graph`, the textual representation
+        of the event or provide that textual representation through
+        `str()`. The text is not parsed until the body is accessed
+        or `check_body()` is called, and therefore syntax errors in it
+        are not reported until then, as a `ZtreamyException`.
 
         """
         if not syntax in RDFEvent.supported_syntaxes:
             raise ZtreamyException('Usupported syntax in RDFEvent',
                                    'programming')
         super(RDFEvent, self).__init__(source_id, syntax, None, **kwargs)
-        if isinstance(body, rdflib.Graph):
-            self.body = body
+        self.body = body
+
+    @property
+    def body(self):
+        """The RDF graph of the event, parsed upon first access.
+
+        Once the graph has been accessed, the event is serialized from
+        it, because it may have been modified.
+
+        """
+        graph = self._read_body()
+        object.__setattr__(self, '_body_touched', True)
+        return graph
+
+    @body.setter
+    def body(self, value):
+        _set = object.__setattr__
+        if value is None or isinstance(value, rdflib.Graph):
+            _set(self, '_graph', value)
+            _set(self, '_body_text', None)
         else:
-            self.body = self._parse_body(body)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            elif isinstance(value, dict):
+                # JSON-LD body from the JSON deserializer
+                value = json.dumps(value)
+            else:
+                value = str(value)
+            _set(self, '_graph', None)
+            _set(self, '_body_text', value)
+        _set(self, '_body_digest', None)
+        _set(self, '_body_touched', False)
+
+    def body_digest(self):
+        """Returns a digest of the text the body was parsed from.
+
+        Events with the same digest have the same body, which allows
+        caching the results of computations on the graph. Returns
+        None if the body was given as a graph or has been replaced.
+
+        """
+        if self._body_digest is None and self._body_text is not None:
+            object.__setattr__(self, '_body_digest',
+                               hashlib.sha1(self._body_text).digest())
+        return self._body_digest
+
+    def clear_serialization_cache(self):
+        # The graph may have been modified in place
+        super(RDFEvent, self).clear_serialization_cache()
+        if self._body_touched:
+            object.__setattr__(self, '_body_text', None)
+            object.__setattr__(self, '_body_digest', None)
 
     def serialize_body(self):
+        if self._body_text is not None and not self._body_touched:
+            return self._body_text
         if self.syntax == 'text/n3':
-            return self.body.serialize(format='n3')
+            return self._read_body().serialize(format='n3')
         elif self.syntax == 'application/ld+json':
-            return self.body.serialize(format='json-ld')
+            return self._read_body().serialize(format='json-ld')
         else:
             raise ZtreamyException('Bad RDFEvent syntax', 'event_serialize')
 
@@ -62,9 +127,28 @@ class RDFEvent(events.Event):
         return ztreamy.json_ld_media_type
 
     def body_as_json(self):
-        json_obj = json.loads(self.body.serialize(format='json-ld'))
+        if self.syntax == ztreamy.json_ld_media_type:
+            json_obj = json.loads(self.serialize_body())
+        else:
+            json_obj = json.loads(self._read_body().serialize( \
+                                                        format='json-ld'))
         return json_obj
 
+    def _read_body(self):
+        # Returns the graph without marking it as touched,
+        # for code that does not modify it (e.g. filters)
+        if self._graph is None and self._body_text is not None:
+            object.__setattr__(self, '_graph',
+                               self._parse_body(self._body_text))
+        return self._graph
+
+    def check_body(self):
+        self._read_body()
+
+    def _set_parsed_body(self, graph):
+        # Sets the graph parsed elsewhere from the text of the body
+        object.__setattr__(self, '_graph', graph)
+
     def _parse_body(self, body):
         if self.syntax == 'text/n3':
             return self._parse_body_rdflib(body, syntax='n3')
@@ -75,7 +159,12 @@ class RDFEvent(events.Event):
 
     def _parse_body_rdflib(self, body, syntax):
         g = rdflib.Graph()
-        g.parse(data=body, format=syntax)
+        try:
+            g.parse(data=body, format=syntax)
+        except Exception as e:
+            raise ZtreamyException('Error parsing event body: '
+                                   + (str(e) or e.__class__.__name__),
+                                   'event_deserialize')
         return g
 
 for syntax in RDFEvent.supported_syntaxes:
@@ -35,25 +35,50 @@ server will be blocked.
 from __future__ import print_function
 
 import logging
+import tornado.concurrent
 import tornado.escape
+import tornado.gen
 import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.process
 import tornado.web
+import tornado.websocket
 import tornado.httpserver
 import traceback
 import time
 from datetime import timedelta
 import re
+import os
 import os.path
+import socket
+import sys
+import errno
+import zlib
+import multiprocessing.pool
+from collections import OrderedDict, deque
 
 import ztreamy
 from ztreamy import events, logger
 from .client import Client
 from . import dispatchers
+from . import filters
+from . import eventlog
+from . import parsing
 from .dispatchers import ClientProperties, ClientPropertiesFactory
 
 # Uncomment to do memory profiling
 #import guppy.heapy.RM
 
+# WebSocket clients share the compressed stream of the dispatchers
+# through internals of the permessage-deflate implementation of
+# Tornado, known in these versions. With other versions, every
+# connection is compressed on its own.
+_websocket_shared_compression = (4, 5) <= tornado.version_info[:2] < (7, 0)
+
+# End of the data of a sync flush, which permessage-deflate removes
+_sync_flush_trailer = b'\x00\x00\xff\xff'
+
 
 class StreamServer(tornado.web.Application):
     """An HTTP server for event streams.
@@ -70,8 +95,13 @@ class StreamServer(tornado.web.Application):
     server.add_stream(stream2)
     server.start()
 
+    The server can serve the streams from several worker processes
+    in order to use more than one CPU core (see the 'num_processes'
+    parameter of the constructor).
+
     """
-    def __init__(self, port, ioloop=None, stop_when_source_finishes=False):
+    def __init__(self, port, ioloop=None, stop_when_source_finishes=False,
+                 num_processes=1):
         """Creates a new server.
 
         'port' specifies the port number in which the HTTP server will
@@ -82,6 +112,17 @@ class StreamServer(tornado.web.Application):
         for the performance experiments, but its value should normally
         be 'False'.
 
+        'num_processes' is the number of worker processes that serve
+        HTTP requests. If it is None or not positive, one worker per
+        CPU core is created. With more than one worker, 'start()'
+        forks the workers, which share the listening socket. The
+        original (master) process does not serve HTTP requests: it
+        keeps running the event sources of the streams (e.g. relay
+        clients, local event publishers or timers installed in the
+        ioloop) and forwards the events published in any process to
+        every worker. Each worker has its own dispatchers. Local
+        clients receive events only in the master process.
+
         The server won't start to serve streams until start() is
         called.  Streams cannot be registered in the server after it
         has been started.
@@ -90,12 +131,18 @@ class StreamServer(tornado.web.Application):
         settings = dict()
         super(StreamServer, self).__init__(**settings)
         logging.info('Initializing server...')
-        self.http_server = tornado.httpserver.HTTPServer(self,
-                                                decompress_request=True)
         self.streams = []
         self.port = port
         self.ioloop = ioloop or tornado.ioloop.IOLoop.instance()
+        self.http_server = tornado.httpserver.HTTPServer(self,
+                                                decompress_request=True,
+                                                io_loop=self.ioloop)
         self.stop_when_source_finishes = stop_when_source_finishes
+        if num_processes is None or num_processes <= 0:
+            num_processes = tornado.process.cpu_count()
+        self.num_processes = num_processes
+        self._workers = []
+        self._master_channel = None
         self._looping = False
         self._started = False
         self._stopped = False
@@ -125,7 +172,10 @@ class StreamServer(tornado.web.Application):
         assert(not self._started)
         logging.info('Starting server...')
         self._register_handlers()
-        self.http_server.listen(self.port)
+        if self.num_processes > 1:
+            self._start_workers()
+        else:
+            self.http_server.listen(self.port)
         for stream in self.streams:
             stream.start()
         self._started = True
@@ -148,11 +198,112 @@ class StreamServer(tornado.web.Application):
             for stream in self.streams:
                 stream.stop()
             self.http_server.stop()
+            self._stop_workers()
             self._stopped = True
             if self._looping == True:
                 self.ioloop.stop()
                 self._looping = False
 
+    def _start_workers(self):
+        sockets = tornado.netutil.bind_sockets(self.port)
+        channel_sockets = []
+        for i in range(self.num_processes):
+            master_end, worker_end = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                master_end.close()
+                for _, other_end in channel_sockets:
+                    other_end.close()
+                self._run_worker(sockets, worker_end)
+            worker_end.close()
+            channel_sockets.append((pid, master_end))
+        for sock in sockets:
+            sock.close()
+        for pid, master_end in channel_sockets:
+            channel = _ProcessChannel(master_end, self.ioloop,
+                                      self._on_worker_message,
+                                      self._on_worker_closed)
+            self._workers.append((pid, channel))
+        for stream in self.streams:
+            stream._fanout = self._fanout_from_master
+        logging.info('Started {} worker processes'.format(len(self._workers)))
+
+    def _run_worker(self, sockets, channel_socket):
+        # The ioloop inherited from the master cannot be used
+        # in this process, and it must not be closed either,
+        # because its epoll object is shared with the master.
+        try:
+            tornado.ioloop.IOLoop.clear_instance()
+            tornado.ioloop.IOLoop.clear_current()
+            self.ioloop = tornado.ioloop.IOLoop()
+            self.ioloop.install()
+            self.ioloop.make_current()
+            self.http_server = tornado.httpserver.HTTPServer(self,
+                                                decompress_request=True,
+                                                io_loop=self.ioloop)
+            self.http_server.add_sockets(sockets)
+            self._master_channel = _ProcessChannel(channel_socket,
+                                                   self.ioloop,
+                                                   self._on_master_message,
+                                                   self.stop)
+            for stream in self.streams:
+                stream._init_worker(self.ioloop, self._fanout_from_worker)
+                # Event sources (e.g. the clients of relay streams)
+                # run only in the master process
+                Stream.start(stream)
+            self._started = True
+            self._looping = True
+            self.ioloop.start()
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            logging.exception('Worker process failed')
+        finally:
+            os._exit(0)
+
+    def _stop_workers(self):
+        if self._master_channel is not None:
+            self._master_channel.close()
+        for _, channel in self._workers:
+            channel.close()
+        for pid, _ in self._workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+        self._workers = []
+
+    def _fanout_from_master(self, stream, evs):
+        # Dispatching first stamps the sequence numbers, which
+        # then travel to the workers within the serialized events
+        evs = stream._dispatch_local(evs)
+        if evs:
+            self._broadcast(self.streams.index(stream),
+                            ztreamy.serialize_events(evs))
+
+    def _fanout_from_worker(self, stream, evs):
+        if evs:
+            self._master_channel.send(self.streams.index(stream),
+                                      ztreamy.serialize_events(evs))
+
+    def _on_worker_message(self, stream_index, data):
+        self._broadcast(stream_index, data)
+        stream = self.streams[stream_index]
+        stream._dispatch_local(stream._deserialize_fanout(data))
+
+    def _on_master_message(self, stream_index, data):
+        stream = self.streams[stream_index]
+        stream._dispatch_local(stream._deserialize_fanout(data))
+
+    def _on_worker_closed(self):
+        if not self._stopped:
+            logging.error('A worker process finished unexpectedly')
+
+    def _broadcast(self, stream_index, data):
+        for _, channel in self._workers:
+            channel.send(stream_index, data)
+
     def _register_handlers(self):
         handlers = []
         # Common static files
@@ -185,17 +336,34 @@ class StreamServer(tornado.web.Application):
                 tornado.web.URLSpec(stream.path + r"/long-polling",
                                     _ShortLivedHandler,
                                     kwargs=handler_kwargs),
+                tornado.web.URLSpec(stream.path + r"/websocket",
+                                    _WebSocketHandler,
+                                    kwargs=handler_kwargs),
                 tornado.web.URLSpec(stream.path + r"/(dashboard.html)",
                                     tornado.web.StaticFileHandler,
                                     kwargs=dict(path=static_path)),
             ])
+            if stream.dispatcher.dictionaries is not None:
+                handlers.append(tornado.web.URLSpec( \
+                                    stream.path + r"/dictionary/([0-9a-f]+)",
+                                    _DictionaryHandler,
+                                    kwargs=handler_kwargs))
+            if stream.dispatcher.event_log is not None:
+                handlers.append(tornado.web.URLSpec(stream.path + r"/history",
+                                                    _HistoryHandler,
+                                                    kwargs=handler_kwargs))
             if stream.allow_publish:
                 publish_kwargs = {'stream': stream,
                                   'stop_when_source_finishes': \
                                        self.stop_when_source_finishes}
-                handlers.append(tornado.web.URLSpec(stream.path + r"/publish",
-                                                    _EventPublishHandler,
-                                                    kwargs=publish_kwargs))
+                handlers.extend([
+                    tornado.web.URLSpec(stream.path + r"/publish",
+                                        _EventPublishHandler,
+                                        kwargs=publish_kwargs),
+                    tornado.web.URLSpec(stream.path + r"/publish-stream",
+                                        _EventPublishStreamHandler,
+                                        kwargs=publish_kwargs),
+                ])
         self.add_handlers(".*$", handlers)
 
 
@@ -235,6 +403,18 @@ class Stream(object):
         clients with priority, typically relay servers.
         The Accept-Encoding header is ignored.
 
+    '/websocket': the stream through a WebSocket, in which each
+        message carries a batch of events. They are serialized in the
+        ztreamy format (binary messages), or as JSON lines (text
+        messages) if the client selects the 'ldjson' subprotocol.
+        The permessage-deflate extension is supported. The client
+        can specify the latest event it has received, as with
+        '/long-polling', in order to resume the stream.
+
+    The streams at '/stream', '/compressed' and '/websocket' can also
+    be received with the delay of one of the dispatch tiers of the
+    stream, which is selected with the 'tier' parameter of the request.
+
     '/long-polling': available events are sent to the client uncompressed.
         The request is closed immediately. The client can specify the
         latest event it has received in order to get the events that
@@ -243,6 +423,11 @@ class Stream(object):
     '/publish': receives events from event sources in order to be
         published in the stream.
 
+    '/publish-stream': receives events from an event source through
+        a long-lived request, whose body is streamed by the source
+        as new events are available. Each event is published as soon
+        as it is completely received.
+
     There are two ways of publishing events in a stream: sending them
     through HTTP using the .../publish path, if allowed by the
     configuration of the stream, or using locally its
@@ -254,8 +439,22 @@ class Stream(object):
                  allow_publish=False,
                  buffering_time=None,
                  num_recent_events=2048,
+                 recent_events_max_bytes=None,
+                 recent_events_max_age=None,
+                 event_log_dir=None,
+                 event_log_max_bytes=None,
+                 event_log_max_age=None,
                  event_adapter=None,
                  parse_event_body=True,
+                 shared_compression=False,
+                 compression_dictionary=False,
+                 parser_pool=None,
+                 max_client_pending_bytes=16777216,
+                 slow_client_policy='close',
+                 adaptive_buffering=False,
+                 latency_target=None,
+                 max_buffered_events=None,
+                 dispatch_tiers=None,
                  ioloop=None):
         """Creates a stream object.
 
@@ -278,6 +477,75 @@ class Stream(object):
         and compression ratios, but increase the latency in the
         delivery of events.
 
+        If 'adaptive_buffering' is True, 'buffering_time' is instead
+        the maximum time events are buffered, and the stream adapts
+        the actual period to its load: events are sent immediately
+        while the stream receives few of them, and buffered for
+        longer as the cost of sending them to the clients grows with
+        the rate of events and the number of clients. If a
+        'latency_target' (in milliseconds) is given, the period is
+        kept short enough for the 99th percentile of the delay added
+        by buffering and dispatching to stay below it. The current
+        period is reported by 'effective_buffering_time'. With any
+        kind of buffering, 'max_buffered_events' optionally limits
+        the number of events kept in the buffer before sending them.
+
+        'dispatch_tiers' is an optional list of delays (in
+        milliseconds) that streaming clients can choose instead of
+        'buffering_time' with the 'tier' parameter of their request
+        or the 'ztreamy.tier_header' header, for example [0, 50, 1000].
+        Every tier supports all the serializations and encodings of
+        streaming clients, and the dispatchers of a tier are created
+        only when clients subscribe to it.
+
+        The stream keeps its 'num_recent_events' most recent events
+        in order to send them to the clients that ask for past
+        events. 'recent_events_max_bytes' optionally limits the total
+        size of their serializations, and 'recent_events_max_age' the
+        time (in seconds) they are kept. The occupancy of that buffer
+        is reported by 'recent_events_stats()'.
+
+        If 'event_log_dir' is given, the events of the stream are also
+        stored in a persistent log in that directory (see the
+        'eventlog' module), and the buffer of recent events is loaded
+        from it when the stream is created again. Old events are
+        removed from the log when it takes more than
+        'event_log_max_bytes' bytes or when they are older than
+        'event_log_max_age' seconds.
+
+        If 'shared_compression' is True, the zlib-compressed stream is
+        compressed just once for all its clients, even for the clients
+        that have just connected, at the cost of a slightly worse
+        compression ratio when new clients connect (see
+        'dispatchers.ZlibDispatcher').
+
+        If 'compression_dictionary' is True, the stream periodically
+        builds a zlib preset dictionary from its recent events. Clients
+        that support it can then receive the long-polling responses,
+        and new streaming connections that do not ask for past events,
+        compressed with that dictionary. The dictionaries are served
+        at the '/dictionary/<id>' path of the stream.
+
+        If a 'parser_pool' ('parsing.ParserPool') is given and
+        'parse_event_body' is True, the bodies of the events published
+        through HTTP are parsed in the processes of that pool instead
+        of in the IOLoop. Events are still dispatched in the order
+        they were received.
+
+        Streaming clients whose connections do not keep up with the
+        stream accumulate data in the server. When a client has more
+        than 'max_client_pending_bytes' bytes pending to be sent
+        (None for no limit), the 'slow_client_policy' is applied:
+        'close' disconnects the client, which may reconnect later
+        asking for the events it missed, and 'skip' stops sending
+        events to it until its pending data is sent, so that it
+        receives only the events published from then on. 'demote'
+        also skips events, and then moves the client to the next
+        slower tier of 'dispatch_tiers', whose larger batches cost
+        less to send; clients already in the slowest tier and
+        filtered clients are just skipped. The queue of each client
+        is reported by 'clients_stats()'.
+
         If a 'ioloop' object is given, it will be used by the internal
         timers of the stream.  If not, the default 'ioloop' of the
         Tornado instance will be used.
@@ -293,13 +561,41 @@ class Stream(object):
             self.path = '/' + path
         self.allow_publish = allow_publish
         self.dispatcher = _EventDispatcher(self,
-                                           num_recent_events=num_recent_events)
+                                   num_recent_events=num_recent_events,
+                                   recent_events_max_bytes=\
+                                       recent_events_max_bytes,
+                                   recent_events_max_age=\
+                                       recent_events_max_age,
+                                   event_log_dir=event_log_dir,
+                                   event_log_max_bytes=event_log_max_bytes,
+                                   event_log_max_age=event_log_max_age,
+                                   shared_compression=shared_compression,
+                                   compression_dictionary=\
+                                       compression_dictionary,
+                                   max_client_pending_bytes=\
+                                       max_client_pending_bytes,
+                                   slow_client_policy=slow_client_policy,
+                                   dispatch_tiers=dispatch_tiers,
+                                   ioloop=ioloop)
         self.buffering_time = buffering_time
+        self.max_buffered_events = max_buffered_events
+        if adaptive_buffering and buffering_time:
+            self._adaptive_buffering = _AdaptiveBuffering(buffering_time,
+                                            latency_target=latency_target)
+        else:
+            self._adaptive_buffering = None
+        self._dump_timeout = None
         self.event_adapter = event_adapter
         self.ioloop = ioloop or tornado.ioloop.IOLoop.instance()
         self.parse_event_body = parse_event_body
+        if parser_pool is not None:
+            self.parse_queue = parsing.ParseQueue(parser_pool)
+        else:
+            self.parse_queue = None
         self._event_buffer = []
-        if buffering_time:
+        # Set by the server when it runs in several processes
+        self._fanout = None
+        if buffering_time and self._adaptive_buffering is None:
             self.buffer_dump_sched = \
                 tornado.ioloop.PeriodicCallback(self._dump_buffer,
                                                 buffering_time, self.ioloop)
@@ -314,7 +610,7 @@ class Stream(object):
         is started. User code won't probably need to call it.
 
         """
-        if self.buffering_time:
+        if self.buffering_time and self._adaptive_buffering is None:
             self.buffer_dump_sched.start()
         ## self.stats_sched.start()
 
@@ -328,7 +624,8 @@ class Stream(object):
         ## self.dispatch_event(events.create_command(self.source_id,
         ##                                           'Stream-Finished'))
         if self.buffering_time:
-            self.buffer_dump_sched.stop()
+            if self._adaptive_buffering is None:
+                self.buffer_dump_sched.stop()
             self._dump_buffer()
         self.dispatcher.close()
         ## self.stats_sched.stop()
@@ -356,11 +653,38 @@ class Stream(object):
 #            logger.logger.event_published(e)
         if self.event_adapter:
             evs = self.event_adapter(evs)
+        if self._fanout is not None:
+            self._fanout(self, evs)
+        else:
+            self._dispatch_local(evs)
+
+    def _dispatch_local(self, evs):
+        evs = self.dispatcher.assign_sequence_numbers(evs)
         self.dispatcher.dispatch_immediate(evs)
         if self.buffering_time is None:
             self.dispatcher.dispatch(evs)
         else:
             self._event_buffer.extend(evs)
+            if (self.max_buffered_events is not None
+                and len(self._event_buffer) >= self.max_buffered_events):
+                self._dump_buffer()
+            elif (self._adaptive_buffering is not None
+                  and self._dump_timeout is None):
+                window = self._adaptive_buffering.window()
+                if window:
+                    self._dump_timeout = self.ioloop.call_later( \
+                                                    window, self._dump_buffer)
+                else:
+                    self._dump_buffer()
+        return evs
+
+    @property
+    def effective_buffering_time(self):
+        """The time (in milliseconds) events are currently buffered."""
+        if self._adaptive_buffering is not None:
+            return 1000 * self._adaptive_buffering.window()
+        else:
+            return self.buffering_time
 
     def create_local_client(self, callback, separate_events=True):
         """Creates a local client for this stream.
@@ -379,15 +703,59 @@ class Stream(object):
         return client
 
     def preload_recent_events_buffer_from_file(self, file_):
-        self.dispatcher.recent_events.load_from_file(file_)
+        deserializer = events.Deserializer()
+        for evs in deserializer.deserialize_file(file_):
+            evs = self.dispatcher.assign_sequence_numbers(evs)
+            self.dispatcher.recent_events.append_events(evs)
+
+    def recent_events_stats(self):
+        """Returns a dictionary with the occupancy of the buffer of
+        recent events (number of events and bytes, evictions, etc.).
+
+        """
+        return self.dispatcher.recent_events.stats()
+
+    def clients_stats(self):
+        """Returns a list with a dictionary for each streaming client
+        (pending bytes, bytes sent, times it was suspended, etc.).
+
+        """
+        return self.dispatcher.clients_stats()
+
+    def _init_worker(self, ioloop, fanout):
+        """Prepares the stream to run in a worker process of the server."""
+        self.ioloop = ioloop
+        self._fanout = fanout
+        if self.buffering_time and self._adaptive_buffering is None:
+            self.buffer_dump_sched = \
+                tornado.ioloop.PeriodicCallback(self._dump_buffer,
+                                                self.buffering_time, ioloop)
+        self.dispatcher._init_worker(ioloop)
+
+    def _deserialize_fanout(self, data):
+        deserializer = events.Deserializer()
+        return deserializer.deserialize(data,
+                                        parse_body=self.parse_event_body,
+                                        complete=True)
 
     def _dump_buffer(self):
-        self.dispatcher.dispatch(self._event_buffer)
+        evs = self._event_buffer
         self._event_buffer = []
+        if self._adaptive_buffering is None:
+            self.dispatcher.dispatch(evs)
+        else:
+            if self._dump_timeout is not None:
+                self.ioloop.remove_timeout(self._dump_timeout)
+                self._dump_timeout = None
+            start = time.time()
+            self.dispatcher.dispatch(evs)
+            self._adaptive_buffering.batch_dispatched(len(evs),
+                                                      time.time() - start)
 
     def _finish_when_possible(self):
         self.dispatcher._auto_finish = True
-        if self.buffering_time is None or self.buffering_time <= 0:
+        if (self.buffering_time is None or self.buffering_time <= 0
+            or self._adaptive_buffering is not None):
             self.ioloop.add_timeout(timedelta(seconds=20), self._finish)
 
     def _finish(self):
@@ -408,10 +776,24 @@ class RelayStream(Stream):
                  allow_publish=False,
                  buffering_time=None,
                  num_recent_events=2048,
+                 recent_events_max_bytes=None,
+                 recent_events_max_age=None,
+                 event_log_dir=None,
+                 event_log_max_bytes=None,
+                 event_log_max_age=None,
                  event_adapter=None,
                  parse_event_body=False,
                  label=None,
                  retrieve_missing_events=False,
+                 shared_compression=False,
+                 compression_dictionary=False,
+                 parser_pool=None,
+                 max_client_pending_bytes=16777216,
+                 slow_client_policy='close',
+                 adaptive_buffering=False,
+                 latency_target=None,
+                 max_buffered_events=None,
+                 dispatch_tiers=None,
                  ioloop=None,
                  stop_when_source_finishes=False):
         """Creates a new relay stream.
@@ -434,6 +816,10 @@ class RelayStream(Stream):
         to True in order to do that.
         If 'retrieve_missing_events' is True, a non-empty label must be set.
 
+        A 'parser_pool' is used both by the stream and by the client
+        that receives the relayed events, when 'parse_event_body' is
+        True.
+
         The rest of the parameters are as described in the constructor
         of the Stream class.
 
@@ -442,8 +828,32 @@ class RelayStream(Stream):
                                           allow_publish=allow_publish,
                                           buffering_time=buffering_time,
                                           num_recent_events=num_recent_events,
+                                          recent_events_max_bytes=\
+                                              recent_events_max_bytes,
+                                          recent_events_max_age=\
+                                              recent_events_max_age,
+                                          event_log_dir=event_log_dir,
+                                          event_log_max_bytes=\
+                                              event_log_max_bytes,
+                                          event_log_max_age=\
+                                              event_log_max_age,
                                           event_adapter=event_adapter,
                                           parse_event_body=parse_event_body,
+                                          shared_compression=\
+                                              shared_compression,
+                                          compression_dictionary=\
+                                              compression_dictionary,
+                                          parser_pool=parser_pool,
+                                          max_client_pending_bytes=\
+                                              max_client_pending_bytes,
+                                          slow_client_policy=\
+                                              slow_client_policy,
+                                          adaptive_buffering=\
+                                              adaptive_buffering,
+                                          latency_target=latency_target,
+                                          max_buffered_events=\
+                                              max_buffered_events,
+                                          dispatch_tiers=dispatch_tiers,
                                           ioloop=ioloop)
         if filter_ is not None:
             filter_.callback = self._relay_events
@@ -458,6 +868,7 @@ class RelayStream(Stream):
                         separate_events=False,
                         label=label,
                         retrieve_missing_events=retrieve_missing_events,
+                        parser_pool=parser_pool,
                         ioloop=ioloop)
 
     def start(self):
@@ -499,30 +910,80 @@ class RelayStream(Stream):
 
 
 class _Client(object):
-    def __init__(self, handler, callback, properties):
+    def __init__(self, handler, callback, properties, dictionary=None,
+                 max_pending_bytes=None):
         self.handler = handler
         self.callback = callback
         self.properties = properties
+        self.dictionary = dictionary
+        self.max_pending_bytes = max_pending_bytes
         self.closed = False
         self.creation_time = time.time()
         self.is_fresh = True
+        self.suspended = False
+        self.bytes_sent = 0
+        self.num_suspensions = 0
+        # Used only if the IOStream does not count its pending bytes
+        self._bytes_drained = 0
+        self._drain_mark = None
 
     def send(self, data, flush=True):
+        if self.suspended:
+            return
         self.callback(data, flush=flush)
+        self.bytes_sent += len(data)
         if data:
             self.is_fresh = False
-
-    def send_initial_events(self, evs):
-        serialized = ztreamy.serialize_events( \
-                                evs,
-                                serialization=self.properties.serialization)
-        if self.properties.encoding == ClientProperties.ENCODING_PLAIN:
-            data = serialized
-        elif self.properties.encoding == ClientProperties.ENCODING_ZLIB:
-            data = dispatchers.compress_zlib(serialized)
-        elif self.properties.encoding == ClientProperties.ENCODING_GZIP:
-            data = dispatchers.compress_gzip(serialized)
-        self.send(data)
+            if (self.max_pending_bytes is not None
+                and self.pending_bytes() > self.max_pending_bytes):
+                self.handler.dispatcher.slow_client(self)
+
+    def pending_bytes(self):
+        """Returns the number of bytes the connection has not sent yet."""
+        stream = self._iostream()
+        if (hasattr(stream, '_total_write_index')
+            and hasattr(stream, '_total_write_done_index')):
+            # Private attributes of Tornado's IOStream (4.5 to 6.x)
+            return stream._total_write_index - stream._total_write_done_index
+        return self._count_pending_bytes(stream)
+
+    def _count_pending_bytes(self, stream):
+        # Bytes sent since the connection was last seen drained.
+        # Writing no data returns a Future that resolves when the
+        # data already written has been sent.
+        if self._drain_mark is None and not stream.closed():
+            self._drain_mark = self.bytes_sent
+            stream.write(b'').add_done_callback(self._drained)
+        return self.bytes_sent - self._bytes_drained
+
+    def _drained(self, future):
+        self._bytes_drained = self._drain_mark
+        self._drain_mark = None
+
+    def wait_for_drain(self):
+        """Returns a Future that resolves when the pending data is sent."""
+        stream = self._iostream()
+        if stream.closed():
+            future = tornado.concurrent.Future()
+            future.set_result(None)
+            return future
+        # Writing no data just waits for the data already written
+        return stream.write(b'')
+
+    def stats(self):
+        return {
+            'properties': str(self.properties),
+            'remote_ip': self.handler.request.remote_ip,
+            'age': time.time() - self.creation_time,
+            'pending_bytes': self.pending_bytes(),
+            'bytes_sent': self.bytes_sent,
+            'suspensions': self.num_suspensions,
+            'suspended': self.suspended,
+        }
+
+    def abort(self):
+        """Closes the connection without sending the pending data."""
+        self._iostream().close()
 
     def close(self):
         """Closes the connection to this client.
@@ -531,10 +992,24 @@ class _Client(object):
 
         """
         self.closed = True
-        if not self.handler.request.connection.stream.closed():
+        if not self._iostream().closed():
             ## logging.info('Finishing a client...')
             self.handler.finish()
 
+    def _iostream(self):
+        return self.handler.request.connection.stream
+
+
+class _WebSocketClient(_Client):
+    """A streaming client connected through a WebSocket."""
+    def close(self):
+        self.closed = True
+        if self.handler.ws_connection is not None:
+            self.handler.close()
+
+    def _iostream(self):
+        return self.handler.stream
+
 
 class _LocalClient(object):
     """Handle for a local client.
@@ -571,17 +1046,103 @@ class _LocalClient(object):
                 self.callback(event)
 
 
+class _ProcessChannel(object):
+    """Connection between the master process and a worker process.
+
+    Each message carries the index of a stream in the server and a
+    block of serialized events of that stream.
+
+    """
+    def __init__(self, socket_, ioloop, message_callback, close_callback):
+        self.message_callback = message_callback
+        self.stream = tornado.iostream.IOStream(socket_, io_loop=ioloop)
+        self.stream.set_close_callback(close_callback)
+        self._stream_index = None
+        self._read_header()
+
+    def send(self, stream_index, data):
+        if not self.stream.closed():
+            self.stream.write('{0} {1}\n'.format(stream_index, len(data))
+                              + data)
+
+    def close(self):
+        self.stream.close()
+
+    def _read_header(self):
+        if not self.stream.closed():
+            self.stream.read_until('\n', self._on_header)
+
+    def _on_header(self, line):
+        stream_index, length = line.split()
+        self._stream_index = int(stream_index)
+        self.stream.read_bytes(int(length), self._on_data)
+
+    def _on_data(self, data):
+        self.message_callback(self._stream_index, data)
+        self._read_header()
+
+
 class _EventDispatcher(object):
-    def __init__(self, stream, num_recent_events=2048, ioloop=None):
+    # The first compression dictionary is built after this number
+    # of events, and a new one every 'dictionary_period' events.
+    # Dictionaries depend only on the sequence of events, so that
+    # all the worker processes of a server build the same ones.
+    dictionary_first = 32
+    dictionary_period = 8192
+    dictionary_max_events = 256
+    dictionary_max_size = 16384
+    dictionary_history = 4
+
+    def __init__(self, stream, num_recent_events=2048,
+                 recent_events_max_bytes=None, recent_events_max_age=None,
+                 event_log_dir=None, event_log_max_bytes=None,
+                 event_log_max_age=None, ioloop=None,
+                 shared_compression=False, compression_dictionary=False,
+                 max_client_pending_bytes=None, slow_client_policy='close',
+                 dispatch_tiers=None):
+        if slow_client_policy not in ('close', 'skip', 'demote'):
+            raise ValueError('Unknown slow client policy: '
+                             + str(slow_client_policy))
         self.stream = stream
+        self.max_client_pending_bytes = max_client_pending_bytes
+        self.slow_client_policy = slow_client_policy
+        # Clients waiting for their connection to drain
+        self.suspended_clients = set()
+        self.dispatch_tiers = frozenset(dispatch_tiers or ())
+        # Delay -> _DispatchTier, created as clients subscribe
+        self.tiers = {}
         self.dispatchers = {}
         self.immediate_dispatchers = []
         self.buffered_dispatchers = []
+        self.shared_compression = shared_compression
         self._init_dispatchers()
+        # Filter expression -> _FilterGroup
+        self.filter_groups = {}
+        self.filter_router = filters.FilterRouter()
+        if compression_dictionary:
+            self.dictionaries = OrderedDict()
+            self._init_dictionary_dispatchers()
+        else:
+            self.dictionaries = None
+        self.dictionary = None
+        self._num_events = 0
         self.last_event_time = time.time()
         self._auto_finish = False
         self.ioloop = ioloop or tornado.ioloop.IOLoop.instance()
-        self.recent_events = _RecentEventsBuffer(num_recent_events)
+        self.recent_events = _RecentEventsBuffer( \
+                                        num_recent_events,
+                                        max_bytes=recent_events_max_bytes,
+                                        max_age=recent_events_max_age)
+        if event_log_dir is not None:
+            self.event_log = eventlog.EventLog(event_log_dir,
+                                               max_bytes=event_log_max_bytes,
+                                               max_age=event_log_max_age)
+            evs, first_sequence = self.event_log.read_recent( \
+                                                num_recent_events)
+            self.recent_events.restore(evs, first_sequence)
+        else:
+            self.event_log = None
+        self.next_sequence = self.recent_events.num_events
         self.periodic_maintenance_timer = tornado.ioloop.PeriodicCallback( \
                                                    self._periodic_maintenance,
                                                    60000,
@@ -590,42 +1151,166 @@ class _EventDispatcher(object):
 
     @property
     def num_clients(self):
-        return sum(len(dispatcher) for dispatcher in self.dispatchers.values())
+        return (sum(len(dispatcher) for dispatcher in self.dispatchers.values())
+                + sum(group.num_clients
+                      for group in self.filter_groups.values()))
 
     def register_client(self, client, last_event_seen=None,
-                        past_events_limit=None, non_blocking=False):
-        dispatcher = self.dispatchers.get(client.properties, None)
+                        past_events_limit=None, non_blocking=False,
+                        from_sequence=None, filter_=None):
+        """Subscribes a client to the stream.
+
+        If a 'filter_' (see 'filters.parse_filter') is given, the
+        client receives only the events selected by it. Clients with
+        the same filter expression share the filter and the work of
+        serializing and compressing the events they select.
+
+        """
+        if filter_ is not None:
+            group = self.filter_groups.get(filter_.expression)
+            if group is None:
+                group = _FilterGroup(self.stream, filter_,
+                                     self.shared_compression)
+                self.filter_groups[filter_.expression] = group
+                self.filter_router.add_filter(group.filter)
+            dispatcher = group.dispatcher(client.properties)
+        else:
+            group = None
+            dispatcher = self._dispatcher(client.properties)
         if dispatcher is None:
             raise ValueError('Not appropriate dispatcher')
         past_data = []
-        if last_event_seen:
+        # Sequence number from which the client wants the events
+        resume = None
+        if from_sequence is not None:
+            past_data, none_lost = self.recent_events.from_sequence( \
+                                            from_sequence,
+                                            limit=past_events_limit,
+                                            next_sequence=self.next_sequence)
+            resume = from_sequence if none_lost else past_data.start
+        elif last_event_seen:
             # Send the available events after the last seen event
             past_data, none_lost = self.recent_events.newer_than( \
                                                     last_event_seen,
                                                     limit=past_events_limit)
+            resume = past_data.start
         elif past_events_limit is not None:
             past_data = self.recent_events.most_recent(past_events_limit)
+            resume = past_data.start
+        if group is not None and past_data:
+            past_data = group.select(past_data)
+        most_recent = group is None
+        tier = None
+        if (client.properties.tier is not None and group is None
+            and resume is not None):
+            tier = self.tiers[client.properties.tier]
+            first = tier.first_buffered()
+            if first is None or resume <= first:
+                tier = None
+            if first is not None:
+                # The events still buffered by the tier reach the client
+                # when the tier flushes them, so they are not replayed
+                keep = max(0, first - past_data.start)
+                if keep < len(past_data):
+                    past_data = past_data[:keep]
+                    most_recent = False
         if past_data or non_blocking:
-            client.send_initial_events(past_data)
+            if not most_recent:
+                client.send(_encode_events(past_data,
+                                           client.properties.serialization,
+                                           client.properties.encoding))
+            else:
+                # The past events are always the most recent ones
+                client.send(self.recent_events.serialize_most_recent( \
+                                        len(past_data),
+                                        client.properties.serialization,
+                                        client.properties.encoding,
+                                        dictionary=client.dictionary))
             if not client.properties.streaming:
                 client.close()
         if not client.closed:
             dispatcher.subscribe(client)
             client.dispatcher = dispatcher
+            if tier is not None:
+                tier.resume_client(client, resume)
 
     def deregister_client(self, client):
         client.dispatcher.unsubscribe(client)
         client.close()
 
+    def slow_client(self, client):
+        """Handles a client whose connection does not keep up.
+
+        Depending on 'slow_client_policy', the client is disconnected
+        ('close') or it skips the events dispatched until its
+        connection sends its pending data ('skip'), after which it
+        may be moved to a slower dispatch tier ('demote'). Either way,
+        the memory the connection uses stays bounded. The client can tell
+        the events it missed by the gap in their sequence numbers.
+
+        """
+        if client.closed or client.suspended:
+            return
+        logging.warning('{}: slow client {} with {} pending bytes'.format( \
+                                                self.stream.path,
+                                                client.handler.request.remote_ip,
+                                                client.pending_bytes()))
+        # Clients cannot be unsubscribed while being dispatched to
+        if self.slow_client_policy == 'close':
+            client.abort()
+            self.ioloop.add_callback(self._drop_client, client)
+        else:
+            client.suspended = True
+            client.num_suspensions += 1
+            self.suspended_clients.add(client)
+            self.ioloop.add_callback(self._suspend_client, client)
+
+    def clients_stats(self):
+        """Returns a list with the statistics of the streaming clients."""
+        clients = list(self.suspended_clients)
+        for dispatcher in self._all_dispatchers():
+            if dispatcher.properties.streaming:
+                clients.extend(c for c in dispatcher.subscriptions
+                               if hasattr(c, 'stats'))
+        return [client.stats() for client in clients]
+
+    def assign_sequence_numbers(self, evs):
+        """Stamps the events with the next sequence numbers of the stream.
+
+        The numbers match the positions the events will have in the
+        buffer of recent events and in the event log. Returns the list
+        of stamped events, which contains copies of the events that
+        another stream already stamped (see
+        'Event.stamp_sequence_number()').
+
+        """
+        seq = self.next_sequence
+        stamped = []
+        for event in evs:
+            stamped.append(event.stamp_sequence_number(seq))
+            seq += 1
+        self.next_sequence = seq
+        return stamped
+
     def dispatch_immediate(self, evs):
         pack = dispatchers.EventsPack(evs)
         for dispatcher in self.immediate_dispatchers:
             dispatcher.dispatch(pack)
+        for tier in self.tiers.values():
+            tier.add_events(evs, pack)
+        # The filters are evaluated again in the buffered pass, and
+        # therefore only for groups that have priority clients
+        if self.filter_groups and any(group.has_clients(True)
+                                      for group in self.filter_groups.values()):
+            self._dispatch_filtered(evs, True)
 
     def dispatch(self, evs):
-        logging.info('{}: server cycle; events: {}'.format(self.stream.path,
-                                                           len(evs)))
+        logging.info('%s: server cycle; events: %d', self.stream.path, len(evs))
         self.recent_events.append_events(evs)
+        if self.event_log is not None:
+            self.event_log.append(evs)
+        if self.dictionaries is not None and evs:
+            self._update_dictionary(len(evs))
         if not evs:
             if self._auto_finish and time.time() - self.last_event_time > 60:
                 logger.logger.server_closed(self.num_clients)
@@ -635,97 +1320,438 @@ class _EventDispatcher(object):
             self.last_event_time = time.time()
         pack = dispatchers.EventsPack(evs)
         for dispatcher in self.buffered_dispatchers:
-            dispatcher.dispatch(pack)
-            if evs and not dispatcher.properties.streaming:
-                dispatcher.close()
-            for e in evs:
-                logger.logger.event_dispatched(e)
+            if len(dispatcher):
+                dispatcher.dispatch(pack)
+                if evs and not dispatcher.properties.streaming:
+                    dispatcher.close()
+        logger.events_dispatched(evs)
+        if self.filter_groups:
+            self._dispatch_filtered(evs, False)
 
     def close(self):
         """Closes every active streaming client."""
+        for tier in self.tiers.values():
+            tier.close()
         for dispatcher in self.dispatchers.values():
             dispatcher.close()
+        for group in self.filter_groups.values():
+            group.close()
+        self.filter_groups = {}
+        self.filter_router = filters.FilterRouter()
+        if self.event_log is not None:
+            self.event_log.close()
+
+    def _drop_client(self, client):
+        # The client may have been deregistered meanwhile
+        if not client.closed:
+            self.deregister_client(client)
+
+    def _suspend_client(self, client):
+        client.dispatcher.unsubscribe(client)
+        self.ioloop.add_future(client.wait_for_drain(),
+                               lambda future: self._resume_client(client))
+
+    def _resume_client(self, client):
+        self.suspended_clients.discard(client)
+        client.suspended = False
+        if client.closed or client._iostream().closed():
+            return
+        if self.slow_client_policy == 'demote':
+            self._demote_client(client)
+        # The dispatcher resynchronizes the compressed stream
+        # of the client as if it had just subscribed
+        client.dictionary = None
+        client.dispatcher.subscribe(client)
+
+    def _demote_client(self, client):
+        # Moves an unfiltered client to the next slower tier, if any
+        properties = client.properties
+        if (self.dispatchers.get(properties) is not client.dispatcher
+            or properties.local):
+            return
+        if properties.tier is not None:
+            delay = properties.tier
+        elif properties.priority:
+            delay = 0
+        else:
+            delay = self.stream.buffering_time or 0
+        slower = [tier for tier in self.dispatch_tiers if tier > delay]
+        if not slower:
+            return
+        properties = ClientPropertiesFactory.create( \
+                                    streaming=True,
+                                    serialization=properties.serialization,
+                                    encoding=properties.encoding,
+                                    tier=min(slower))
+        dispatcher = self._dispatcher(properties)
+        if dispatcher is not None:
+            client.properties = properties
+            client.dispatcher = dispatcher
+
+    def _tier_dispatcher(self, properties):
+        if (properties.tier not in self.dispatch_tiers
+            or properties.encoding == ClientProperties.ENCODING_ZLIB_DICT):
+            return None
+        dispatcher = _new_dispatcher(self.stream, properties,
+                                     self.shared_compression)
+        tier = self.tiers.get(properties.tier)
+        if tier is None:
+            tier = _DispatchTier(properties.tier, self.ioloop)
+            self.tiers[properties.tier] = tier
+        tier.dispatchers.append(dispatcher)
+        self.dispatchers[properties] = dispatcher
+        return dispatcher
+
+    def _all_dispatchers(self):
+        for dispatcher in self.dispatchers.values():
+            yield dispatcher
+        for group in self.filter_groups.values():
+            for dispatcher in group.dispatchers.values():
+                yield dispatcher
+
+    def _dispatch_filtered(self, evs, priority):
+        # The router evaluates the filters of all the groups at once
+        if evs:
+            self.filter_router.filter_events(evs)
+        for group in self.filter_groups.values():
+            selected = group.take_selected()
+            if group.has_clients(priority):
+                group.dispatch(selected, priority)
+
+    def _update_dictionary(self, num_new_events):
+        previous = self._num_events
+        self._num_events += num_new_events
+        if previous < self.dictionary_first <= self._num_events:
+            milestone = self.dictionary_first
+        else:
+            milestone = self._num_events - (self._num_events
+                                            % self.dictionary_period)
+            if milestone <= previous:
+                return
+        # Use the events up to the milestone
+        extra = self._num_events - milestone
+        evs = self.recent_events.most_recent(self.dictionary_max_events
+                                             + extra)
+        if extra:
+            evs = evs[:-extra]
+        dictionary = dispatchers.CompressionDictionary.train( \
+                                        evs,
+                                        max_size=self.dictionary_max_size)
+        if dictionary is not None:
+            self.dictionaries[dictionary.dictionary_id] = dictionary
+            while len(self.dictionaries) > self.dictionary_history:
+                self.dictionaries.popitem(last=False)
+            self.dictionary = dictionary
+
+    def _init_worker(self, ioloop):
+        self.ioloop = ioloop
+        self.periodic_maintenance_timer = tornado.ioloop.PeriodicCallback( \
+                                                   self._periodic_maintenance,
+                                                   60000,
+                                                   io_loop=self.ioloop)
+        self.periodic_maintenance_timer.start()
+        # Local clients belong to the master process
+        properties = ClientPropertiesFactory.create_local_client()
+        if properties in self.dispatchers:
+            self.dispatchers[properties].subscriptions = []
+        if self.event_log is not None:
+            self.event_log._init_worker()
 
     def _periodic_maintenance(self):
+        self._remove_idle_dispatchers()
         for dispatcher in self.dispatchers.values():
             dispatcher.periodic_maintenance()
+        for group in self.filter_groups.values():
+            group.periodic_maintenance()
 
     def _init_dispatchers(self):
-        # Streaming dispatcher, plain encoding, ztreamy serialization:
-        properties = ClientPropertiesFactory.create( \
-                                streaming=True)
-        dispatcher = dispatchers.SimpleDispatcher(self.stream, properties)
-        self.dispatchers[properties] = dispatcher
-        self.buffered_dispatchers.append(dispatcher)
-        # Streaming dispatcher, zlib encoding, ztreamy serialization:
-        properties = ClientPropertiesFactory.create( \
-                                streaming=True,
-                                encoding=ClientProperties.ENCODING_ZLIB)
-        dispatcher = dispatchers.ZlibDispatcher(self.stream, properties)
-        self.dispatchers[properties] = dispatcher
-        self.buffered_dispatchers.append(dispatcher)
-        # Streaming dispatcher, pain encoding, json serialization:
-        properties = ClientPropertiesFactory.create( \
-                                streaming=True,
-                                serialization=ztreamy.SERIALIZATION_LDJSON)
-        dispatcher = dispatchers.SimpleDispatcher(self.stream, properties)
-        self.dispatchers[properties] = dispatcher
-        self.buffered_dispatchers.append(dispatcher)
-        # Streaming dispatcher, zlib encoding, json serialization:
-        properties = ClientPropertiesFactory.create( \
-                                streaming=True,
-                                serialization=ztreamy.SERIALIZATION_LDJSON,
-                                encoding=ClientProperties.ENCODING_ZLIB)
-        dispatcher = dispatchers.ZlibDispatcher(self.stream, properties)
-        self.dispatchers[properties] = dispatcher
-        self.buffered_dispatchers.append(dispatcher)
-        # Long polling dispatcher, plain encoding, ztreamy serialization:
-        properties = ClientPropertiesFactory.create()
-        dispatcher = dispatchers.SimpleDispatcher(self.stream, properties)
-        self.dispatchers[properties] = dispatcher
-        self.buffered_dispatchers.append(dispatcher)
-        # Long polling dispatcher, plain encoding, json serialization:
-        properties = ClientPropertiesFactory.create( \
-                                serialization=ztreamy.SERIALIZATION_JSON)
-        dispatcher = dispatchers.SimpleDispatcher(self.stream, properties)
-        self.dispatchers[properties] = dispatcher
-        self.buffered_dispatchers.append(dispatcher)
-        # Long polling dispatcher, gzip encoding, ztreamy serialization:
-        properties = ClientPropertiesFactory.create( \
-                                encoding=ClientProperties.ENCODING_GZIP)
-        dispatcher = dispatchers.SimpleDispatcher(self.stream, properties)
-        self.dispatchers[properties] = dispatcher
-        self.buffered_dispatchers.append(dispatcher)
-        # Long polling dispatcher, gzip encoding, json serialization:
-        properties = ClientPropertiesFactory.create( \
-                                serialization=ztreamy.SERIALIZATION_JSON,
-                                encoding=ClientProperties.ENCODING_GZIP)
-        dispatcher = dispatchers.SimpleDispatcher(self.stream, properties)
-        self.dispatchers[properties] = dispatcher
-        self.buffered_dispatchers.append(dispatcher)
+        # Properties of the clients the stream accepts, and whether
+        # their dispatchers are immediate. The dispatchers are created
+        # when their first client subscribes (see '_dispatcher').
+        self.dispatcher_kinds = {}
+        for serialization in (ztreamy.SERIALIZATION_ZTREAMY,
+                              ztreamy.SERIALIZATION_LDJSON):
+            # Streaming dispatchers, plain and zlib encodings
+            for encoding in (ClientProperties.ENCODING_PLAIN,
+                             ClientProperties.ENCODING_ZLIB):
+                properties = ClientPropertiesFactory.create( \
+                                    streaming=True,
+                                    serialization=serialization,
+                                    encoding=encoding)
+                self.dispatcher_kinds[properties] = False
+        for serialization in (ztreamy.SERIALIZATION_ZTREAMY,
+                              ztreamy.SERIALIZATION_JSON):
+            # Long polling dispatchers, plain and gzip encodings
+            for encoding in (ClientProperties.ENCODING_PLAIN,
+                             ClientProperties.ENCODING_GZIP):
+                properties = ClientPropertiesFactory.create( \
+                                    serialization=serialization,
+                                    encoding=encoding)
+                self.dispatcher_kinds[properties] = False
         # Priority dispatcher
         properties = ClientPropertiesFactory.create( \
                                 streaming=True,
                                 priority=True)
-        dispatcher = dispatchers.SimpleDispatcher(self.stream, properties)
-        self.dispatchers[properties] = dispatcher
-        self.immediate_dispatchers.append(dispatcher)
+        self.dispatcher_kinds[properties] = True
         # Local dispatcher
         properties = ClientPropertiesFactory.create_local_client()
-        dispatcher = dispatchers.LocalDispatcher(self.stream, properties)
-        self.dispatchers[properties] = dispatcher
-        self.immediate_dispatchers.append(dispatcher)
+        self.dispatcher_kinds[properties] = True
+
+    def _init_dictionary_dispatchers(self):
+        for serialization in (ztreamy.SERIALIZATION_ZTREAMY,
+                              ztreamy.SERIALIZATION_LDJSON):
+            # Streaming dispatcher, zlib with dictionary encoding
+            properties = ClientPropertiesFactory.create( \
+                                streaming=True,
+                                serialization=serialization,
+                                encoding=ClientProperties.ENCODING_ZLIB_DICT)
+            self.dispatcher_kinds[properties] = False
+        for serialization in (ztreamy.SERIALIZATION_ZTREAMY,
+                              ztreamy.SERIALIZATION_JSON):
+            # Long polling dispatcher, zlib with dictionary encoding
+            properties = ClientPropertiesFactory.create( \
+                                serialization=serialization,
+                                encoding=ClientProperties.ENCODING_ZLIB_DICT)
+            self.dispatcher_kinds[properties] = False
+
+    def _dispatcher(self, properties):
+        """Returns the dispatcher for unfiltered clients with
+        'properties', creating it if necessary.
+
+        Returns None for properties the stream does not accept.
+
+        """
+        dispatcher = self.dispatchers.get(properties)
+        if dispatcher is None:
+            if properties.tier is not None:
+                return self._tier_dispatcher(properties)
+            immediate = self.dispatcher_kinds.get(properties)
+            if immediate is None:
+                return None
+            dispatcher = _new_dispatcher(self.stream, properties,
+                                         self.shared_compression)
+            self.dispatchers[properties] = dispatcher
+            if immediate:
+                self.immediate_dispatchers.append(dispatcher)
+            else:
+                self.buffered_dispatchers.append(dispatcher)
+        return dispatcher
+
+    def _remove_idle_dispatchers(self):
+        # Suspended clients will subscribe again to their dispatchers
+        in_use = set(client.dispatcher for client in self.suspended_clients)
+        for properties, dispatcher in self.dispatchers.items():
+            if not len(dispatcher) and dispatcher not in in_use:
+                del self.dispatchers[properties]
+                if dispatcher in self.immediate_dispatchers:
+                    self.immediate_dispatchers.remove(dispatcher)
+                elif dispatcher in self.buffered_dispatchers:
+                    self.buffered_dispatchers.remove(dispatcher)
+                elif properties.tier is not None:
+                    tier = self.tiers[properties.tier]
+                    tier.dispatchers.remove(dispatcher)
+                    if not tier.dispatchers:
+                        tier.close()
+                        del self.tiers[properties.tier]
+        for expression, group in self.filter_groups.items():
+            if (not group.num_clients
+                and not in_use.intersection(group.dispatchers.values())):
+                del self.filter_groups[expression]
+                self.filter_router.remove_filter(group.filter)
+
+
+class _FilterGroup(object):
+    """The clients of a stream that share a server-side filter.
+
+    The filter is evaluated once for every batch of events (the
+    stream routes the events to the filters of all its groups with
+    a 'filters.FilterRouter'). The selected events are dispatched to
+    the clients of the group, which have their own dispatchers
+    depending on their properties. Events are filtered as they are
+    published too, before being buffered, only while some group has
+    priority clients.
+
+    """
+    def __init__(self, stream, filter_, shared_compression=False):
+        self.stream = stream
+        self.filter = filter_
+        self.filter.callback = self._select_event
+        self.shared_compression = shared_compression
+        self.dispatchers = {}
+        self._selected = []
+
+    @property
+    def num_clients(self):
+        return sum(len(dispatcher) for dispatcher in self.dispatchers.values())
+
+    def dispatcher(self, properties):
+        """Returns the dispatcher for clients with 'properties'.
+
+        Returns None for properties filtered clients cannot have.
+
+        """
+        dispatcher = self.dispatchers.get(properties)
+        if dispatcher is None:
+            if (properties.local or properties.tier is not None
+                or properties.encoding == ClientProperties.ENCODING_ZLIB_DICT):
+                return None
+            dispatcher = _new_dispatcher(self.stream, properties,
+                                         self.shared_compression)
+            self.dispatchers[properties] = dispatcher
+        return dispatcher
+
+    def select(self, evs):
+        """Returns the list of events the filter selects from 'evs'."""
+        self.filter.filter_events(evs)
+        return self.take_selected()
+
+    def take_selected(self):
+        """Returns the events selected since the last call."""
+        selected = self._selected
+        self._selected = []
+        return selected
+
+    def has_clients(self, priority):
+        for dispatcher in self.dispatchers.values():
+            if dispatcher.properties.priority == priority and len(dispatcher):
+                return True
+        return False
+
+    def dispatch(self, selected, priority):
+        """Dispatches the selected events to the priority clients
+        (if 'priority' is True) or to the rest of the clients.
+
+        """
+        pack = dispatchers.EventsPack(selected)
+        for dispatcher in self.dispatchers.values():
+            if dispatcher.properties.priority == priority and len(dispatcher):
+                dispatcher.dispatch(pack)
+                if selected and not dispatcher.properties.streaming:
+                    dispatcher.close()
+
+    def close(self):
+        for dispatcher in self.dispatchers.values():
+            dispatcher.close()
+
+    def periodic_maintenance(self):
+        for dispatcher in self.dispatchers.values():
+            dispatcher.periodic_maintenance()
+
+    def _select_event(self, event):
+        self._selected.append(event)
+
+
+class _DispatchTier(object):
+    """The streaming clients that receive events with a given delay.
+
+    Events are buffered for 'delay' milliseconds since the first of
+    them arrives, and then dispatched to the dispatchers of the tier.
+    A tier with no delay dispatches events as they arrive. Events
+    are not buffered while the tier has no clients.
+
+    """
+    def __init__(self, delay, ioloop):
+        self.delay = delay
+        self.ioloop = ioloop
+        self.dispatchers = []
+        self._buffer = []
+        self._timeout = None
+        # Client -> sequence number from which it receives events
+        self._resuming = {}
+
+    def add_events(self, evs, pack):
+        if not any(len(dispatcher) for dispatcher in self.dispatchers):
+            return
+        if not self.delay:
+            self._dispatch(pack)
+        else:
+            self._buffer.extend(evs)
+            if self._timeout is None:
+                self._timeout = self.ioloop.call_later(self.delay / 1000.0,
+                                                       self.flush)
+
+    def flush(self):
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+        if self._buffer:
+            evs = self._buffer
+            self._buffer = []
+            resuming = [(client, sequence)
+                        for client, sequence in self._resuming.items()
+                        if client in client.dispatcher.subscriptions]
+            self._resuming = {}
+            for client, _ in resuming:
+                client.dispatcher.unsubscribe(client)
+            self._dispatch(dispatchers.EventsPack(evs))
+            for client, sequence in resuming:
+                pending = [e for e in evs if e.sequence_number() >= sequence]
+                if pending:
+                    client.send(self._encode_pending(client, pending))
+                client.dispatcher.subscribe(client)
+
+    def first_buffered(self):
+        """Returns the sequence number of the oldest buffered event."""
+        if self._buffer:
+            return self._buffer[0].sequence_number()
+        else:
+            return None
+
+    def resume_client(self, client, sequence):
+        """Keeps the buffered events before 'sequence' from 'client'.
+
+        The client resumed the stream after them, so that it received
+        them before, or in the replay of past events.
+
+        """
+        self._resuming[client] = sequence
+
+    def _encode_pending(self, client, evs):
+        # The compressed stream of the client may have already begun
+        serialization = client.properties.serialization
+        data = ztreamy.serialize_events(evs, serialization=serialization)
+        if client.properties.encoding == ClientProperties.ENCODING_ZLIB:
+            data = dispatchers.compress_deflate_raw(data)
+            if client.is_fresh:
+                data = dispatchers.wrap_zlib([data])
+        return data
+
+    def close(self):
+        self.flush()
+
+    def _dispatch(self, pack):
+        for dispatcher in self.dispatchers:
+            if len(dispatcher):
+                dispatcher.dispatch(pack)
+
+
+def _new_dispatcher(stream, properties, shared_compression):
+    if properties.local:
+        return dispatchers.LocalDispatcher(stream, properties)
+    elif (properties.encoding == ClientProperties.ENCODING_ZLIB
+          or (properties.encoding == ClientProperties.ENCODING_ZLIB_DICT
+              and properties.streaming)):
+        return dispatchers.ZlibDispatcher(stream, properties,
+                                          shared_compression=shared_compression)
+    else:
+        return dispatchers.SimpleDispatcher(stream, properties)
 
 
 class _GenericHandler(tornado.web.RequestHandler):
-    _q_re = re.compile(r'^\s*(\w+)\s*;\s*q=(0(\.[0-9]{1,3})?|1(\.0{1,3})?)$')
-    _attribute_re = re.compile(r'^\s*(\w+)\s*')
+    _q_re = re.compile( \
+                r'^\s*([\w-]+)\s*;\s*q=(0(\.[0-9]{1,3})?|1(\.0{1,3})?)$')
+    _attribute_re = re.compile(r'^\s*([\w-]+)\s*')
 
     def __init__(self, application, request, **kwargs):
         super(_GenericHandler, self).__init__(application, request, **kwargs)
 
     def _last_seen_parameters(self):
         last_event_seen = self.get_argument('last-seen', default=None)
+        from_sequence = self.get_argument('from-seq', default=None)
+        if from_sequence is not None:
+            if not from_sequence.isdigit():
+                raise tornado.web.HTTPError(404, 'Not Found')
+            from_sequence = int(from_sequence)
         past_events_limit = self.get_argument('past-events-limit',
                                               default=None)
         if past_events_limit == '':
@@ -743,7 +1769,32 @@ class _GenericHandler(tornado.web.RequestHandler):
             non_blocking = True
         else:
             non_blocking = False
-        return last_event_seen, past_events_limit, non_blocking
+        return last_event_seen, past_events_limit, non_blocking, from_sequence
+
+    def _filter_parameter(self):
+        expression = self.get_argument('filter', default=None)
+        if not expression:
+            return None
+        try:
+            return filters.parse_filter(expression)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+    def _tier_parameter(self):
+        value = self.get_argument('tier', default=None)
+        if value is None:
+            value = self.request.headers.get(ztreamy.tier_header)
+        if not value:
+            return None
+        if (not value.isdigit()
+            or int(value) not in self.dispatcher.dispatch_tiers):
+            raise tornado.web.HTTPError(400, 'Unknown tier: ' + value)
+        return int(value)
+
+    def _set_dictionary_header(self, dictionary):
+        self.set_header(ztreamy.dictionary_header,
+                        (self.dispatcher.stream.path + '/dictionary/'
+                         + dictionary.dictionary_id))
 
     def _select_encoding(self, acceptable_encodings):
         """Selects an appropriate encoding for the HTTP response.
@@ -850,14 +1901,19 @@ class _EventPublishHandler(_GenericHandler):
                              application_id=application_id,
                              aggregator_id=aggregator_id,
                              event_type=event_type, timestamp=timestamp)
-        event.aggregator_id.append(self.stream.source_id)
+        event.append_aggregator_id(self.stream.source_id)
         self.stream.dispatch_event(event)
         self.finish()
 
+    @tornado.gen.coroutine
     def post(self):
+        parse_queue = None
         if self.request.headers['Content-Type'] == ztreamy.event_media_type:
             deserializer = events.Deserializer()
             parse_body = self.stream.parse_event_body
+            if parse_body and self.stream.parse_queue is not None:
+                parse_queue = self.stream.parse_queue
+                parse_body = False
         elif self.request.headers['Content-Type'] == ztreamy.json_media_type:
             deserializer = events.JSONDeserializer()
             parse_body = True
@@ -867,16 +1923,117 @@ class _EventPublishHandler(_GenericHandler):
             evs = deserializer.deserialize(self.request.body,
                                            parse_body=parse_body,
                                            complete=True)
+            if parse_body:
+                _check_bodies(evs)
         except Exception as ex:
             traceback.print_exc()
             raise tornado.web.HTTPError(400, str(ex))
+        if parse_queue is not None:
+            try:
+                evs = yield parse_queue.parse_events(evs)
+            except ztreamy.ZtreamyException as ex:
+                raise tornado.web.HTTPError(400, str(ex))
+        self._publish(evs)
+        self.finish()
+
+    def _publish(self, evs):
         for event in evs:
             if event.syntax == 'ztreamy-command':
                 if event.command == 'Event-Source-Finished':
                     if self.stop_when_source_finishes:
                         self.stream._finish_when_possible()
-            event.aggregator_id.append(self.stream.source_id)
-            self.stream.dispatch_event(event)
+            event.append_aggregator_id(self.stream.source_id)
+        self.stream.dispatch_events(evs)
+
+
+@tornado.web.stream_request_body
+class _EventPublishStreamHandler(_EventPublishHandler):
+    """Receives the events of a source through a long-lived request.
+
+    The body of the POST request, usually sent with chunked transfer
+    encoding, is a sequence of serialized events. The events are
+    dispatched as soon as they are completely received, without
+    waiting for the end of the request.
+
+    """
+    SUPPORTED_METHODS = ('POST',)
+
+    def prepare(self):
+        if self.request.headers.get('Content-Type') != \
+                ztreamy.event_media_type:
+            raise tornado.web.HTTPError(400, 'Bad content type')
+        # The request lasts as long as the source publishes events
+        self.request.connection.set_max_body_size(sys.maxsize)
+        self.deserializer = events.Deserializer()
+        self.parse_body = self.stream.parse_event_body
+        self.parse_queue = None
+        if self.parse_body and self.stream.parse_queue is not None:
+            self.parse_queue = self.stream.parse_queue
+            self.parse_body = False
+        self.error = None
+        # Batches of events whose bodies are being parsed, in order
+        self._parsing = deque()
+
+    def data_received(self, chunk):
+        if self.error is not None:
+            return
+        try:
+            evs = self.deserializer.deserialize(chunk,
+                                                parse_body=self.parse_body)
+            if self.parse_body:
+                _check_bodies(evs)
+        except Exception as ex:
+            self._reject(str(ex))
+            return
+        if evs:
+            if self.parse_queue is None:
+                self._publish(evs)
+            else:
+                future = self.parse_queue.parse_events(evs)
+                self._parsing.append(future)
+                self.stream.ioloop.add_future(future, self._parsed_callback)
+
+    def _parsed_callback(self, future=None):
+        # Publishes, in order, the batches parsed so far
+        while self._parsing and self._parsing[0].done():
+            try:
+                evs = self._parsing.popleft().result()
+            except ztreamy.ZtreamyException as ex:
+                if self.error is None:
+                    self._reject(str(ex))
+            else:
+                if self.error is None:
+                    self._publish(evs)
+
+    def _reject(self, message):
+        # The response is sent without waiting for the end of the
+        # body, which may never come. Tornado closes the connection
+        # instead of reading the rest of it.
+        logging.warning('Error in published events: ' + message)
+        self.error = message
+        if not self._finished:
+            self.send_error(400)
+
+    @tornado.gen.coroutine
+    def post(self):
+        if self._finished:
+            # The request was rejected while its body was being read
+            return
+        # The batches are published here rather than in the callbacks
+        # scheduled for them, which may run after the response is sent
+        while self._parsing:
+            try:
+                yield self._parsing[0]
+            except ztreamy.ZtreamyException:
+                pass
+            self._parsed_callback()
+        if self._finished:
+            # Rejected because of an error in the last batches
+            return
+        if self.error is not None:
+            raise tornado.web.HTTPError(400, self.error)
+        if self.deserializer.pending_data() > 0:
+            raise tornado.web.HTTPError(400, 'Incomplete event at the end')
         self.finish()
 
 
@@ -892,25 +2049,50 @@ class _EventStreamHandler(_GenericHandler):
     @tornado.web.asynchronous
     def get(self):
         # non_blocking will be ignored and False used always!
-        last_event_seen, past_events_limit, non_blocking = \
+        last_event_seen, past_events_limit, non_blocking, from_sequence = \
             self._last_seen_parameters()
+        filter_ = self._filter_parameter()
+        if not self.priority:
+            tier = self._tier_parameter()
+        else:
+            tier = None
+        if tier is not None and filter_ is not None:
+            raise tornado.web.HTTPError(400, 'Filtered clients cannot '
+                                             'choose a tier')
         if ('Accept' in self.request.headers
             and ztreamy.ldjson_media_type in self.request.headers['Accept']):
             serialization = ztreamy.SERIALIZATION_LDJSON
         else:
             serialization = ztreamy.SERIALIZATION_ZTREAMY
+        # The dictionary cannot be used when past events are sent
+        # before joining the compressed stream, nor by filtered
+        # clients or clients of a tier
+        dictionary = None
+        if (last_event_seen is None and past_events_limit is None
+            and from_sequence is None and filter_ is None and tier is None):
+            dictionary = self.dispatcher.dictionary
         if not self.priority:
             if self.force_compression:
-                encoding = 'deflate'
+                acceptable_encodings = ['deflate']
             else:
-                encoding = self._select_encoding(['deflate', 'identity'])
+                acceptable_encodings = ['deflate', 'identity']
+            if dictionary is not None:
+                acceptable_encodings.append(ztreamy.dictionary_encoding)
+            encoding = self._select_encoding(acceptable_encodings)
+            if encoding is None and self.force_compression:
+                encoding = 'deflate'
         else:
             encoding = 'identity'
         if encoding is not None:
             if encoding == 'deflate':
                 encoding = ClientProperties.ENCODING_ZLIB
+            elif encoding == ztreamy.dictionary_encoding:
+                encoding = ClientProperties.ENCODING_ZLIB_DICT
+                self._set_dictionary_header(dictionary)
             else:
                 encoding = ClientProperties.ENCODING_PLAIN
+            if encoding != ClientProperties.ENCODING_ZLIB_DICT:
+                dictionary = None
             if serialization == ztreamy.SERIALIZATION_ZTREAMY:
                 self.set_header('Content-Type', ztreamy.stream_media_type)
             else:
@@ -923,13 +2105,19 @@ class _EventStreamHandler(_GenericHandler):
                                 streaming=True,
                                 serialization=serialization,
                                 encoding=encoding,
-                                priority=self.priority)
-            self.client = _Client(self, self._on_new_data, properties)
+                                priority=self.priority,
+                                tier=tier)
+            self.client = _Client(self, self._on_new_data, properties,
+                                  dictionary=dictionary,
+                                  max_pending_bytes=\
+                                      self.dispatcher.max_client_pending_bytes)
             self.dispatcher.register_client( \
                                         self.client,
                                         last_event_seen=last_event_seen,
                                         past_events_limit=past_events_limit,
-                                        non_blocking=False)
+                                        non_blocking=False,
+                                        from_sequence=from_sequence,
+                                        filter_=filter_)
         else:
             raise tornado.web.HTTPError(406, 'Not Acceptable')
 
@@ -942,6 +2130,134 @@ class _EventStreamHandler(_GenericHandler):
             self.flush()
 
 
+class _WebSocketHandler(_GenericHandler, tornado.websocket.WebSocketHandler):
+    """Sends the events of a stream through a WebSocket.
+
+    When the client accepts permessage-deflate with context takeover
+    and the default window, it joins the zlib-compressed stream of
+    the stream's dispatcher, whose data is already made of raw
+    deflate blocks ended by sync flushes. Therefore, every batch is
+    compressed once for all those clients instead of once per
+    connection. The frames are written through internals of Tornado.
+    With versions of Tornado not known to have them, Tornado
+    compresses every connection on its own.
+
+    """
+    def __init__(self, application, request, stream=None, dispatcher=None):
+        super(_WebSocketHandler, self).__init__(application, request)
+        self.dispatcher = dispatcher
+        self.client = None
+        self.serialization = ztreamy.SERIALIZATION_ZTREAMY
+        self._parameters = None
+        self._compressed = False
+        self._first_data = True
+
+    def get(self, *args, **kwargs):
+        # Bad parameters are reported before accepting the connection
+        last_event_seen, past_events_limit, _, from_sequence = \
+            self._last_seen_parameters()
+        filter_ = self._filter_parameter()
+        tier = self._tier_parameter()
+        if tier is not None and filter_ is not None:
+            raise tornado.web.HTTPError(400, 'Filtered clients cannot '
+                                             'choose a tier')
+        self._parameters = (last_event_seen, past_events_limit,
+                            from_sequence, filter_, tier)
+        super(_WebSocketHandler, self).get(*args, **kwargs)
+
+    def get_compression_options(self):
+        return {}
+
+    def select_subprotocol(self, subprotocols):
+        if 'ldjson' in subprotocols:
+            self.serialization = ztreamy.SERIALIZATION_LDJSON
+            return 'ldjson'
+        elif 'ztreamy' in subprotocols:
+            return 'ztreamy'
+        else:
+            return None
+
+    def check_origin(self, origin):
+        # Like the rest of the streams, allow cross-origin clients
+        return True
+
+    def open(self):
+        last_event_seen, past_events_limit, from_sequence, filter_, tier = \
+            self._parameters
+        self._compressed = self._shareable_compression()
+        if self._compressed:
+            encoding = ClientProperties.ENCODING_ZLIB
+        else:
+            encoding = ClientProperties.ENCODING_PLAIN
+        properties = ClientPropertiesFactory.create( \
+                                streaming=True,
+                                serialization=self.serialization,
+                                encoding=encoding,
+                                tier=tier)
+        self.client = _WebSocketClient(self, self._on_new_data, properties,
+                                       max_pending_bytes=\
+                                       self.dispatcher.max_client_pending_bytes)
+        self.dispatcher.register_client(self.client,
+                                        last_event_seen=last_event_seen,
+                                        past_events_limit=past_events_limit,
+                                        from_sequence=from_sequence,
+                                        filter_=filter_)
+
+    def on_message(self, message):
+        # Messages from clients are ignored
+        pass
+
+    def on_close(self):
+        if self.client is not None and not self.client.closed:
+            if self.client.suspended:
+                # It will not subscribe again
+                self.client.closed = True
+            else:
+                self.dispatcher.deregister_client(self.client)
+
+    def _on_new_data(self, data, flush=True):
+        if self.ws_connection is None:
+            return
+        binary = self.serialization == ztreamy.SERIALIZATION_ZTREAMY
+        if not self._compressed:
+            if data:
+                self.write_message(data, binary=binary)
+            return
+        if self._first_data:
+            # The zlib stream starts with a header that raw
+            # deflate streams do not have
+            self._first_data = False
+            header = dispatchers.wrap_zlib([])
+            if not data.startswith(header):
+                self._bad_data()
+                return
+            data = data[len(header):]
+        if data:
+            if not data.endswith(_sync_flush_trailer):
+                self._bad_data()
+                return
+            # Drop the trailer of the sync flush (RFC 7692, 7.2.1)
+            opcode = 0x2 if binary else 0x1
+            self.ws_connection._write_frame(True, opcode,
+                                            data[:-len(_sync_flush_trailer)],
+                                            flags=self.ws_connection.RSV1)
+
+    def _bad_data(self):
+        logging.error('{}: compressed data cannot be sent through '
+                      'a WebSocket'.format(self.dispatcher.stream.path))
+        self.close()
+
+    def _shareable_compression(self):
+        if not _websocket_shared_compression:
+            return False
+        connection = self.ws_connection
+        compressor = getattr(connection, '_compressor', None)
+        return (compressor is not None
+                and hasattr(connection, '_write_frame')
+                and getattr(compressor, '_compressor', None) is not None
+                and getattr(compressor, '_max_wbits', None) == zlib.MAX_WBITS)
+
+
 class _ShortLivedHandler(_GenericHandler):
     def __init__(self, application, request, dispatcher=None, stream=None):
         super(_ShortLivedHandler, self).__init__(application, request)
@@ -950,8 +2266,9 @@ class _ShortLivedHandler(_GenericHandler):
 
     @tornado.web.asynchronous
     def get(self):
-        last_event_seen, past_events_limit, non_blocking = \
+        last_event_seen, past_events_limit, non_blocking, from_sequence = \
             self._last_seen_parameters()
+        filter_ = self._filter_parameter()
         if ('Accept' in self.request.headers
             and ztreamy.json_media_type in self.request.headers['Accept']):
             serialization = ztreamy.SERIALIZATION_JSON
@@ -960,21 +2277,36 @@ class _ShortLivedHandler(_GenericHandler):
             serialization=ztreamy.SERIALIZATION_ZTREAMY
             self.set_header('Content-Type', ztreamy.stream_media_type)
         self.set_header('Access-Control-Allow-Origin', '*')
-        encoding = self._select_encoding(['gzip', 'identity'])
+        if filter_ is None:
+            dictionary = self.dispatcher.dictionary
+        else:
+            dictionary = None
+        acceptable_encodings = ['gzip', 'identity']
+        if dictionary is not None:
+            acceptable_encodings.append(ztreamy.dictionary_encoding)
+        encoding = self._select_encoding(acceptable_encodings)
         if encoding == 'gzip':
             encoding = ClientProperties.ENCODING_GZIP
             self.set_header('Content-Encoding', 'gzip')
+        elif encoding == ztreamy.dictionary_encoding:
+            encoding = ClientProperties.ENCODING_ZLIB_DICT
+            self._set_dictionary_header(dictionary)
         else:
             encoding = ClientProperties.ENCODING_PLAIN
+        if encoding != ClientProperties.ENCODING_ZLIB_DICT:
+            dictionary = None
         properties = ClientPropertiesFactory.create( \
                                 streaming=False,
                                 serialization=serialization,
                                 encoding=encoding)
-        self.client = _Client(self, self._on_new_data, properties)
+        self.client = _Client(self, self._on_new_data, properties,
+                              dictionary=dictionary)
         self.dispatcher.register_client(self.client,
                                         last_event_seen=last_event_seen,
                                         past_events_limit=past_events_limit,
-                                        non_blocking=non_blocking)
+                                        non_blocking=non_blocking,
+                                        from_sequence=from_sequence,
+                                        filter_=filter_)
 
     def _on_new_data(self, data, flush=False):
         # No need to flush because the request will be soon completed
@@ -983,40 +2315,303 @@ class _ShortLivedHandler(_GenericHandler):
             self.write(data)
 
 
+class _DictionaryHandler(_GenericHandler):
+    def __init__(self, application, request, dispatcher=None, stream=None):
+        super(_DictionaryHandler, self).__init__(application, request)
+        self.dispatcher = dispatcher
+
+    def get(self, dictionary_id):
+        dictionary = self.dispatcher.dictionaries.get(dictionary_id)
+        if dictionary is None:
+            raise tornado.web.HTTPError(404, 'Not Found')
+        self.set_header('Content-Type', 'application/octet-stream')
+        self.set_header('Access-Control-Allow-Origin', '*')
+        # Dictionaries never change: their id is a hash of their contents
+        self.set_header('Cache-Control', 'public, max-age=86400')
+        self.write(dictionary.data)
+
+
+class _HistoryHandler(_GenericHandler):
+    """Serves ranges of events from the persistent log of the stream.
+
+    The 'from' and 'to' arguments delimit the range of events.
+    Each of them may be a sequence number, an event id or an RFC 3339
+    timestamp. The range includes the 'from' event and excludes the
+    'to' event. By default, it spans the whole log.
+
+    The events are sent in the ztreamy serialization, which is the
+    format in which they are stored, in chunks read from the
+    memory-mapped segment files. Every chunk is sent only after the
+    previous one has been written to the socket, so that many long
+    responses can be served without using much memory and without
+    delaying other requests.
+
+    Finding the range may scan whole segments (e.g. for an event id
+    that is not in the sparse index), which is done by a pool of
+    'lookup_threads' threads instead of the thread of the IOLoop.
+
+    """
+    chunk_size = 65536
+    lookup_threads = 2
+    _lookup_pool = None
+
+    def __init__(self, application, request, dispatcher=None, stream=None):
+        super(_HistoryHandler, self).__init__(application, request)
+        self.dispatcher = dispatcher
+
+    @tornado.gen.coroutine
+    def get(self):
+        log = self.dispatcher.event_log
+        ranges = yield self._run_lookup(self._lookup, log,
+                                        self.get_argument('from', None),
+                                        self.get_argument('to', None))
+        self.set_header('Content-Type', ztreamy.stream_media_type)
+        self.set_header('Access-Control-Allow-Origin', '*')
+        if self._select_encoding(['deflate', 'identity']) == 'deflate':
+            self.set_header('Content-Encoding', 'deflate')
+            compressor = zlib.compressobj()
+        else:
+            compressor = None
+        try:
+            for segment, offset, end_offset in ranges:
+                data = segment.map()
+                try:
+                    for pos in range(offset, end_offset, self.chunk_size):
+                        chunk = data[pos:min(pos + self.chunk_size,
+                                             end_offset)]
+                        if compressor is not None:
+                            chunk = compressor.compress(chunk)
+                        if chunk:
+                            self.write(chunk)
+                            yield self.flush()
+                finally:
+                    data.close()
+            if compressor is not None:
+                self.write(compressor.flush())
+        except tornado.iostream.StreamClosedError:
+            return
+        self.finish()
+
+    def _run_lookup(self, function, *args):
+        # Returns a Future for the result of the function,
+        # which runs in the pool of threads
+        if _HistoryHandler._lookup_pool is None:
+            _HistoryHandler._lookup_pool = multiprocessing.pool.ThreadPool( \
+                                                        self.lookup_threads)
+        future = tornado.concurrent.Future()
+        ioloop = tornado.ioloop.IOLoop.current()
+
+        def callback(outcome):
+            # Called from a thread of the pool
+            ioloop.add_callback(_set_outcome, future, outcome)
+
+        _HistoryHandler._lookup_pool.apply_async(_call_for_outcome,
+                                                 (function, args),
+                                                 callback=callback)
+        return future
+
+    def _lookup(self, log, from_value, to_value):
+        # Runs in the pool of threads
+        if not log.writable:
+            log.refresh()
+        start = self._position(log, from_value, log.first_sequence)
+        end = self._position(log, to_value, log.next_sequence)
+        return list(self._ranges(log, start, end))
+
+    def _position(self, log, value, default):
+        # Converts the value of the 'from' and 'to' arguments
+        # to a sequence number
+        if value is None:
+            return default
+        elif value.isdigit():
+            return int(value)
+        try:
+            timestamp = ztreamy.rfc3339_as_time(value)
+        except ztreamy.ZtreamyException:
+            sequence = log.find_event(value)
+            if sequence is None:
+                raise tornado.web.HTTPError(404, 'Event not found')
+            return sequence
+        else:
+            return log.find_time(timestamp)
+
+    def _ranges(self, log, start, end):
+        # Yields (segment, start offset, end offset) tuples
+        for segment in list(log.segments):
+            if (segment.end_sequence <= start
+                or segment.first_sequence >= end):
+                continue
+            offset = segment.offset_of(max(start, segment.first_sequence))
+            if end < segment.end_sequence:
+                end_offset = segment.offset_of(end)
+            else:
+                end_offset = segment.size
+            if offset is not None and end_offset > offset:
+                yield segment, offset, end_offset
+
+
+class _AdaptiveBuffering(object):
+    """Computes the buffering period of a stream from its load.
+
+    The period is chosen so that dispatching a batch of events takes
+    at most 'duty_cycle' of the time, which amortizes the cost of
+    serializing and compressing each batch for every group of
+    clients. That cost is measured at every dispatch (its 99th
+    percentile over the latest 'history' batches), and grows with
+    the number of events per batch and the number of clients, and
+    so does the period. It is limited by 'max_time' and by the
+    latency target. Events are not buffered when the expected number
+    of events in the period is less than one.
+
+    """
+    duty_cycle = 0.1
+    history = 128
+    rate_smoothing = 0.2
+
+    def __init__(self, max_time, latency_target=None):
+        """Both 'max_time' and 'latency_target' are in milliseconds."""
+        self.max_time = max_time / 1000.0
+        if latency_target is not None:
+            self.latency_target = latency_target / 1000.0
+        else:
+            self.latency_target = None
+        self.period = 0.0
+        # Events per second, smoothed
+        self.rate = 0.0
+        self.costs = deque(maxlen=self.history)
+        self.last_dispatch = time.time()
+
+    def window(self):
+        """Returns the time (in seconds) new events should wait."""
+        if self.rate * self.period < 1.0:
+            return 0.0
+        else:
+            return self.period
+
+    def batch_dispatched(self, num_events, cost):
+        """Updates the period after dispatching a batch of events.
+
+        'cost' is the time (in seconds) the dispatch took.
+
+        """
+        now = time.time()
+        elapsed = max(now - self.last_dispatch, 0.001)
+        self.last_dispatch = now
+        self.rate += self.rate_smoothing * (num_events / elapsed - self.rate)
+        self.costs.append(cost)
+        costs = sorted(self.costs)
+        cost_p99 = costs[int(0.99 * (len(costs) - 1))]
+        period = min(cost_p99 / self.duty_cycle, self.max_time)
+        if self.latency_target is not None:
+            period = min(period, self.latency_target - cost_p99)
+        self.period = max(period, 0.0)
+
+
 class _RecentEventsBuffer(object):
-    """A circular buffer that stores the latest events of a stream."""
-    def __init__(self, size):
-        """Creates a new buffer with capacity for 'size' events."""
+    """A ring buffer that stores the latest events of a stream.
+
+    Events are numbered in arrival order by a sequence number that
+    starts at 0 when the buffer is created. An event is evicted when
+    the buffer already holds 'size' events, when the serializations
+    of the events it holds take more than 'max_bytes' bytes or when
+    it is older than 'max_age' seconds. Looking up an event by its
+    id or its sequence number takes constant time.
+
+    The events are also grouped in segments of 'segment_size'
+    consecutive events. The serialization of a segment, and its
+    compressed form, are computed the first time a client asks for
+    past events that span the whole segment, and reused for the
+    next clients while the segment is in the buffer.
+
+    """
+    segment_size = 64
+
+    def __init__(self, size, max_bytes=None, max_age=None):
+        """Creates a new buffer with capacity for 'size' events.
+
+        'max_bytes' and 'max_age' are optional additional limits on
+        the size of the events (in bytes of their serialization)
+        and their age (in seconds).
+
+        """
+        self.capacity = size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
         self.buffer = [None] * size
-        self.position = 0
+        self.sizes = [0] * size
+        self.times = [0.0] * size
+        # Sequence numbers of the oldest event and of the next event
+        self.first = 0
+        self.num_events = 0
+        self.num_bytes = 0
+        # Event id -> sequence number
         self.events = {}
+        self.evicted = {'size': 0, 'bytes': 0, 'age': 0}
+        # (serialization, segment number) -> [serialized, compressed]
+        self.segments = {}
+
+    def __len__(self):
+        return self.num_events - self.first
 
     def append_event(self, event):
         """Appends an event to the buffer."""
-        if self.buffer[self.position] is not None:
-            del self.events[self.buffer[self.position].event_id]
-        self.buffer[self.position] = event
-        self.events[event.event_id] = self.position
-        self.position += 1
-        if self.position == len(self.buffer):
-            self.position = 0
+        self.append_events([event])
 
     def append_events(self, events):
         """Appends a list of events to the buffer."""
-        if len(events) > len(self.buffer):
-            events = events[-len(self.buffer):]
-        if self.position + len(events) >= len(self.buffer):
-            first_block = len(self.buffer) - self.position
-            self._append_internal(events[:first_block])
-            self._append_internal(events[first_block:])
-        else:
-            self._append_internal(events)
+        now = time.time()
+        capacity = self.capacity
+        buffer_ = self.buffer
+        times = self.times
+        ids = self.events
+        seq = self.num_events
+        for event in events:
+            if seq - self.first == capacity:
+                self._evict_oldest()
+                self.evicted['size'] += 1
+            pos = seq % capacity
+            buffer_[pos] = event
+            times[pos] = now
+            ids[event.event_id] = seq
+            seq += 1
+            if self.max_bytes is not None:
+                size = len(str(event))
+                self.sizes[pos] = size
+                self.num_bytes += size
+        self.num_events = seq
+        self._evict_by_bytes()
+        self._evict_by_age(now)
+
+    def restore(self, evs, first_sequence):
+        """Loads events into an empty buffer.
+
+        The events are numbered from 'first_sequence' on.
+
+        """
+        if self.num_events:
+            raise ValueError('The buffer is not empty')
+        self.first = self.num_events = first_sequence
+        self.append_events(evs)
 
     def load_from_file(self, file_):
         deserializer = events.Deserializer()
         for evs in deserializer.deserialize_file(file_):
             self.append_events(evs)
 
+    def get_event(self, event_id):
+        """Returns the event with the given id, or None."""
+        seq = self.events.get(event_id)
+        if seq is None:
+            return None
+        return self.buffer[seq % self.capacity]
+
+    def get_by_sequence(self, seq):
+        """Returns the event with the given sequence number, or None."""
+        if self.first <= seq < self.num_events:
+            return self.buffer[seq % self.capacity]
+        else:
+            return None
+
     def newer_than(self, event_id, limit=None):
         """Returns the events newer than the given 'event_id'.
 
@@ -1027,59 +2622,304 @@ class _RecentEventsBuffer(object):
         If 'limit' is not None, at most 'limit' events are returned
         (the most recent ones).
 
-        Returns a tuple ('events', 'complete') where 'events' is the list
-        of events and 'complete' is True when 'event_id' is in the buffer
-        and no limit was applied.
+        Returns a tuple ('events', 'complete') where 'events' is a
+        view of the events (see '_EventsView') and 'complete' is True
+        when 'event_id' is in the buffer and no limit was applied.
 
         """
-        if event_id in self.events:
+        self._evict_by_age(time.time())
+        seq = self.events.get(event_id)
+        if seq is not None:
+            start = seq + 1
             complete = True
-            pos = self.events[event_id] + 1
-            if pos == len(self.buffer):
-                pos = 0
-            if pos == self.position:
-                data = []
-            elif pos < self.position:
-                data = self.buffer[pos:self.position]
-            else:
-                data = self.buffer[pos:] + self.buffer[:self.position]
         else:
+            start = self.first
             complete = False
-            if (self.position != len(self.buffer) - 1
-                and self.buffer[self.position + 1] is None):
-                data = self.buffer[:self.position]
-            else:
-                data = (self.buffer[self.position:]
-                        + self.buffer[:self.position])
-        if limit is not None and len(data) > limit:
-            data = data[-limit:]
+        if limit is not None and self.num_events - start > limit:
+            start = self.num_events - limit
+            complete = False
+        return self.view(start, self.num_events), complete
+
+    def from_sequence(self, seq, limit=None, next_sequence=None):
+        """Returns the events from the sequence number 'seq' on.
+
+        Returns a tuple ('events', 'complete') like 'newer_than'.
+        'complete' is False when some of the requested events are no
+        longer in the buffer or were cut by the limit. A sequence
+        number ahead of the stream means that it was restarted (the
+        numbering began again), and then all the events are returned.
+
+        'next_sequence' is the number the stream will give to its next
+        event, when the stream has numbered events that are not in
+        the buffer yet because they are still buffered for dispatch.
+        Sequence numbers up to it are valid, and no event in the
+        buffer is returned for them.
+
+        """
+        self._evict_by_age(time.time())
+        if next_sequence is None:
+            next_sequence = self.num_events
+        if self.first <= seq <= max(self.num_events, next_sequence):
+            start = min(seq, self.num_events)
+            complete = True
+        else:
+            start = self.first
+            complete = False
+        if limit is not None and self.num_events - start > limit:
+            start = self.num_events - limit
             complete = False
-        return data, complete
+        return self.view(start, self.num_events), complete
 
     def most_recent(self, num_events):
-        if num_events > len(self.buffer):
-            num_events = len(self.buffer)
-        pos = self.position - num_events
-        if pos >= 0:
-            data = self.buffer[pos:self.position]
-        elif self.buffer[-1] is not None:
-            data = self.buffer[pos:] + self.buffer[:self.position]
+        """Returns a view of the 'num_events' most recent events."""
+        self._evict_by_age(time.time())
+        start = max(self.num_events - num_events, self.first)
+        return self.view(start, self.num_events)
+
+    def view(self, start, end):
+        """Returns a view of the events with sequence numbers in a range.
+
+        'start' is included and 'end' excluded.
+
+        """
+        if start < self.first or end > self.num_events or start > end:
+            raise ValueError('Events not in the buffer')
+        return _EventsView(self, start, end)
+
+    def stats(self):
+        """Returns a dictionary with the occupancy of the buffer.
+
+        The number of bytes is only computed when the buffer
+        has a 'max_bytes' limit.
+
+        """
+        if len(self):
+            oldest_age = time.time() - self.times[self.first % self.capacity]
         else:
-            data = self.buffer[:self.position]
-        return data
+            oldest_age = None
+        return {
+            'events': len(self),
+            'capacity': self.capacity,
+            'bytes': self.num_bytes,
+            'max_bytes': self.max_bytes,
+            'oldest_age': oldest_age,
+            'max_age': self.max_age,
+            'evicted_by_size': self.evicted['size'],
+            'evicted_by_bytes': self.evicted['bytes'],
+            'evicted_by_age': self.evicted['age'],
+            'segments': len(self.segments),
+        }
+
+    def serialize_most_recent(self, num_events, serialization, encoding,
+                              dictionary=None):
+        """Returns the most recent events serialized and encoded.
+
+        At most 'num_events' events are included. The data is
+        assembled from the cached segments when possible, so that only
+        the events at both ends of the range are serialized and
+        compressed again.
+
+        """
+        num_events = min(num_events, len(self))
+        segment_size = self.segment_size
+        start = self.num_events - num_events
+        end = self.num_events
+        # Whole segments that start after the first event of the range
+        first = start // segment_size + 1
+        last = end // segment_size
+        if first >= last:
+            first = last = None
+            head_end = end
+        else:
+            head_end = first * segment_size
+        self._prune_segments()
+        serialized = [_serialize_piece(self.view(start, head_end),
+                                       serialization, True)]
+        segments = []
+        if first is not None:
+            for number in range(first, last):
+                segment = self._segment(serialization, number)
+                serialized.append(segment[0])
+                segments.append(segment)
+            serialized.append(_serialize_piece( \
+                                self.view(last * segment_size, end),
+                                serialization, False))
+        if serialization == ztreamy.SERIALIZATION_JSON:
+            serialized.append(']')
+        if encoding == ClientProperties.ENCODING_PLAIN:
+            return ''.join(serialized)
+        elif encoding == ClientProperties.ENCODING_ZLIB_DICT:
+            return dictionary.compress(''.join(serialized))
+        pieces = [dispatchers.compress_deflate_raw(serialized[0])]
+        for segment in segments:
+            if segment[1] is None:
+                segment[1] = dispatchers.compress_deflate_raw(segment[0])
+            pieces.append(segment[1])
+        if len(serialized) > len(segments) + 1:
+            pieces.append(dispatchers.compress_deflate_raw( \
+                                        ''.join(serialized[len(segments) + 1:])))
+        if encoding == ClientProperties.ENCODING_ZLIB:
+            return dispatchers.wrap_zlib(pieces)
+        elif encoding == ClientProperties.ENCODING_GZIP:
+            crc = 0
+            for data in serialized:
+                crc = zlib.crc32(data, crc)
+            return dispatchers.wrap_gzip(pieces, crc,
+                                         sum(len(data) for data in serialized))
+        else:
+            raise ValueError('Unknown encoding')
+
+    def _segment(self, serialization, number):
+        key = (serialization, number)
+        segment = self.segments.get(key)
+        if segment is None:
+            start = number * self.segment_size
+            evs = self.view(start, start + self.segment_size)
+            segment = [_serialize_piece(evs, serialization, False), None]
+            self.segments[key] = segment
+        return segment
+
+    def _prune_segments(self):
+        # Remove the segments with events no longer in the buffer
+        first = -(-self.first // self.segment_size)
+        for key in [key for key in self.segments if key[1] < first]:
+            del self.segments[key]
+
+    def _evict_by_bytes(self):
+        # The newest event is kept even if it is bigger than the limit
+        if self.max_bytes is not None:
+            while self.num_bytes > self.max_bytes and len(self) > 1:
+                self._evict_oldest()
+                self.evicted['bytes'] += 1
+
+    def _evict_by_age(self, now):
+        if self.max_age is not None:
+            limit = now - self.max_age
+            while len(self) and self.times[self.first % self.capacity] < limit:
+                self._evict_oldest()
+                self.evicted['age'] += 1
+
+    def _evict_oldest(self):
+        pos = self.first % self.capacity
+        event_id = self.buffer[pos].event_id
+        # A newer event may have the same id
+        if self.events.get(event_id) == self.first:
+            del self.events[event_id]
+        self.buffer[pos] = None
+        if self.max_bytes is not None:
+            self.num_bytes -= self.sizes[pos]
+            self.sizes[pos] = 0
+        self.first += 1
+
+
+class _EventsView(object):
+    """A read-only view of consecutive events of '_RecentEventsBuffer'.
+
+    It does not copy the events. It behaves like a list of events
+    while the buffer does not evict them, which means that it should
+    not be kept after new events are appended to the buffer.
 
-    def _append_internal(self, events):
-        self._remove_from_dict(self.position, len(events))
-        self.buffer[self.position:self.position + len(events)] = events
-        for i in range(0, len(events)):
-            self.events[events[i].event_id] = self.position + i
-        self.position = (self.position + len(events)) % len(self.buffer)
+    """
+    __slots__ = ('_buffer', '_start', '_end')
+
+    def __init__(self, buffer_, start, end):
+        self._buffer = buffer_
+        self._start = start
+        self._end = end
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def start(self):
+        """The sequence number of the first event of the view."""
+        return self._start
+
+    def __iter__(self):
+        buffer_ = self._buffer.buffer
+        capacity = self._buffer.capacity
+        for seq in xrange(self._start, self._end):
+            yield buffer_[seq % capacity]
+
+    def __reversed__(self):
+        buffer_ = self._buffer.buffer
+        capacity = self._buffer.capacity
+        for seq in xrange(self._end - 1, self._start - 1, -1):
+            yield buffer_[seq % capacity]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return list(self)[index]
+            stop = max(start, stop)
+            return _EventsView(self._buffer, self._start + start,
+                               self._start + stop)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Index out of range')
+        return self._buffer.buffer[(self._start + index)
+                                   % self._buffer.capacity]
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def _serialize_piece(evs, serialization, first):
+    # Serializes events so that the pieces of a range can be
+    # concatenated. In JSON, only the 'first' piece opens the array
+    # and the closing bracket is appended separately.
+    if serialization == ztreamy.SERIALIZATION_JSON:
+        items = [e.serialize_json() for e in evs]
+        if first:
+            return '[' + ', '.join(items)
+        else:
+            return ''.join(', ' + item for item in items)
+    else:
+        return ztreamy.serialize_events(evs, serialization=serialization)
 
-    def _remove_from_dict(self, position, num_events):
-        for i in range(position, position + num_events):
-            if self.buffer[i] is not None:
-                if self.buffer[i].event_id in self.events:
-                    del self.events[self.buffer[i].event_id]
+def _call_for_outcome(function, args):
+    # The thread pool would not report the exceptions
+    try:
+        return function(*args), None
+    except Exception as e:
+        return None, e
+
+def _set_outcome(future, outcome):
+    result, exception = outcome
+    if exception is None:
+        future.set_result(result)
+    else:
+        future.set_exception(exception)
+
+def _check_bodies(evs):
+    # Bodies may be parsed lazily, but published events are rejected
+    # right away when they are malformed
+    for event in evs:
+        event.check_body()
+
+def _encode_events(evs, serialization, encoding):
+    # Serializes and compresses events to be sent on their own
+    data = ztreamy.serialize_events(evs, serialization=serialization)
+    if encoding == ClientProperties.ENCODING_ZLIB:
+        return dispatchers.wrap_zlib([dispatchers.compress_deflate_raw(data)])
+    elif encoding == ClientProperties.ENCODING_GZIP:
+        return dispatchers.compress_gzip(data)
+    else:
+        return data
 
 def main():
     import time
@@ -1095,12 +2935,20 @@ def main():
                            type=int)
     tornado.options.define('buffer', default=None, help='event buffer time (s)',
                            type=float)
+    tornado.options.define('adaptive', default=False,
+                           help='adapt the buffer time to the load, '
+                                'up to --buffer',
+                           type=bool)
     tornado.options.define('eventlog', default=False,
                            help='dump event log',
                            type=bool)
     tornado.options.define('autostop', default=False,
                            help='stop the server when the source finishes',
                            type=bool)
+    tornado.options.define('processes', default=1,
+                           help='number of worker processes (0 for one per '
+                                'CPU core)',
+                           type=int)
     tornado.options.parse_command_line()
     port = tornado.options.options.port
     if (tornado.options.options.buffer is not None
@@ -1109,9 +2957,11 @@ def main():
     else:
         buffering_time = None
     server = StreamServer(port,
-                 stop_when_source_finishes=tornado.options.options.autostop)
+                 stop_when_source_finishes=tornado.options.options.autostop,
+                 num_processes=tornado.options.options.processes)
     stream = Stream('/events', allow_publish=True,
-                    buffering_time=buffering_time)
+                    buffering_time=buffering_time,
+                    adaptive_buffering=tornado.options.options.adaptive)
     ## relay = RelayStream('/relay', [('http://localhost:' + str(port)
     ##                                + '/stream/priority')],
     ##                     allow_publish=True,
@@ -47,6 +47,10 @@ def read_cmd_options():
                            help='distribution of the time between events')
     tornado.options.define('limit', default=0, type=int,
                            help='number of events to generate')
+    tornado.options.define('batch_time', default=0, type=int,
+                           help='send the events in batches every this '
+                                'number of milliseconds (0 disables '
+                                'batching)')
     tornado.options.define('eventlog', default=False,
                            help='dump event log',
                            type=bool)
@@ -62,7 +66,14 @@ def main():
     options = read_cmd_options()
     entity_id = ztreamy.random_id()
     limit = tornado.options.options.limit
-    publishers = [client.EventPublisher(url) for url in options.server_urls]
+    batch_time = tornado.options.options.batch_time
+    if batch_time > 0:
+        publishers = [client.BatchingEventPublisher(url,
+                                                    buffering_time=batch_time)
+                      for url in options.server_urls]
+    else:
+        publishers = [client.EventPublisher(url)
+                      for url in options.server_urls]
     io_loop = tornado.ioloop.IOLoop.instance()
     time_generator = utils.get_scheduler(tornado.options.options.distribution)
     scheduler = Scheduler(limit, entity_id, io_loop, publishers,